@@ -0,0 +1,389 @@
+"""
+Benchmark suite for the shingling, minhashing and lsh pipeline
+
+Synthetic corpora of any size are generated from the orig_task*.txt files
+of the corpus folder. Documents are random draws of words from those seeds,
+and a given fraction of them are near-duplicates created by mutating an
+earlier document.
+
+Every pipeline stage and query path is timed, and its peak memory is
+measured using tracemalloc. Results are appended as one JSON object per
+corpus size to a JSONL file, which can be compared across commits.
+
+usage:
+    python benchmark.py --sizes 1000 10000 --output bench.jsonl
+    python benchmark.py --compare baseline.jsonl bench.jsonl
+
+This module contains the following functions:
+    * generate_corpus - write a synthetic plagiarism corpus
+    * run_benchmark - time and measure every stage for a corpus size
+    * compare - find time and memory regressions between two result files
+"""
+
+import argparse
+import glob
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+
+import lsh
+import metrics
+import minhashing
+import shingling
+import statistics
+import storage
+
+
+def load_seed_words(folderpath="corpus", pattern="orig_task*.txt"):
+    """This function reads the words of the seed documents
+
+    Parameters
+    ----------
+    folderpath: str, optional
+        folder containing the seed documents. Default: corpus
+    pattern: str, optional
+        glob pattern of the seed documents. Default: orig_task*.txt
+
+    Returns
+    -------
+    numpy.ndarray
+        array of all words of the seed documents
+    """
+
+    words = []
+    for path in sorted(glob.glob(os.path.join(folderpath, pattern))):
+        words.extend(shingling.read_document(path).split())
+    if not words:
+        raise Exception(f"No seed documents matching {pattern} in {folderpath}")
+    return np.array(words)
+
+
+def generate_corpus(folderpath, no_of_docs, duplicate_rate=0.2, mutation_rate=0.05,
+                    doc_length=250, seed_folder="corpus", seed=0, files_per_folder=1000,
+                    max_sources=10000):
+    """This function writes a synthetic corpus with controlled near-duplicates
+
+    Parameters
+    ----------
+    folderpath: str
+        folder to write the corpus to. Created if it does not exist
+    no_of_docs: int
+        no of documents to generate
+    duplicate_rate: float, optional
+        fraction of documents which are mutated copies of an earlier
+        document. Default: 0.2
+    mutation_rate: float, optional
+        fraction of words replaced in a near-duplicate. Default: 0.05
+    doc_length: int, optional
+        average no of words in a document. Default: 250
+    seed_folder: str, optional
+        folder containing the orig_task*.txt seed documents. Default: corpus
+    seed: int, optional
+        seed of the random generator. Default: 0
+    files_per_folder: int, optional
+        documents are split into sub-folders of this size. Default: 1000
+    max_sources: int, optional
+        no of earlier documents near-duplicates are drawn from, sampled
+        uniformly over the corpus. Default: 10000
+
+    Returns
+    -------
+    list
+        list of (path, source path) tuples of every near-duplicate
+    """
+
+    rng = np.random.default_rng(seed)
+    pool = load_seed_words(seed_folder)
+    # candidate sources of near-duplicates, kept as word ids of the pool.
+    # a bounded reservoir of earlier documents keeps memory independent
+    # of no_of_docs
+    sources = []
+    duplicates = []
+
+    for i in range(no_of_docs):
+        if sources and rng.random() < duplicate_rate:
+            source_path, words = sources[int(rng.integers(0, len(sources)))]
+            words = words.copy()
+            mutate = rng.random(len(words)) < mutation_rate
+            words[mutate] = rng.integers(0, len(pool), size=int(mutate.sum()))
+        else:
+            source_path = None
+            length = max(1, int(rng.normal(doc_length, doc_length/4)))
+            words = rng.integers(0, len(pool), size=length)
+
+        folder = os.path.join(folderpath, f"{i//files_per_folder:05d}")
+        os.makedirs(folder, exist_ok=True)
+        path = os.path.join(folder, f"doc{i:07d}.txt")
+        with open(path, 'w', encoding="utf8") as doc:
+            doc.write(' '.join(pool[words].tolist()))
+
+        if source_path is not None:
+            duplicates.append((path, source_path))
+        if len(sources) < max_sources:
+            sources.append((path, words))
+        else:
+            j = int(rng.integers(0, i+1))
+            if j < max_sources:
+                sources[j] = (path, words)
+
+    return duplicates
+
+
+class _Stage:
+    """helper-class: context manager timing a stage and tracing its memory
+    """
+
+    def __init__(self, results, name, count=None, memory=True):
+        self.results = results
+        self.name = name
+        self.count = count
+        self.memory = memory
+
+    def __enter__(self):
+        if self.memory:
+            tracemalloc.start()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        seconds = time.perf_counter() - self.start
+        result = {"seconds": seconds}
+        if self.memory:
+            result["peak_bytes"] = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        if self.count is not None:
+            result["count"] = self.count
+            result["per_second"] = self.count/seconds if seconds > 0 else None
+        self.results[self.name] = result
+        return False
+
+
+def _git_commit():
+    """helper-function: current commit of the repository, if available"""
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def run_benchmark(no_of_docs, workdir, shingle_size=4, lsh_threshold=0.5, seed=0,
+                  parallel=None, no_of_queries=100, memory=True, hash_bits=None,
+                  scheme="minhash", signature_bits=None, **corpus_args):
+    """This function benchmarks every stage of the pipeline on a synthetic corpus
+
+    Parameters
+    ----------
+    no_of_docs: int
+        no of documents in the generated corpus
+    workdir: str
+        folder to write the corpus and index to
+    shingle_size: int, optional
+        size of shingles. Default: 4
+    lsh_threshold: float, optional
+        target similarity used to plan the bands. Default: 0.5
+    seed: int, optional
+        seed for corpus generation and hash functions. Default: 0
+    parallel: int, optional
+        no of processes for shingling and minhashing. Default: None
+    no_of_queries: int, optional
+        no of documents queried in the query stages. Default: 100
+    memory: bool, optional
+        trace peak memory of each stage. Tracing slows down the stages.
+        Default: True
+    hash_bits: int, optional
+        shingle with 32 or 64-bit fingerprints instead of a vocabulary.
+        Default: None
+    scheme: str, optional
+        signature scheme, "minhash", "oph" or "simhash". Default: "minhash"
+    signature_bits: int, optional
+        keep b bits of every signature value, packed. Default: None
+    corpus_args:
+        other parameters passed on to generate_corpus
+
+    Returns
+    -------
+    dict
+        parameters of the run and measurements of every stage
+    """
+
+    folderpath = os.path.join(workdir, f"corpus_{no_of_docs}")
+    index_path = folderpath + ".index"
+    plan = lsh.plan_banding(lsh_threshold, bits=signature_bits, scheme=scheme)
+    stages = dict()
+
+    with _Stage(stages, "generate", no_of_docs, memory=False):
+        duplicates = generate_corpus(folderpath, no_of_docs, seed=seed, **corpus_args)
+
+    with _Stage(stages, "shingling", no_of_docs, memory):
+        incidence_matrix, files = shingling.get_shingle_matrix(folderpath, shingle_size, parallel=parallel,
+                                                               hash_bits=hash_bits)
+    stages["shingling"]["shingles"] = incidence_matrix.nnz
+
+    with _Stage(stages, "minhashing", no_of_docs, memory):
+        signature_matrix = minhashing.generate_signature_matrix(incidence_matrix, plan.n, seed,
+                                                                 parallel=parallel, scheme=scheme)
+        if signature_bits is not None:
+            signature_matrix = minhashing.PackedSignatures.from_signatures(signature_matrix, signature_bits)
+
+    with _Stage(stages, "lsh", no_of_docs, memory):
+        buckets_list = lsh.get_bucket_list(signature_matrix, plan)
+    bucket_sizes = np.concatenate([ table.bucket_sizes() for table in buckets_list ])
+    stages["lsh"]["max_bucket"] = int(bucket_sizes.max()) if len(bucket_sizes) else 0
+    stages["lsh"]["oversized_buckets"] = int(np.sum(bucket_sizes > metrics.OVERSIZED_BUCKET))
+
+    params = { "shingle_size": shingle_size, "extension": ".txt",
+               "no_of_hash_functions": plan.n, "seed": seed, "r": plan.r,
+               "hash_bits": hash_bits, "scheme": scheme,
+               "signature_bits": signature_bits }
+    with _Stage(stages, "save_index", no_of_docs, memory):
+        storage.save_index(index_path, params, files, incidence_matrix, signature_matrix, buckets_list)
+    with _Stage(stages, "load_index", no_of_docs, memory):
+        index = storage.load_index(index_path)
+
+    rng = np.random.default_rng(seed)
+    query_ids = rng.choice(len(files), size=min(no_of_queries, len(files)), replace=False).tolist()
+    with _Stage(stages, "query_batch", len(query_ids), memory):
+        candidates = lsh.find_similar_docs_batch(query_ids, index.buckets_list, index.signature_matrix, plan)
+        for doc_id in query_ids:
+            statistics.estimate_similarity(doc_id, candidates[doc_id], index.signature_matrix)
+    stages["query_batch"]["candidates_per_query"] = float(np.mean([len(c) for c in candidates.values()]))
+
+    query_paths = [ files[doc_id][0] for doc_id in query_ids[:min(20, len(query_ids))] ]
+    with _Stage(stages, "query_text", len(query_paths), memory):
+        for path in query_paths:
+            index.query_file(path)
+
+    with _Stage(stages, "all_pairs", no_of_docs, memory):
+        pairs, _ = lsh.bucket_pairs(index.buckets_list, metrics.OVERSIZED_BUCKET)
+        statistics.pair_similarity(pairs, index.signature_matrix)
+    stages["all_pairs"]["pairs"] = len(pairs)
+
+    del index
+    shutil.rmtree(folderpath)
+    shutil.rmtree(index_path)
+
+    return {
+        "commit": _git_commit(),
+        "timestamp": time.time(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "no_of_docs": no_of_docs,
+        "duplicates": len(duplicates),
+        "params": dict(params, b=plan.b, parallel=parallel, memory=memory),
+        "stages": stages,
+    }
+
+
+def compare(baseline_path, current_path, tolerance=0.2, memory_tolerance=0.2):
+    """This function finds stages which got slower or use more memory
+    between two result files
+
+    Parameters
+    ----------
+    baseline_path: str
+        JSONL results of the baseline
+    current_path: str
+        JSONL results to check
+    tolerance: float, optional
+        allowed relative slow down of a stage. Default: 0.2
+    memory_tolerance: float, optional
+        allowed relative growth of the peak memory of a stage, compared
+        when both runs traced memory. Default: 0.2
+
+    Returns
+    -------
+    list
+        list of (no_of_docs, stage, measure, baseline, current) of every
+        stage worse than allowed, measure is "seconds" or "peak_bytes"
+    """
+
+    def latest(path):
+        runs = dict()
+        with open(path, 'r', encoding="utf8") as results:
+            for line in results:
+                if line.strip():
+                    run = json.loads(line)
+                    runs[run["no_of_docs"]] = run
+        return runs
+
+    baseline, current = latest(baseline_path), latest(current_path)
+    regressions = []
+    for no_of_docs in sorted(set(baseline) & set(current)):
+        for stage, result in current[no_of_docs]["stages"].items():
+            base = baseline[no_of_docs]["stages"].get(stage)
+            if base is None or stage == "generate":
+                continue
+            ratio = result["seconds"]/base["seconds"] if base["seconds"] > 0 else 1.0
+            print(f"{no_of_docs}\t{stage}\t{base['seconds']:.4f}s -> {result['seconds']:.4f}s\t{ratio:.2f}x")
+            if ratio > 1 + tolerance:
+                regressions.append((no_of_docs, stage, "seconds", base["seconds"], result["seconds"]))
+            if base.get("peak_bytes") and result.get("peak_bytes") is not None:
+                ratio = result["peak_bytes"]/base["peak_bytes"]
+                print(f"{no_of_docs}\t{stage}\t{base['peak_bytes']}B -> {result['peak_bytes']}B\t{ratio:.2f}x")
+                if ratio > 1 + memory_tolerance:
+                    regressions.append((no_of_docs, stage, "peak_bytes", base["peak_bytes"], result["peak_bytes"]))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the LSH pipeline on synthetic corpora")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000],
+                        help="no of documents of each generated corpus")
+    parser.add_argument("--output", default="benchmark_results.jsonl", help="JSONL file to append results to")
+    parser.add_argument("--workdir", default=None, help="folder for generated corpora. Default: a temporary folder")
+    parser.add_argument("--shingle-size", type=int, default=4)
+    parser.add_argument("--threshold", type=float, default=0.5, help="target similarity to plan the bands")
+    parser.add_argument("--duplicate-rate", type=float, default=0.2)
+    parser.add_argument("--mutation-rate", type=float, default=0.05)
+    parser.add_argument("--parallel", type=int, default=None)
+    parser.add_argument("--hash-bits", type=int, default=None, choices=[32, 64],
+                        help="shingle with fingerprints instead of a vocabulary")
+    parser.add_argument("--scheme", default="minhash", choices=["minhash", "oph", "simhash"],
+                        help="signature scheme")
+    parser.add_argument("--signature-bits", type=int, default=None, choices=[1, 2, 4, 8, 16],
+                        help="keep b bits of every signature value (b-bit minhash)")
+    parser.add_argument("--no-memory", action="store_true", help="do not trace peak memory")
+    parser.add_argument("--compare", nargs=2, metavar=("BASELINE", "CURRENT"),
+                        help="compare two result files instead of running")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed relative slow down")
+    parser.add_argument("--memory-tolerance", type=float, default=0.2,
+                        help="allowed relative growth of peak memory")
+    args = parser.parse_args()
+
+    if args.compare:
+        regressions = compare(args.compare[0], args.compare[1], args.tolerance, args.memory_tolerance)
+        for no_of_docs, stage, measure, base, current in regressions:
+            if measure == "seconds":
+                print(f"REGRESSION: {stage} on {no_of_docs} docs: {base:.4f}s -> {current:.4f}s")
+            else:
+                print(f"REGRESSION: {stage} on {no_of_docs} docs: peak memory {base}B -> {current}B")
+        sys.exit(1 if regressions else 0)
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="lsh_bench_")
+    try:
+        for no_of_docs in args.sizes:
+            result = run_benchmark(no_of_docs, workdir, shingle_size=args.shingle_size,
+                                   lsh_threshold=args.threshold, parallel=args.parallel,
+                                   memory=not args.no_memory, hash_bits=args.hash_bits,
+                                   scheme=args.scheme, signature_bits=args.signature_bits,
+                                   duplicate_rate=args.duplicate_rate,
+                                   mutation_rate=args.mutation_rate)
+            with open(args.output, 'a', encoding="utf8") as output:
+                output.write(json.dumps(result) + "\n")
+            for stage, measures in result["stages"].items():
+                print(f"{no_of_docs}\t{stage}\t{measures['seconds']:.4f}s\t{measures.get('peak_bytes', '')}")
+    finally:
+        if args.workdir is None:
+            shutil.rmtree(workdir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,216 @@
+"""
+Non-interactive command line entry point, for scripts and scheduled jobs
+
+    python cli.py index corpus --shingle-size 4 --threshold 0.5
+    python cli.py query corpus.index --from queries.txt --sim-type jaccard
+    find new/ -name "*.txt" | python cli.py query corpus.index --k 5
+    python cli.py dedupe corpus.index --threshold 0.8
+
+Every command writes one JSON object per line to stdout:
+
+    index   {"index": path, "documents": n, "params": {...}}
+    query   {"query": path, "results": [[doc_id, filename, score], ...]}
+            {"query": path, "error": "..."}
+    dedupe  {"cluster": i, "representative": filename,
+             "members": [[doc_id, filename, score], ...]}
+
+Query paths are read lazily from the command line, a file or stdin and are
+answered in batches, each batch written out as soon as it is done. Progress
+messages go to stderr, and metrics are logged to the file named by the
+LSH_METRICS environment variable, as for main.py. numpy and the index
+modules are only imported once a command runs, so --help and argument
+errors return immediately.
+
+This module contains the following:
+    * main - parse the arguments and run a command
+"""
+
+import argparse
+import contextlib
+import itertools
+import json
+import os
+import sys
+
+
+def _emit(out, record):
+    """helper-function: write one JSON line"""
+    out.write(json.dumps(record) + "\n")
+
+
+def _query_paths(args):
+    """helper-function: generate the query paths, from the arguments, the
+    --from file or stdin
+    """
+
+    yield from args.paths
+    if args.from_file is None and args.paths:
+        return
+    if args.from_file is None or args.from_file == "-":
+        stream = sys.stdin
+    else:
+        stream = open(args.from_file, 'r', encoding="utf8")
+    with stream:
+        for line in stream:
+            if line.strip():
+                yield line.strip()
+
+
+def _open_index(index_path):
+    """helper-function: open a saved index, exits if there is none"""
+    import storage
+
+    index = storage.load_index(index_path)
+    if index is None:
+        sys.exit(f"No index found at {index_path}")
+    return index
+
+
+def _index(args, out):
+    """helper-function: build or refresh the index of a corpus"""
+    from main import get_index
+
+    index = get_index(args.corpus, extension=args.extension, shingle_size=args.shingle_size,
+                      parallel=args.parallel, no_of_hash_functions=args.hash_functions, seed=args.seed,
+                      r=args.rows, lsh_threshold=args.threshold, hash_bits=args.hash_bits,
+                      scheme=args.scheme, signature_bits=args.signature_bits, stream=args.stream,
+                      index_path=args.output)
+    _emit(out, {"index": index.path, "documents": len(index.files) - len(index.deleted), "params": index.params})
+
+
+def _query_batch(index, doc_ids, paths, args):
+    """helper-function: answer a batch of query paths
+
+    indexed documents are looked up together, other files are read and
+    signed one by one.
+    """
+
+    # top-k queries estimate unless told otherwise, like StoredIndex.top_k
+    estimate = args.k is not None if args.estimate is None else args.estimate
+    outputs = dict()
+    known = [ doc_ids[path] for path in paths if path in doc_ids ]
+    if known and args.k is None:
+        outputs = index.query_ids(known, args.sim_type, estimate)
+
+    records = []
+    for path in paths:
+        try:
+            if args.k is not None and path in doc_ids:
+                output = index.top_k(doc_ids[path], args.k, args.sim_type, estimate)
+            elif args.k is not None:
+                with open(path, 'rb') as doc:
+                    text = doc.read().decode("utf8", errors="ignore")
+                output = index.top_k(text, args.k, args.sim_type, estimate)
+            elif path in doc_ids:
+                output = outputs[doc_ids[path]]
+            else:
+                output = index.query_file(path, args.sim_type, estimate)
+            results = [ [doc_id, index.files[doc_id][0], score] for doc_id, score in output
+                        if score >= args.threshold ]
+            if args.limit is not None:
+                results = results[:args.limit]
+            records.append({"query": path, "results": results})
+        except Exception as error:
+            records.append({"query": path, "error": str(error)})
+    return records
+
+
+def _query(args, out):
+    """helper-function: answer query paths in batches"""
+    index = _open_index(args.index)
+    # deleted documents have no filename
+    doc_ids = { os.path.normpath(filename): doc_id for filename, doc_id in index.files if filename is not None }
+    paths = _query_paths(args)
+    while True:
+        batch = list(itertools.islice(paths, args.batch_size))
+        if not batch:
+            break
+        lookup = { path: doc_ids[os.path.normpath(path)] for path in batch if os.path.normpath(path) in doc_ids }
+        for record in _query_batch(index, lookup, batch, args):
+            _emit(out, record)
+        out.flush()
+
+
+def _dedupe(args, out):
+    """helper-function: write the clusters of near-duplicate documents"""
+    import clustering
+
+    index = _open_index(args.index)
+    files = index.files
+    clusters = clustering.cluster_documents(index.buckets_list, index.signature_matrix, args.threshold,
+                                            args.max_bucket, args.min_size)
+    for i, cluster in enumerate(clusters):
+        _emit(out, {"cluster": i, "representative": files[cluster.representative][0],
+                    "members": [ [doc_id, files[doc_id][0], score]
+                                 for doc_id, score in zip(cluster.members, cluster.scores) ]})
+
+
+def _parser():
+    """helper-function: argument parser of all the commands"""
+    parser = argparse.ArgumentParser(description="Locality sensitive hashing of a corpus of documents")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    index = commands.add_parser("index", help="build the index of a corpus, or reuse it if up to date")
+    index.add_argument("corpus", help="folder of the corpus")
+    index.add_argument("--output", default=None, help="index directory. Default: {corpus}.index")
+    index.add_argument("--extension", default=".txt", help="extension of the documents")
+    index.add_argument("--shingle-size", type=int, default=4)
+    index.add_argument("--threshold", type=float, default=0.5,
+                       help="target similarity used to plan the bands")
+    index.add_argument("--hash-functions", type=int, default=None,
+                       help="signature length. Planned from --threshold if not given")
+    index.add_argument("--rows", type=int, default=None,
+                       help="rows in a band. Planned from --threshold if not given")
+    index.add_argument("--seed", type=int, default=0)
+    index.add_argument("--scheme", default="minhash", choices=["minhash", "oph", "simhash"])
+    index.add_argument("--hash-bits", type=int, default=None, choices=[32, 64],
+                       help="shingle with fingerprints instead of a vocabulary")
+    index.add_argument("--signature-bits", type=int, default=None, choices=[1, 2, 4, 8, 16],
+                       help="keep b bits of every signature value")
+    index.add_argument("--parallel", type=int, default=None, help="no of processes")
+    index.add_argument("--stream", action="store_true",
+                       help="read documents in chunks, without an incidence matrix")
+    index.set_defaults(run=_index)
+
+    query = commands.add_parser("query", help="find documents similar to given files")
+    query.add_argument("index", help="index directory")
+    query.add_argument("paths", nargs="*", help="files to query. Read from stdin if none are given")
+    query.add_argument("--from", dest="from_file", default=None,
+                       help="file listing a path per line, - for stdin")
+    query.add_argument("--batch-size", type=int, default=64)
+    query.add_argument("--threshold", type=float, default=0.0, help="minimum similarity of results")
+    query.add_argument("--sim-type", default="jaccard", choices=["jaccard", "euclid", "cosine"])
+    query.add_argument("--estimate", action=argparse.BooleanOptionalAction, default=None,
+                       help="estimate similarity from the signatures "
+                            "(default: only for --k queries)")
+    query.add_argument("--k", type=int, default=None,
+                       help="return the k most similar documents found by the LSH forest")
+    query.add_argument("--limit", type=int, default=None, help="most results per query")
+    query.set_defaults(run=_query)
+
+    dedupe = commands.add_parser("dedupe", help="group near-duplicate documents of an index")
+    dedupe.add_argument("index", help="index directory")
+    dedupe.add_argument("--threshold", type=float, default=0.5,
+                        help="minimum estimated similarity of merged documents")
+    dedupe.add_argument("--max-bucket", type=int, default=None, help="skip larger buckets")
+    dedupe.add_argument("--min-size", type=int, default=2, help="smallest cluster written")
+    dedupe.set_defaults(run=_dedupe)
+    return parser
+
+
+def main(argv=None):
+    args = _parser().parse_args(argv)
+    out = sys.stdout
+    if os.environ.get("LSH_METRICS"):
+        import metrics
+        metrics.set_sink(metrics.JSONLogSink(os.environ["LSH_METRICS"]))
+    # messages of the index modules would break the JSON lines
+    with contextlib.redirect_stdout(sys.stderr):
+        try:
+            args.run(args, out)
+        except BrokenPipeError:
+            pass    # output closed early, e.g. piped into head
+
+
+if __name__ == "__main__":
+    main()
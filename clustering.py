@@ -0,0 +1,129 @@
+"""
+Groups of near-duplicate documents found from the LSH bucket tables
+
+The bucket tables are walked once to list every pair of documents sharing a
+bucket. Pairs are verified by estimating their similarity from the
+signatures, and those above a threshold are merged into clusters using
+union-find. Buckets with more documents than max_bucket are skipped, as the
+pairs of a bucket grow quadratically with its size: this keeps the runtime
+close to linear in the no of documents when a few buckets collect unrelated
+documents (empty or boilerplate files).
+
+This module contains the following:
+    * Cluster - a group of near-duplicate documents
+    * UnionFind - disjoint sets of doc_ids
+    * cluster_documents - clusters of near-duplicate documents of an index
+"""
+
+from collections import namedtuple
+
+import numpy as np
+
+import lsh
+import metrics
+import statistics
+
+
+# representative: doc_id of the document closest to the rest of the cluster
+# members: doc_ids of the cluster, representative first
+# scores: estimated similarity of every member to the representative
+Cluster = namedtuple("Cluster", ["representative", "members", "scores"])
+
+
+class UnionFind:
+    """Disjoint sets of doc_ids, merged by union by size
+
+    Parameters
+    ----------
+    n: int
+        no of documents, every document starts in a set of its own
+    """
+
+    def __init__(self, n):
+        self.parent = list(range(n))
+        self.size = [1] * n
+
+    def find(self, x):
+        """returns the root of the set containing x"""
+        parent = self.parent
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]   # path halving
+            x = parent[x]
+        return x
+
+    def union(self, a, b):
+        """merges the sets containing a and b, returns the new root"""
+        a, b = self.find(a), self.find(b)
+        if a == b:
+            return a
+        if self.size[a] < self.size[b]:
+            a, b = b, a
+        self.parent[b] = a
+        self.size[a] += self.size[b]
+        return a
+
+    def groups(self, min_size=2):
+        """returns the sets with atleast min_size documents, as lists"""
+        groups = dict()
+        for x in range(len(self.parent)):
+            if self.size[self.find(x)] >= min_size:
+                groups.setdefault(self.find(x), []).append(x)
+        return list(groups.values())
+
+
+def cluster_documents(buckets_list, signature_matrix, threshold=0.5, max_bucket=None, min_size=2):
+    """This function groups near-duplicate documents into clusters
+
+    two documents end up in the same cluster if a chain of verified pairs
+    connects them, so members of large clusters need not all be similar to
+    each other; the scores to the representative show how close they are.
+
+    Parameters
+    ----------
+    buckets_list: list
+        list of bucket tables generated by lsh.get_bucket_list
+    signature_matrix: numpy.ndarray or minhashing.PackedSignatures
+        signatures of all documents as columns
+    threshold: float, optional
+        minimum estimated jaccard similarity of a verified pair. Default: 0.5
+    max_bucket: int, optional
+        buckets with more documents are skipped.
+        Default: None, metrics.OVERSIZED_BUCKET
+    min_size: int, optional
+        smallest cluster returned. Default: 2, leaves out single documents
+
+    Returns
+    -------
+    list
+        list of Cluster tuples, largest clusters first
+    """
+
+    max_bucket = metrics.OVERSIZED_BUCKET if max_bucket is None else max_bucket
+    no_of_docs = signature_matrix.shape[1]
+    with metrics.stage("clustering", threshold=threshold) as stage:
+        pairs, skipped = lsh.bucket_pairs(buckets_list, max_bucket)
+        if skipped:
+            print(f"Skipped {skipped} buckets with more than {max_bucket} documents")
+            metrics.event("skipped_buckets", count=skipped, max_bucket=max_bucket)
+
+        scores = statistics.pair_similarity(pairs, signature_matrix)
+        verified = scores >= threshold
+        pairs, scores = pairs[verified], scores[verified]
+
+        sets = UnionFind(no_of_docs)
+        for a, b in pairs.tolist():
+            sets.union(a, b)
+
+        # representative: the member with the highest total verified similarity
+        strength = np.bincount(pairs.ravel(), weights=np.repeat(scores, 2), minlength=no_of_docs)
+        clusters = []
+        for members in sets.groups(min_size):
+            representative = members[int(np.argmax(strength[members]))]
+            ranked = statistics.estimate_similarity(representative, members, signature_matrix)
+            clusters.append(Cluster(representative,
+                                    [representative] + [ doc_id for doc_id, score in ranked ],
+                                    [1.0] + [ score for doc_id, score in ranked ]))
+        clusters.sort(key=lambda cluster: len(cluster.members), reverse=True)
+        stage.set(docs=no_of_docs, pairs=len(verified))
+        stage.note(verified_pairs=len(pairs), clusters=len(clusters))
+    return clusters
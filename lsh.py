@@ -1,75 +1,345 @@
 """
 Hash similar documents to same buckets to identify similar documents
+
+This module contains the following:
+    * plan_banding - choose signature length, b and r for a target threshold
+    * band_hash - deterministic 64-bit keys of all bands of all documents
+    * get_bucket_list - hash all documents of a signature matrix into buckets
+    * find_similar_docs - find documents sharing a bucket with given document
+    * query_batch - find candidate documents for many signatures at once
+    * find_similar_docs_batch - find_similar_docs for many doc_ids at once
+    * candidate_pairs - all pairs of documents sharing atleast one bucket
+    * bucket_pairs - candidate_pairs as an array, skipping giant buckets
+    * record_bucket_sizes - record bucket size distribution to metrics
+    * LSHIndex - mutable index to add, remove and query documents one by one
+    * LSHForest - prefix trees over signature rows for top-k queries
+    * BandTable - compact bucket table of a band as sorted arrays
+    * DeltaBandTable - BandTable with documents added and removed since
+"""
+
+from collections import namedtuple
+import numpy as np
+
+import metrics
+import statistics
+from minhashing import GOLDEN, PackedSignatures, mix64
+
+
+_MASK = (1 << 64) - 1
+
+
+BandingPlan = namedtuple("BandingPlan", ["n", "b", "r", "threshold", "false_negative_rate",
+                                         "false_positive_rate", "expected_candidates"])
+BandingPlan.__doc__ = """Banding parameters chosen by plan_banding
+
+n: length of signature (no of hash functions), b*r unless it was fixed
+b: no of bands
+r: no of rows in each band
+threshold: target jaccard similarity, cosine for simhash signatures
+false_negative_rate: average probability to miss a pair above threshold
+false_positive_rate: average probability to pair documents below threshold
+expected_candidates: expected no of candidates per query, or None
 """
 
-def band_hashing(band, hash_f, buckets_dict):
-    """helper-function: To Perform hash on bands
 
-    This function takes a band as input,
-    hashes it and puts it in the buckets_list
-    at its respective postition.
+def collision_probability(s, b, r, bits=None, scheme="minhash"):
+    """This function gives probability of two documents sharing a bucket
+
+    Parameters
+    ----------
+    s: float or numpy.ndarray
+        jaccard similarity of the documents, cosine similarity for simhash
+    b: int
+        no of bands
+    r: int
+        no of rows in each band
+    bits: int, optional
+        no of bits kept of every value for b-bit signatures. Rows then also
+        agree by chance, with probability 1/2^bits. Default: None
+    scheme: str, optional
+        signature scheme. A simhash bit agrees with probability
+        1 - arccos(s)/pi instead of s. Default: "minhash"
+
+    Returns
+    -------
+    float or numpy.ndarray
+        1-(1-p^r)^b, the S-curve of banding for row agreement probability p
+    """
+
+    if scheme == "simhash":
+        s = 1 - np.arccos(np.clip(s, -1, 1)) / np.pi
+    elif bits is not None:
+        chance = 1.0 / (1 << bits)
+        s = chance + (1 - chance) * np.asarray(s)
+    return 1 - (1 - np.power(s, r))**b
+
+
+def _error_rates(threshold, b, r, bits=None, scheme="minhash", points=256):
+    """helper-function: average false negative and false positive rates
+
+    false negatives are averaged over similarities in [threshold, 1] and
+    false positives over [0, threshold], assuming uniform similarities.
     """
 
-    for col in band.columns:
-        h = hash_f(tuple(band[col].values))
-        if h in buckets_dict: 
-            buckets_dict[h].append(col)
-        else: 
-            buckets_dict[h] = [col]
+    above = np.linspace(threshold, 1, points)
+    below = np.linspace(0, threshold, points)
+    false_negative = np.mean(1 - collision_probability(above, b, r, bits, scheme))
+    false_positive = np.mean(collision_probability(below, b, r, bits, scheme))
+    return float(false_negative), float(false_positive)
 
 
-def get_bucket_list(sign_mat, r, hash_f=None):
-    """This function returns the list of buckets with similar documents
+def expected_candidates(b, r, no_of_docs, similarities, bits=None, scheme="minhash"):
+    """This function estimates the no of candidates returned for a query
 
-    This function generates the list of dictionaries objects where
-    each each band is hashed to a bucket in a dictionary.
-    
     Parameters
     ----------
-    sign_mat: pandas.Dataframe
-        signatures of all the dacuments generated from minhashing
+    b: int
+        no of bands
     r: int
         no of rows in each band
+    no_of_docs: int
+        no of documents in the index
+    similarities: numpy.ndarray
+        sample of jaccard similarities between pairs of documents, see
+        sample_similarities. Cosine similarities for simhash
+    bits: int, optional
+        bits kept of every value for b-bit signatures, see
+        collision_probability. Default: None
+    scheme: str, optional
+        signature scheme, see collision_probability. Default: "minhash"
+
+    Returns
+    -------
+    float
+        expected no of candidate documents per query. The total no of
+        candidate pairs of the corpus is about no_of_docs/2 times this.
+    """
+
+    probability = np.mean(collision_probability(np.asarray(similarities, dtype=np.float64), b, r, bits, scheme))
+    return float((no_of_docs - 1) * probability)
+
+
+def sample_similarities(sign_mat, sample_size=10000, seed=0):
+    """This function estimates similarities of random pairs of documents
+
+    jaccard similarity of each sampled pair is estimated as the fraction of
+    equal rows of their signatures, see statistics.pair_similarity.
+
+    Parameters
+    ----------
+    sign_mat: numpy.ndarray or minhashing.PackedSignatures
+        signatures of documents as columns
+    sample_size: int, optional
+        no of pairs to sample. Default: 10000
+    seed: int, optional
+        seed of the random generator. Default: 0
+
+    Returns
+    -------
+    numpy.ndarray
+        estimated similarity of every sampled pair
+    """
+
+    cols = sign_mat.shape[1]
+    if cols < 2:
+        return np.zeros(0)
+    rng = np.random.default_rng(seed)
+    x = rng.integers(0, cols, size=sample_size)
+    a = (x + rng.integers(1, cols, size=sample_size)) % cols   # never equal to x
+    return statistics.pair_similarity(np.stack([x, a], axis=1), sign_mat)
+
+
+def plan_banding(threshold, max_false_negative=0.1, max_false_positive=0.1,
+                 max_hash_functions=None, no_of_docs=None, similarities=None, bits=None,
+                 scheme="minhash", n=None, r=None):
+    """This function chooses banding parameters for a target similarity
+
+    All (b, r) with b*r <= max_hash_functions are scored using the S-curve
+    1-(1-s^r)^b. The shortest signature meeting both error rates is chosen,
+    breaking ties by the smaller total error. If no combination meets them,
+    the one with the smallest total error is chosen.
+
+    If n is given, only r is searched and the signature is split into n//r
+    bands. If r is given, only b is searched. If both are given, the plan
+    just reports their error rates.
+
+    Parameters
+    ----------
+    threshold: float
+        target jaccard similarity above which documents should be candidates
+    max_false_negative: float, optional
+        acceptable average probability of missing a pair above threshold.
+        Default: 0.1
+    max_false_positive: float, optional
+        acceptable average probability of pairing documents below threshold.
+        Default: 0.1
+    max_hash_functions: int, optional
+        upper limit on the signature length. Default: 256, or 1024 bits for
+        simhash signatures
+    no_of_docs: int, optional
+        no of documents to be indexed, to report expected_candidates
+    similarities: numpy.ndarray, optional
+        sample of pairwise similarities of the corpus, see sample_similarities.
+        Used with no_of_docs to report expected_candidates
+    bits: int, optional
+        plan for b-bit signatures keeping this many bits of every value,
+        which need more rows per band. Default: None
+    scheme: str, optional
+        signature scheme, see collision_probability. Simhash bits agree
+        more often by chance, so they need many more rows.
+        Default: "minhash"
+    n: int, optional
+        fixed signature length. Default: None, planned
+    r: int, optional
+        fixed no of rows in each band. Default: None, planned
+
+    Returns
+    -------
+    BandingPlan
+        chosen parameters and their expected error rates
+    """
+
+    if not 0 < threshold < 1:
+        raise Exception(f"threshold must be between 0 and 1, given: {threshold}")
+    if max_hash_functions is None:
+        max_hash_functions = 1024 if scheme == "simhash" else 256
+    if n is not None and r is not None and r > n:
+        raise Exception(f"r={r} rows do not fit in a signature of length {n}")
+    if n is not None:
+        max_hash_functions = n
+    elif r is not None:
+        max_hash_functions = max(max_hash_functions, r)
+
+    best, best_key = None, None
+    for rows in ([r] if r is not None else range(1, max_hash_functions+1)):
+        bands = [n // rows] if n is not None else range(1, max_hash_functions//rows + 1)
+        for b in bands:
+            false_negative, false_positive = _error_rates(threshold, b, rows, bits, scheme)
+            feasible = false_negative <= max_false_negative and false_positive <= max_false_positive
+            # feasible plans first, then shortest signature, then least error
+            if feasible:
+                key = (0, b*rows, false_negative + false_positive)
+            else:
+                key = (1, false_negative + false_positive, b*rows)
+            if best_key is None or key < best_key:
+                best, best_key = (b, rows, false_negative, false_positive), key
+
+    b, r, false_negative, false_positive = best
+    candidates = None
+    if no_of_docs is not None and similarities is not None:
+        candidates = expected_candidates(b, r, no_of_docs, similarities, bits, scheme)
+    return BandingPlan(n if n is not None else b*r, b, r, threshold, false_negative, false_positive, candidates)
+
+
+def band_hash(sign_mat, r, hash_f=None):
+    """This function computes the bucket key of every band of every document
+
+    By default the r rows of a band are mixed into a 64-bit key using
+    vectorized operations over all the documents, so keys are the same
+    across processes and runs.
+
+    Parameters
+    ----------
+    sign_mat: numpy.ndarray or minhashing.PackedSignatures
+        signatures of documents as columns. b-bit signatures are unpacked
+        one band at a time
+    r: int or BandingPlan
+        no of rows in each band, or a plan from plan_banding
     hash_f: function, optional
-        hash function used to hash document to buckets
+        custom hash function, called on the tuple of values of each band
 
     Returns
     -------
-    buckets_list: a list of dictionaries. Each dictionary 
-        contains hashes of column vectors of the band as keys 
-        and the list of documents as values.
+    numpy.ndarray
+        uint64 array of shape (no of bands, no of documents)
     """
 
     # b: number of bands
     # n: length of a document signature
     # r: number of rows in a band
-    n = sign_mat.shape[0]
-    b = n//r
-    buckets_list = [dict() for i in range(b)]
+    n, cols = sign_mat.shape
+    if isinstance(r, BandingPlan):
+        if n < r.n:
+            raise Exception(f"Signature of length {n} is shorter than planned length {r.n}")
+        b, r = r.b, r.r
+    else:
+        b = n//r
+
+    if isinstance(sign_mat, PackedSignatures):
+        keys = np.empty((b, cols), dtype=np.uint64)
+        for band in range(b):
+            keys[band] = band_hash(sign_mat.rows(band*r, (band+1)*r), r, hash_f)[0]
+        return keys
+
+    bands = np.asarray(sign_mat[:b*r]).astype(np.uint64).reshape(b, r, cols)
+
+    if hash_f is not None:
+        keys = [ [ hash_f(tuple(band[:, col].tolist())) & _MASK for col in range(cols) ]
+                 for band in bands ]
+        return np.array(keys, dtype=np.uint64).reshape(b, cols)
+
+    keys = np.full((b, cols), r, dtype=np.uint64)
+    with np.errstate(over='ignore'):
+        for k in range(r):
+            keys = mix64(keys ^ (bands[:, k, :] + GOLDEN))
+    return keys
+
+
+def get_bucket_list(sign_mat, r, hash_f=None):
+    """This function returns the list of buckets with similar documents
 
-    if hash_f==None:
-        hash_f = hash
+    This function hashes every band of all documents at once and stores
+    the buckets of each band as a BandTable.
+    
+    Parameters
+    ----------
+    sign_mat: numpy.ndarray
+        signatures of all the dacuments generated from minhashing
+    r: int or BandingPlan
+        no of rows in each band, or a plan from plan_banding
+    hash_f: function, optional
+        hash function used to hash document to buckets
 
-    for i in range(0, n-r+1, r):
-        band = sign_mat.loc[i:i+r-1,:]
-        band_hashing(band, hash_f, buckets_list[int(i/r)])
+    Returns
+    -------
+    buckets_list: a list of BandTable objects. Each table 
+        contains keys of column vectors of the band 
+        and the documents in those buckets.
+    """
 
+    with metrics.stage("lsh") as stage:
+        keys = band_hash(sign_mat, r, hash_f)
+        buckets_list = [ BandTable.from_keys(band_keys) for band_keys in keys ]
+        stage.set(docs=keys.shape[1])
+    if metrics.enabled():
+        record_bucket_sizes(buckets_list)
     return buckets_list
 
 
-def query_band_hashing(band, hash_f):
-    """helper-function: To Perform hash on query doc bands
+def record_bucket_sizes(buckets_list):
+    """This function records the bucket size distribution of every band
+
+    Buckets larger than metrics.OVERSIZED_BUCKET are reported as oversized
+    events, since every document in them is a candidate of all the others.
 
-    This function takes a band of query document as input,
-    hashes it and puts it in the buckets_list
-    at its respective postition.
+    Parameters
+    ----------
+    buckets_list: list
+        list of bucket tables generated by get_bucket_list
     """
 
-    hash_list = []
-    h = hash_f(tuple(band.values))
-    hash_list.append(h)
-    
-    return hash_list
+    for band, table in enumerate(buckets_list):
+        sizes = table.bucket_sizes()
+        metrics.observe_many("bucket_size", sizes, band=band)
+        for bucket in np.flatnonzero(sizes > metrics.OVERSIZED_BUCKET).tolist():
+            metrics.event("oversized_bucket", band=band, size=int(sizes[bucket]))
+
+
+def _columns(sign_mat, doc_ids):
+    """helper-function: signatures of given doc_ids"""
+    if isinstance(sign_mat, PackedSignatures):
+        return sign_mat.select(doc_ids)
+    return np.asarray(sign_mat)[:, doc_ids]
 
 
 def find_similar_docs(doc_id, buckets_list, sign_mat, r, hash_f=None):
@@ -78,7 +348,7 @@ def find_similar_docs(doc_id, buckets_list, sign_mat, r, hash_f=None):
     Parameters
     ----------
     buckets_list: list
-        list of dictionary objects generated by get_bucket_list
+        list of bucket tables generated by get_bucket_list
     hash_f: function, optional
         the same hash function used for get_bucket_list
     
@@ -88,31 +358,606 @@ def find_similar_docs(doc_id, buckets_list, sign_mat, r, hash_f=None):
         set containing similar documents to given document
     """
     
-    # b: number of bands
-    # n: length of a document signature
-    # r: number of rows in a band
-    n = sign_mat.shape[0]
-    b = n//r
+    return query_batch(_columns(sign_mat, [int(doc_id)]), buckets_list, r, hash_f)[0]
 
-    if hash_f==None:
-        hash_f = hash
-    
-    query_bucket_list = []
 
-    for i in range(0, n-r+1, r):
-        band = sign_mat.loc[i:i+r-1, int(doc_id)]
-        query_bucket_list.append(query_band_hashing(band, hash_f))
-    
-    similar_docs = set()
-    for i in range(len(query_bucket_list)):
-        for j in range(len(query_bucket_list[i])):
-            similar_docs.update(set(buckets_list[i][query_bucket_list[i][j]]))
+def query_batch(signatures, buckets_list, r, hash_f=None):
+    """This function finds candidate similar documents for many signatures
+
+    the bands of all the query signatures are hashed at once.
+
+    Parameters
+    ----------
+    signatures: numpy.ndarray or minhashing.PackedSignatures
+        query signatures as columns, shape (n, no_of_queries)
+    buckets_list: list
+        list of bucket tables generated by get_bucket_list
+    r: int or BandingPlan
+        same r used for get_bucket_list
+    hash_f: function, optional
+        the same hash function used for get_bucket_list
+
+    Returns
+    -------
+    list
+        list of sets, candidate documents of each query signature
+    """
+
+    q = signatures.shape[1]
+    with metrics.latency("query_batch_seconds", queries=q):
+        keys = band_hash(signatures, r, hash_f)
+
+        similar_docs = [set() for j in range(q)]
+        for buckets_dict, band_keys in zip(buckets_list, keys):
+            for j, h in enumerate(band_keys.tolist()):
+                similar_docs[j].update(buckets_dict.get(h, ()))
 
+    if metrics.enabled():
+        metrics.observe_many("candidates_per_query", [ len(docs) for docs in similar_docs ])
     return similar_docs
 
 
+def find_similar_docs_batch(doc_ids, buckets_list, sign_mat, r, hash_f=None):
+    """This function finds similar documents for many documents at once
+
+    Parameters
+    ----------
+    doc_ids: list
+        list of doc_ids to query
+    buckets_list: list
+        list of bucket tables generated by get_bucket_list
+    sign_mat: numpy.ndarray
+        signatures of all the documents generated from minhashing
+    r: int or BandingPlan
+        same r used for get_bucket_list
+    hash_f: function, optional
+        the same hash function used for get_bucket_list
+
+    Returns
+    -------
+    dict
+        maps every given doc_id to the set of its candidate documents
+    """
+
+    doc_ids = [ int(doc_id) for doc_id in doc_ids ]
+    signatures = _columns(sign_mat, doc_ids)
+    return dict(zip(doc_ids, query_batch(signatures, buckets_list, r, hash_f)))
+
+
+def candidate_pairs(buckets_list):
+    """This function finds all pairs of documents which share a bucket
+
+    Pairs are read straight from the bucket tables, and a pair colliding in
+    several bands is reported only once.
+
+    Parameters
+    ----------
+    buckets_list: list
+        list of bucket tables generated by get_bucket_list
+
+    Returns
+    -------
+    set
+        set of (doc_id, doc_id) tuples, with the smaller doc_id first
+    """
+
+    pairs = set()
+    for buckets_dict in buckets_list:
+        for bucket in buckets_dict.values():
+            if len(bucket) < 2:
+                continue
+            bucket = sorted(bucket)
+            for i in range(len(bucket)):
+                for j in range(i+1, len(bucket)):
+                    pairs.add((bucket[i], bucket[j]))
+    return pairs
+
+
+def bucket_pairs(buckets_list, max_bucket=None):
+    """This function lists all pairs of documents sharing a bucket as an array
+
+    vectorized counterpart of candidate_pairs. Pairs at distance d within
+    the buckets of a table are generated for all buckets at once, for d =
+    1, 2, ... up to the size of the largest bucket.
+
+    Parameters
+    ----------
+    buckets_list: list
+        list of bucket tables generated by get_bucket_list
+    max_bucket: int, optional
+        buckets with more documents than this are skipped, as they would
+        give max_bucket^2/2 pairs each. Default: None, keep all buckets
+
+    Returns
+    -------
+    tuple
+        (pairs, skipped) where pairs is an int64 array of shape
+        (no_of_pairs, 2) without duplicates and with the smaller doc_id
+        first, and skipped is the no of buckets left out
+    """
+
+    codes = []
+    skipped = 0
+    for table in buckets_list:
+        if not isinstance(table, BandTable):
+            table = BandTable.from_dict(table)
+        bounds = np.asarray(table._bounds(), dtype=np.int64)
+        sizes = np.diff(bounds)
+        keep = sizes >= 2
+        if max_bucket is not None:
+            skipped += int(np.sum(sizes > max_bucket))
+            keep &= sizes <= max_bucket
+        if not keep.any():
+            continue
+        starts, sizes = bounds[:-1][keep], sizes[keep]
+        # every position inside the kept buckets, and the end of its bucket
+        offsets = np.cumsum(sizes) - sizes
+        positions = np.arange(int(sizes.sum())) - np.repeat(offsets - starts, sizes)
+        ends = np.repeat(starts + sizes, sizes)
+        docs = np.asarray(table.docs).astype(np.int64)
+        for d in range(1, int(sizes.max())):
+            valid = positions + d < ends
+            positions, ends = positions[valid], ends[valid]
+            a, b = docs[positions], docs[positions + d]
+            codes.append((np.minimum(a, b) << 32) | np.maximum(a, b))
+
+    codes = np.unique(np.concatenate(codes)) if codes else np.zeros(0, dtype=np.int64)
+    return np.stack([codes >> 32, codes & 0xffffffff], axis=1), skipped
+
+
+class LSHIndex:
+    """Mutable LSH index supporting incremental add/remove of documents
+
+    Each band keeps a dictionary of bucket key to set of doc_ids, and the
+    band keys of every indexed document are remembered, so adding or
+    removing a document only touches b buckets.
+
+    Parameters
+    ----------
+    r: int or BandingPlan
+        no of rows in each band, or a plan from plan_banding
+    hash_f: function, optional
+        hash function used to hash bands of documents to buckets
+    """
+
+    def __init__(self, r, hash_f=None):
+        self.r = r
+        self.hash_f = hash_f
+        self.n = None               # length of a document signature
+        self.buckets_list = []      # one dictionary per band
+        self.doc_keys = dict()      # doc_id -> list of band keys
+
+    @classmethod
+    def from_signature_matrix(cls, sign_mat, r, hash_f=None):
+        """builds an index containing all columns of sign_mat as doc_ids
+        """
+        index = cls(r, hash_f)
+        for doc_id in range(sign_mat.shape[1]):
+            index.add(doc_id, sign_mat[:, doc_id])
+        return index
+
+    def __len__(self):
+        return len(self.doc_keys)
+
+    def __contains__(self, doc_id):
+        return doc_id in self.doc_keys
+
+    def band_keys(self, signature):
+        """returns the bucket key of every band of given signature
+        """
+        if self.n is None:
+            self.n = len(signature)
+        elif len(signature) != self.n:
+            raise Exception(f"Signature of length {len(signature)} does not match index length {self.n}")
+
+        signature = np.asarray(signature)
+        keys = band_hash(signature[:, None], self.r, self.hash_f)[:, 0].tolist()
+        if not self.buckets_list:
+            self.buckets_list = [dict() for i in range(len(keys))]
+        return keys
+
+    def add(self, doc_id, signature):
+        """adds (or replaces) document doc_id with given signature
+
+        Parameters
+        ----------
+        doc_id: int
+            id of the document
+        signature: numpy.ndarray
+            minhash signature of the document
+        """
+        if doc_id in self.doc_keys:
+            self.remove(doc_id)
+        keys = self.band_keys(signature)
+        for buckets_dict, h in zip(self.buckets_list, keys):
+            if h in buckets_dict:
+                buckets_dict[h].add(doc_id)
+            else:
+                buckets_dict[h] = {doc_id}
+        self.doc_keys[doc_id] = keys
+
+    def remove(self, doc_id):
+        """removes document doc_id from all band tables
+
+        Raises
+        ------
+        KeyError
+            if doc_id is not present in the index
+        """
+        keys = self.doc_keys.pop(doc_id)
+        for buckets_dict, h in zip(self.buckets_list, keys):
+            bucket = buckets_dict[h]
+            bucket.discard(doc_id)
+            if not bucket:
+                del buckets_dict[h]
+
+    def query(self, signature):
+        """finds documents sharing atleast one bucket with given signature
+
+        Parameters
+        ----------
+        signature: numpy.ndarray
+            minhash signature of the query document
+
+        Returns
+        -------
+        set
+            set containing doc_ids of candidate similar documents
+        """
+        similar_docs = set()
+        if self.n is None:
+            return similar_docs
+        for buckets_dict, h in zip(self.buckets_list, self.band_keys(signature)):
+            similar_docs.update(buckets_dict.get(h, ()))
+        return similar_docs
+
+    def query_batch(self, signatures):
+        """query for many signatures given as columns of a matrix
+
+        Returns
+        -------
+        list
+            list of sets, candidate documents of each query signature
+        """
+        if self.n is None:
+            return [set() for j in range(signatures.shape[1])]
+        if signatures.shape[0] != self.n:
+            raise Exception(f"Signature of length {signatures.shape[0]} does not match index length {self.n}")
+        return query_batch(signatures, self.buckets_list, self.r, self.hash_f)
+
+    def candidate_pairs(self):
+        """returns all pairs of indexed documents sharing atleast one bucket
+        """
+        return candidate_pairs(self.buckets_list)
+
+
+class LSHForest:
+    """LSH Forest over a signature matrix for top-k queries
+
+    Every tree indexes the documents by a sequence of depth signature rows.
+    The columns are sorted lexicographically, so documents which share the
+    first d values with a query form a contiguous range that can be found
+    by binary search, for every d. A query descends all trees together from
+    the longest matching prefix to shorter ones until enough candidates are
+    found. No threshold or r has to be chosen in advance, and a few trees
+    replace many bands.
+
+    For b-bit signatures the prefix of a document in a tree is packed into
+    a single integer key, value after value from the highest bits down, so
+    documents sharing d values form a range of keys. A tree then takes as
+    much memory as its doc_ids, instead of depth unpacked values per doc.
+
+    Parameters
+    ----------
+    rows: numpy.ndarray
+        signature rows used by every tree, shape (no_of_trees, depth)
+    values: list
+        sorted values of every tree, arrays of shape (depth, no_of_docs) in
+        the dtype of the signatures. For b-bit signatures, sorted prefix
+        keys of shape (no_of_docs,)
+    docs: list
+        doc_id of every column of values, one uint32 array per tree
+    bits: int, optional
+        no of bits of every value if values are prefix keys. Default: None
+    """
+
+    def __init__(self, rows, values, docs, bits=None):
+        self.rows = rows
+        self.values = values
+        self.docs = docs
+        self.bits = bits
+
+    @classmethod
+    def from_signature_matrix(cls, sign_mat, no_of_trees=8, depth=None, seed=0, doc_ids=None):
+        """builds a forest over the columns of sign_mat
+
+        Parameters
+        ----------
+        sign_mat: numpy.ndarray or minhashing.PackedSignatures
+            signatures of documents as columns
+        no_of_trees: int, optional
+            no of prefix trees. Default: 8
+        depth: int, optional
+            length of the prefixes. Default: signature length / no_of_trees,
+            so the trees use disjoint rows. For b-bit signatures atmost 64/b,
+            so that a prefix fits a 64-bit key
+        seed: int, optional
+            seed to assign signature rows to trees. Default: 0
+        doc_ids: numpy.ndarray, optional
+            columns to index, e.g. without deleted documents. Default: None,
+            all columns
+        """
+        if doc_ids is not None:
+            doc_ids = np.asarray(doc_ids, dtype=np.int64)
+            sign_mat = _columns(sign_mat, doc_ids)
+        n = sign_mat.shape[0]
+        packed = isinstance(sign_mat, PackedSignatures)
+        if depth is None:
+            depth = max(1, n // no_of_trees)
+        if packed:
+            depth = min(depth, 64 // sign_mat.bits)
+        else:
+            sign_mat = np.asarray(sign_mat)
+        permutation = np.random.default_rng(seed).permutation(n)
+        rows = permutation[(np.arange(no_of_trees)[:, None] * depth + np.arange(depth)) % n]
+        values, docs = [], []
+        for tree_rows in rows:
+            if packed:
+                tree_values = _prefix_keys(sign_mat, tree_rows)
+                order = np.argsort(tree_values, kind='stable')
+                values.append(tree_values[order])
+            else:
+                tree_values = sign_mat[tree_rows]
+                # lexsort sorts by the last key first
+                order = np.lexsort(tree_values[::-1])
+                values.append(tree_values[:, order])
+            docs.append((order if doc_ids is None else doc_ids[order]).astype(np.uint32))
+        return cls(rows, values, docs, sign_mat.bits if packed else None)
+
+    def __len__(self):
+        return len(self.docs[0]) if self.docs else 0
+
+    def _prefix_ranges(self, tree, query):
+        """helper-function: ranges of documents sharing each prefix length
+
+        element d is the (lo, hi) range of docs sharing the first d values.
+        """
+        if self.bits is not None:
+            return self._key_ranges(tree, query)
+        values = self.values[tree]
+        lo, hi = 0, values.shape[1]
+        ranges = [(lo, hi)]
+        for j in range(values.shape[0]):
+            column = values[j, lo:hi]
+            start = lo + int(np.searchsorted(column, query[j], side='left'))
+            stop = lo + int(np.searchsorted(column, query[j], side='right'))
+            if start == stop:
+                break
+            lo, hi = start, stop
+            ranges.append((lo, hi))
+        return ranges
+
+    def _key_ranges(self, tree, query):
+        """helper-function: _prefix_ranges over the prefix keys of a tree"""
+        keys = self.values[tree]
+        depth = len(query)
+        key = int(_prefix_keys(np.asarray(query, dtype=np.uint64)[:, None], np.arange(depth), self.bits)[0])
+        ranges = [(0, len(keys))]
+        for d in range(1, depth+1):
+            # keys sharing the first d values with the query
+            shift = (depth - d) * self.bits
+            low = (key >> shift) << shift
+            start = int(np.searchsorted(keys, np.uint64(low), side='left'))
+            stop = int(np.searchsorted(keys, np.uint64(low + (1 << shift) - 1), side='right'))
+            if start == stop:
+                break
+            ranges.append((start, stop))
+        return ranges
+
+    def query(self, signature, m):
+        """This function finds the documents sharing the longest prefixes
+
+        Parameters
+        ----------
+        signature: numpy.ndarray
+            signature of the query, unpacked for b-bit signatures
+        m: int
+            no of candidates wanted. Shorter prefixes are used until atleast
+            m documents are found, or all of them
+
+        Returns
+        -------
+        set
+            candidate doc_ids
+        """
+        signature = np.asarray(signature)
+        ranges = [ self._prefix_ranges(tree, signature[rows]) for tree, rows in enumerate(self.rows) ]
+        depth = max(len(tree_ranges) for tree_ranges in ranges) - 1
+        while True:
+            candidates = set()
+            for tree, tree_ranges in enumerate(ranges):
+                if len(tree_ranges) > depth:
+                    lo, hi = tree_ranges[depth]
+                    candidates.update(self.docs[tree][lo:hi].tolist())
+            if len(candidates) >= m or depth == 0:
+                return candidates
+            depth -= 1
+
+    def query_batch(self, signatures, m):
+        """query for every column of signatures, returns a list of sets
+        """
+        signatures = np.asarray(signatures)
+        return [ self.query(signatures[:, j], m) for j in range(signatures.shape[1]) ]
+
+
+def _prefix_keys(sign_mat, rows, bits=None):
+    """helper-function: values of given rows of b-bit signatures packed
+    into one integer key per document, the first row in the highest bits
+
+    sign_mat is PackedSignatures, or an array of values of bits bits.
+    """
+    bits = sign_mat.bits if bits is None else bits
+    keys = np.zeros(sign_mat.shape[1], dtype=np.uint64)
+    for row in rows:
+        if isinstance(sign_mat, PackedSignatures):
+            values = sign_mat.rows(int(row), int(row)+1)[0]
+        else:
+            values = sign_mat[row]
+        keys = (keys << np.uint64(bits)) | values
+    return keys.astype(np.uint32) if len(rows) * bits <= 32 else keys
+
+
+class BandTable:
+    """Bucket table of a single band stored as sorted arrays
+
+    keys holds the bucket key of every document in sorted order and docs
+    the doc_id at the same position, so the documents of a bucket are a
+    contiguous slice found by binary search. The table takes 12 bytes per
+    document and can be used in place of a bucket dictionary.
+
+    Parameters
+    ----------
+    keys: numpy.ndarray
+        sorted uint64 array of bucket keys, one per document
+    docs: numpy.ndarray
+        uint32 array of doc_ids aligned with keys
+    """
+
+    def __init__(self, keys, docs):
+        self.keys = keys
+        self.docs = docs
+
+    @classmethod
+    def from_keys(cls, band_keys, doc_ids=None):
+        """builds a table from the band keys of documents
+
+        Parameters
+        ----------
+        band_keys: numpy.ndarray
+            uint64 bucket key of every document, as computed by band_hash
+        doc_ids: numpy.ndarray, optional
+            doc_id of every key. Default: position of the key
+        """
+        order = np.argsort(band_keys, kind='stable')
+        if doc_ids is None:
+            docs = order
+        else:
+            docs = np.asarray(doc_ids)[order]
+        return cls(np.asarray(band_keys, dtype=np.uint64)[order], docs.astype(np.uint32))
+
+    @classmethod
+    def from_dict(cls, buckets_dict):
+        """builds a table from a dictionary of bucket key to doc_ids
+        """
+        band_keys = [ h & _MASK for h, bucket in buckets_dict.items() for doc in bucket ]
+        doc_ids = [ doc for h, bucket in buckets_dict.items() for doc in bucket ]
+        return cls.from_keys(np.array(band_keys, dtype=np.uint64), np.array(doc_ids, dtype=np.int64))
+
+    def _span(self, key):
+        lo = int(np.searchsorted(self.keys, key, side='left'))
+        hi = int(np.searchsorted(self.keys, key, side='right'))
+        return lo, hi
+
+    def _bounds(self):
+        """helper-function: start of every bucket, followed by len(keys)"""
+        starts = np.flatnonzero(self.keys[1:] != self.keys[:-1]) + 1
+        return [0] + starts.tolist() + [len(self.keys)] if len(self.keys) else [0]
+
+    def __len__(self):
+        return len(self._bounds()) - 1
+
+    def bucket_sizes(self):
+        """returns the no of documents in every bucket"""
+        return np.diff(self._bounds())
+
+    def __contains__(self, key):
+        lo, hi = self._span(key)
+        return hi > lo
+
+    def __getitem__(self, key):
+        lo, hi = self._span(key)
+        if hi == lo:
+            raise KeyError(key)
+        return self.docs[lo:hi].tolist()
+
+    def get(self, key, default=None):
+        lo, hi = self._span(key)
+        if hi == lo:
+            return default
+        return self.docs[lo:hi].tolist()
+
+    def values(self):
+        """iterates over the doc_id lists of all buckets
+        """
+        bounds = self._bounds()
+        for i in range(len(bounds)-1):
+            yield self.docs[bounds[i]:bounds[i+1]].tolist()
+
+
+class DeltaBandTable(BandTable):
+    """Bucket table of a band with changes not merged into it yet
+
+    Documents added since base was built are kept in a small table of their
+    own, and the entries of documents removed since are skipped when base
+    is read. Lookups read both tables. keys and docs merge them into a
+    single sorted table on first use, for the methods which go over the
+    whole table.
+
+    Parameters
+    ----------
+    base: BandTable
+        table the changes apply to
+    delta: BandTable
+        table of the documents added since
+    removed: set
+        doc_ids whose entries in base are no longer valid
+    """
+
+    def __init__(self, base, delta, removed):
+        self.base = base
+        self.delta = delta
+        self.removed = removed
+        self._merged = None
+
+    def compact(self):
+        """returns base and delta merged into one BandTable"""
+        if self._merged is None:
+            docs = np.asarray(self.base.docs)
+            keep = ~np.isin(docs, np.fromiter(self.removed, dtype=np.int64, count=len(self.removed)))
+            keys = np.asarray(self.base.keys)[keep]
+            # entries of delta go after those of base with the same key
+            positions = np.searchsorted(keys, np.asarray(self.delta.keys), side='right')
+            self._merged = BandTable(np.insert(keys, positions, np.asarray(self.delta.keys)),
+                                     np.insert(docs[keep], positions, np.asarray(self.delta.docs)))
+        return self._merged
+
+    @property
+    def keys(self):
+        return self.compact().keys
+
+    @property
+    def docs(self):
+        return self.compact().docs
+
+    def get(self, key, default=None):
+        docs = [ doc for doc in self.base.get(key, ()) if doc not in self.removed ] + self.delta.get(key, [])
+        return docs if docs else default
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __getitem__(self, key):
+        docs = self.get(key)
+        if docs is None:
+            raise KeyError(key)
+        return docs
+
+
 if __name__=='__main__':
-    from minhashing import minhash
-    from shingling import main
-    data = main()
-    sign_mat = minhash(data)
+    from minhashing import generate_signature_matrix
+    from shingling import get_shingle_matrix
+    incidence_matrix, files = get_shingle_matrix("corpus")
+    sign_mat = generate_signature_matrix(incidence_matrix, 100)
+    buckets_list = get_bucket_list(sign_mat, 5)
+    pairs, skipped = bucket_pairs(buckets_list)
+    print(f"{len(pairs)} candidate pairs of {len(files)} documents")
@@ -11,41 +11,337 @@ Process:
     - lsh: dividing signature matrix into horizontal bands and applying hash
         functions on them to determing which documents fall in same bucket
 
-NOTE: if pickle(binary) files exist for each operation, they will be used 
-    instead of generating them again(to save time). rename or delete the file
-    to start afresh.
+NOTE: the generated index is saved to the {folderpath}.index directory and 
+    reused on the next run as long as the parameters are unchanged. Only the
+    files added or modified since are shingled and minhashed again.
+    delete the directory to start afresh.
+
+set the LSH_METRICS environment variable to a file path to log metrics of
+every stage and query to it as JSON lines, see metrics.py
 """
 
-import time, os
+import time, os, sys
+import clustering
 import shingling
 import minhashing
 import lsh
+import metrics
 import statistics
+import storage
 
-def startLSH():
-    print("\n*** Plagiarism detection using LSH ***\n")
+def get_index(folderpath="corpus", extension=".txt", shingle_size=4, parallel=None,
+              no_of_hash_functions=None, seed=0, r=None, lsh_threshold=0.5, hash_bits=None,
+              scheme="minhash", signature_bits=None, stream=False, index_path=None):
+    """Builds the LSH index of the corpus, or loads the saved one if up to date
+
+    Parameters
+    ----------
+    folderpath: str
+        path to corpus
+    extension: str, optional
+        specified extensions to read. Set to None to ignore extension
+    shingle_size: int, optional
+        size of shingle: 8-12 is reommended
+    parallel: int, optional
+        no of processes to shingle and minhash with. Set to None to run serially
+    no_of_hash_functions: int, optional
+        no of hash functions for signature matrix. Planned from lsh_threshold if None,
+        else only r is planned for it
+    seed: int, optional
+        seed to generate the hash functions
+    r: int, optional
+        no of rows in a band. Planned from lsh_threshold if None, else only the
+        no of bands is planned for it
+    lsh_threshold: float, optional
+        target jaccard similarity of documents to be reported as candidates
+    hash_bits: int, optional
+        use 32 or 64-bit shingle fingerprints instead of a shingle vocabulary
+    scheme: str, optional
+        signature scheme, "minhash", "oph" (one permutation hashing) or
+        "simhash", which targets cosine similarity: lsh_threshold is then a
+        cosine similarity and cosine is estimated from the signatures
+    signature_bits: int, optional
+        keep only this many bits of every signature value (b-bit minhash),
+        packed to save memory. The bands are planned for it
+    stream: bool, optional
+        stream documents in chunks straight into minhashing instead of
+        building the incidence matrix, so memory use does not depend on the
+        size of documents. Shingles are fingerprints (32-bit unless
+        hash_bits is given) and only estimated similarity is available
+    index_path: str, optional
+        directory the index is saved to. Default: {folderpath}.index
+
+    Returns
+    -------
+    storage.StoredIndex
+        index of the corpus
+    """
+
+    plan = lsh.plan_banding(lsh_threshold, bits=signature_bits, scheme=scheme, n=no_of_hash_functions, r=r)
+    print(f"Banding plan for threshold {lsh_threshold}: {plan}")
+    no_of_hash_functions, r = plan.n, plan.r
+
+    if stream and hash_bits is None:
+        hash_bits = 32
+    if scheme == "simhash" and signature_bits is not None:
+        raise Exception("simhash signatures are already single bits, signature_bits can not be set")
 
-    # step 1: shingling
-    timer_start = time.time()   # start timer
-    folderpath = "corpus"       # path to corpus
-    extension=".txt"            # specified extensions to read. Set to None to ignore extension
-    shingle_size = 4            # size of shingle: 8-12 is reommended
-    shingle_matrix, files = shingling.get_shingle_matrix(folderpath, shingle_size, extension)
-    print(shingle_matrix.shape)
-    print(f"Time taken for shingling: {time.time()-timer_start}")
+    index_path = index_path if index_path is not None else f"{folderpath}.index"
+    params = { "shingle_size": shingle_size, "extension": extension,
+               "no_of_hash_functions": no_of_hash_functions, "seed": seed, "r": r,
+               "hash_bits": hash_bits, "scheme": scheme,
+               "signature_bits": signature_bits, "stream": stream }
 
-    # step 2: min-hashing
+    # step 0: reuse the saved index, updating the documents which changed
     start_time = time.time()    # start timer
-    no_of_hash_functions = 50   # specify no of hash functions for signature matrix
-    signature_matrix = minhashing.generate_signature_matrix(shingle_matrix, no_of_hash_functions)
+    index = storage.load_index(index_path)
+    if index is not None:
+        reason = storage.is_stale(index.manifest, params)
+        if reason is None:
+            index = storage.update_index(index, shingling.list_files(folderpath, extension))
+            print(f"Time taken for loading index: {time.time()-start_time}")
+            return index
+        print(f"Index {index_path} is stale: {reason}")
+
+    if stream:
+        # steps 1 and 2: shingle and minhash every document chunk by chunk
+        start_time = time.time()    # start timer
+        shingle_matrix, files = None, []
+
+        def documents():
+            for f, chunks in shingling.iter_documents(folderpath, shingle_size, extension, hash_bits):
+                files.append(f)
+                yield chunks
+
+        signature_matrix = minhashing.stream_signature_matrix(documents(), no_of_hash_functions, seed, scheme)
+    else:
+        # step 1: shingling
+        timer_start = time.time()   # start timer
+        shingle_matrix, files = shingling.get_shingle_matrix(folderpath, shingle_size, extension, parallel,
+                                                              hash_bits=hash_bits)
+        print(shingle_matrix.shape)
+        print(f"Time taken for shingling: {time.time()-timer_start}")
+
+        # step 2: min-hashing
+        start_time = time.time()    # start timer
+        signature_matrix = minhashing.generate_signature_matrix(shingle_matrix, no_of_hash_functions, seed,
+                                                                 parallel=parallel, scheme=scheme)
+    if signature_bits is not None:
+        signature_matrix = minhashing.PackedSignatures.from_signatures(signature_matrix, signature_bits)
     print(f"Time taken for minhashing: {time.time()-start_time}")
 
+    # candidate volume of the plan, from similarities of sampled pairs
+    plan = lsh.plan_banding(lsh_threshold, bits=signature_bits, scheme=scheme, n=no_of_hash_functions, r=r,
+                            no_of_docs=len(files), similarities=lsh.sample_similarities(signature_matrix, seed=seed))
+    print(f"Expected candidates per query: {plan.expected_candidates:.1f}")
+
     # step 3: LSH(Locality sensitive hashing)
     start_time = time.time()    # start timer
-    r = 2
     buckets_list = lsh.get_bucket_list(signature_matrix, r)
     print(f"Time taken for lsh: {time.time()-start_time}")
 
+    storage.save_index(index_path, params, files, shingle_matrix, signature_matrix, buckets_list)
+    print(f"saved index to {index_path}")
+    return storage.load_index(index_path)
+
+
+def get_ground_truth(index, min_threshold=0.1):
+    """Loads exact pairwise similarities of the corpus, computing them once
+
+    the ground truth is cached in the index directory, and is dropped along
+    with the index when the corpus or parameters change.
+
+    Parameters
+    ----------
+    index: storage.StoredIndex
+        index returned by get_index
+    min_threshold: float, optional
+        lowest similarity the ground truth should cover
+
+    Returns
+    -------
+    statistics.GroundTruth
+        exact jaccard similarities of pairs above min_threshold
+    """
+
+    truth_path = os.path.join(index.path, storage.GROUND_TRUTH)
+    if os.path.exists(truth_path):
+        truth = statistics.GroundTruth.load(truth_path)
+        if truth.covers(min_threshold):
+            return truth
+
+    if index.incidence_matrix is None:
+        raise Exception(f"Index {index.path} was streamed and has no incidence matrix for ground truth")
+    start_time = time.time()    # start timer
+    truth = statistics.ground_truth(index.incidence_matrix, min_threshold, exclude=index.deleted)
+    truth.save(truth_path)
+    print(f"Time taken for ground truth: {time.time()-start_time}")
+    return truth
+
+
+def _candidate_pairs(index, max_bucket=None):
+    """helper-function: candidate pairs of the whole index, skipping giant buckets
+
+    Parameters
+    ----------
+    index: storage.StoredIndex
+        index with the bucket tables
+    max_bucket: int, optional
+        buckets with more documents are skipped.
+        Default: None, metrics.OVERSIZED_BUCKET
+
+    Returns
+    -------
+    numpy.ndarray
+        int64 array of (docid, docid) pairs, see lsh.bucket_pairs
+    """
+
+    max_bucket = metrics.OVERSIZED_BUCKET if max_bucket is None else max_bucket
+    pairs, skipped = lsh.bucket_pairs(index.buckets_list, max_bucket)
+    if skipped:
+        print(f"Skipped {skipped} buckets with more than {max_bucket} documents")
+        metrics.event("skipped_buckets", count=skipped, max_bucket=max_bucket)
+    return pairs
+
+
+def evaluate(threshold=0.5, max_bucket=None, **index_args):
+    """Evaluates the candidate pairs of the index against the ground truth
+
+    Parameters
+    ----------
+    threshold: float, optional
+        jaccard similarity above which pairs are considered relevant
+    max_bucket: int, optional
+        buckets with more documents are left out of the candidate pairs.
+        Default: None, metrics.OVERSIZED_BUCKET
+    index_args:
+        other parameters passed on to get_index
+
+    Returns
+    -------
+    dict
+        corpus level precision, recall and f1, see statistics.GroundTruth.report
+    """
+
+    index = get_index(**index_args)
+    truth = get_ground_truth(index, min(threshold, 0.1))
+    return truth.report(_candidate_pairs(index, max_bucket), threshold)
+
+
+def batch_query(query_files, threshold=0.0, sim_type="jaccard", estimate=False, **index_args):
+    """Finds similar documents for many files at once
+
+    Files of the corpus are looked up together in the index. Other files
+    are shingled and minhashed on their own and compared against the index.
+
+    Parameters
+    ----------
+    query_files: list
+        paths of the files to check
+    threshold: float, optional
+        minimum similarity of reported documents
+    sim_type: string, optional
+        can take values jaccard, euclid, cosine
+    estimate: bool, optional
+        estimate jaccard similarity from signatures instead of shingles
+    index_args:
+        other parameters passed on to get_index
+
+    Returns
+    -------
+    dict
+        maps every query path to its sorted list of (filename, score) tuples
+    """
+
+    index = get_index(**index_args)
+    files = index.files
+    doc_ids = { name: num for name, num in files }
+
+    query_ids = [ doc_ids[path] for path in query_files if path in doc_ids ]
+    outputs = index.query_ids(query_ids, sim_type, estimate)
+    results = dict()
+    for path in query_files:
+        if path in doc_ids:
+            output = outputs[doc_ids[path]]
+        elif os.path.exists(path):
+            output = index.query_file(path, sim_type, estimate)
+        else:
+            print(f">> The given path does not exist: {path}")
+            continue
+        results[path] = [ (files[i][0], score) for i, score in output if score >= threshold ]
+    return results
+
+
+def all_pairs(threshold=0.0, estimate=False, max_bucket=None, **index_args):
+    """Finds every pair of similar documents in the corpus
+
+    Parameters
+    ----------
+    threshold: float, optional
+        minimum jaccard similarity of reported pairs
+    estimate: bool, optional
+        estimate jaccard similarity from signatures instead of shingles
+    max_bucket: int, optional
+        buckets with more documents are left out of the candidate pairs.
+        Default: None, metrics.OVERSIZED_BUCKET
+    index_args:
+        other parameters passed on to get_index
+
+    Returns
+    -------
+    list
+        list of (filename, filename, score) tuples sorted by score
+    """
+
+    index = get_index(**index_args)
+    files = index.files
+    candidates = _candidate_pairs(index, max_bucket)
+    if estimate or index.incidence_matrix is None:
+        scores = statistics.pair_similarity(candidates, index.signature_matrix).tolist()
+    else:
+        scores = [ statistics.jaccard(x, a, index.incidence_matrix) for x, a in candidates.tolist() ]
+    pairs = []
+    for (x, a), score in zip(candidates.tolist(), scores):
+        if score >= threshold:
+            pairs.append((files[x][0], files[a][0], score))
+    return sorted(pairs, key=lambda p: p[2], reverse=True)
+
+
+def clusters(threshold=0.5, **index_args):
+    """Groups near-duplicate documents of the corpus into clusters
+
+    Parameters
+    ----------
+    threshold: float, optional
+        minimum estimated jaccard similarity of documents merged together
+    index_args:
+        other parameters passed on to get_index
+
+    Returns
+    -------
+    list
+        list of clusters, largest first. Every cluster is a list of
+        (filename, score) tuples, with its representative first
+    """
+
+    index = get_index(**index_args)
+    files = index.files
+    output = []
+    for cluster in clustering.cluster_documents(index.buckets_list, index.signature_matrix, threshold):
+        output.append([ (files[doc_id][0], score) for doc_id, score in zip(cluster.members, cluster.scores) ])
+    return output
+
+
+def startLSH():
+    print("\n*** Plagiarism detection using LSH ***\n")
+
+    lsh_threshold = 0.5         # target similarity used to plan the bands
+    index = get_index(lsh_threshold=lsh_threshold)
+    files = index.files
+    r = index.params["r"]
+    shingle_matrix = index.incidence_matrix
+    ground_truth = get_ground_truth(index)
+
     # preprocessing done. ask file from user to check plagiarism
     sim_type = "jaccard"
     while True:
@@ -55,23 +351,58 @@ def startLSH():
         if not os.path.exists(test_file):
             print(">> The given path does not exist.")
             continue
+        query_path = test_file
         for name, num in files:
             if test_file == name:
                 test_file = int(num)
         # test_file = int(input("Enter path of file: "))
         threshold = float(input("Enter threshold: "))
 
-        print(f"Given file: {statistics.get_file_name(test_file, files)}")
-        similar_docs = lsh.find_similar_docs(test_file, buckets_list, signature_matrix, r)
-        output = statistics.compute_similarity(test_file, similar_docs, shingle_matrix, sim_type)
+        if isinstance(test_file, str):
+            # not a part of the corpus: compare it against the index as is
+            print(f"Given file: {query_path} (not in corpus)")
+            output = index.query_file(query_path, sim_type)
+        else:
+            print(f"Given file: {statistics.get_file_name(test_file, files)}")
+            similar_docs = lsh.find_similar_docs(test_file, index.buckets_list, index.signature_matrix, r)
+            output = statistics.compute_similarity(test_file, similar_docs, shingle_matrix, sim_type)
 
         for file_id, score in output:
             print(f"{statistics.get_file_name(file_id, files)}\t{score}")
         
+        if isinstance(test_file, str) or len(output) == 0:
+            continue
         print(f"Precision: {statistics.precision(threshold, output)}")
-        print(f"Recall: {statistics.recall(threshold, test_file, len(files), output, shingle_matrix, sim_type)}")
+        print(f"Recall: {statistics.recall(threshold, test_file, len(files), output, shingle_matrix, sim_type, ground_truth)}")
 
     print("\n*** End of Program ***\n")
 
 if __name__ == "__main__":
-    startLSH()
\ No newline at end of file
+    # python main.py                      : interactive mode
+    # python main.py --pairs [threshold]  : print all similar pairs of corpus
+    # python main.py --report [threshold] : evaluate candidate pairs of corpus
+    # python main.py --clusters [threshold]: print groups of near-duplicates
+    # python main.py file1 file2 ...      : print similar docs of given files
+    if os.environ.get("LSH_METRICS"):
+        metrics.set_sink(metrics.JSONLogSink(os.environ["LSH_METRICS"]))
+    if len(sys.argv) > 1 and sys.argv[1] == "--pairs":
+        threshold = float(sys.argv[2]) if len(sys.argv) > 2 else 0.0
+        for name_x, name_a, score in all_pairs(threshold):
+            print(f"{name_x}\t{name_a}\t{score}")
+    elif len(sys.argv) > 1 and sys.argv[1] == "--clusters":
+        threshold = float(sys.argv[2]) if len(sys.argv) > 2 else 0.5
+        for i, cluster in enumerate(clusters(threshold)):
+            print(f"Cluster {i}: {len(cluster)} documents")
+            for name, score in cluster:
+                print(f"{name}\t{score}")
+    elif len(sys.argv) > 1 and sys.argv[1] == "--report":
+        threshold = float(sys.argv[2]) if len(sys.argv) > 2 else 0.5
+        for measure, value in evaluate(threshold).items():
+            print(f"{measure}: {value}")
+    elif len(sys.argv) > 1:
+        for path, output in batch_query(sys.argv[1:]).items():
+            print(f"Given file: {path}")
+            for name, score in output:
+                print(f"{name}\t{score}")
+    else:
+        startLSH()
\ No newline at end of file
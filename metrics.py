@@ -0,0 +1,427 @@
+"""
+Instrumentation of the pipeline: stage durations, throughput, peak memory,
+bucket size distributions, candidates per query and query latencies
+
+Metrics are disabled by default, in which case every recording function
+returns right away. They are enabled by installing a sink:
+
+    import metrics
+    registry = metrics.Registry()
+    metrics.set_sink(registry)                              # in-process
+    metrics.set_sink(metrics.JSONLogSink("metrics.jsonl"))  # JSON lines
+
+A sink is any object with an emit(event) method, where event is a dict
+with atleast "type" and "name" keys.
+
+The memory of a stage is measured by sampling the resident memory of the
+process while it runs: memory_delta is the peak reached during the stage
+minus the memory at its start, so it does not include earlier stages.
+
+This module contains the following:
+    * set_sink - enable metrics and choose where they go
+    * stage - context manager timing a pipeline stage
+    * latency - context manager recording a duration into a histogram
+    * observe, observe_many, incr - record values and counters
+    * progress - progress bar over an iterable
+    * Histogram, Registry, JSONLogSink, MultiSink
+"""
+
+import json
+import math
+import os
+import sys
+import threading
+import time
+import numpy as np
+
+
+# buckets holding more documents than this are reported as oversized
+OVERSIZED_BUCKET = 1000
+# show tqdm progress bars from the pipeline stages
+SHOW_PROGRESS = True
+# seconds between two samples of the resident memory of a running stage
+MEMORY_INTERVAL = 0.005
+
+_sink = None
+
+
+def set_sink(sink):
+    """This function enables metrics by installing a sink
+
+    Parameters
+    ----------
+    sink: object
+        object with an emit(event) method, or None to disable metrics
+
+    Returns
+    -------
+    object
+        the previously installed sink
+    """
+
+    global _sink
+    previous, _sink = _sink, sink
+    return previous
+
+
+def get_sink():
+    """returns the installed sink, or None if metrics are disabled"""
+    return _sink
+
+
+def enabled():
+    """whether a sink is installed"""
+    return _sink is not None
+
+
+def _emit(event):
+    event["time"] = time.time()
+    _sink.emit(event)
+
+
+def current_memory():
+    """resident memory of the process in bytes, or None if unknown
+
+    read from /proc, so only known on linux.
+    """
+    try:
+        with open("/proc/self/statm", 'r') as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class _MemorySampler:
+    """helper-class: thread sampling the resident memory while stages run
+
+    every running stage keeps the highest sample seen since it started.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stages = []
+        self.thread = None
+
+    def start(self, stage):
+        with self.lock:
+            self.stages.append(stage)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, daemon=True)
+                self.thread.start()
+
+    def stop(self, stage):
+        self.sample()
+        with self.lock:
+            self.stages.remove(stage)
+
+    def sample(self):
+        memory = current_memory()
+        if memory is None:
+            return
+        with self.lock:
+            for stage in self.stages:
+                stage.peak = max(stage.peak, memory)
+
+    def _run(self):
+        while True:
+            with self.lock:
+                if not self.stages:
+                    self.thread = None
+                    return
+            self.sample()
+            time.sleep(MEMORY_INTERVAL)
+
+
+_sampler = _MemorySampler()
+
+
+class Histogram:
+    """Histogram of non-negative values in power of two buckets
+
+    bucket k counts values in (2^(k-1), 2^k], bucket None counts zeros.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+        self.buckets = dict()
+
+    def add_many(self, values):
+        """adds an array of values"""
+        values = np.asarray(values, dtype=np.float64).ravel()
+        if len(values) == 0:
+            return
+        self.count += len(values)
+        self.total += float(values.sum())
+        low, high = float(values.min()), float(values.max())
+        self.min = low if self.min is None else min(self.min, low)
+        self.max = high if self.max is None else max(self.max, high)
+        positive = values[values > 0]
+        zeros = len(values) - len(positive)
+        if zeros:
+            self.buckets[None] = self.buckets.get(None, 0) + zeros
+        exponents, counts = np.unique(np.ceil(np.log2(positive)).astype(np.int64), return_counts=True)
+        for k, c in zip(exponents.tolist(), counts.tolist()):
+            self.buckets[k] = self.buckets.get(k, 0) + c
+
+    def add(self, value):
+        """adds a single value"""
+        self.add_many([value])
+
+    def quantile(self, q):
+        """upper bound of the bucket containing the q-th quantile"""
+        if self.count == 0:
+            return None
+        seen = 0
+        for k in sorted(self.buckets, key=lambda k: -math.inf if k is None else k):
+            seen += self.buckets[k]
+            if seen >= q * self.count:
+                return 0.0 if k is None else min(2.0**k, self.max)
+        return self.max
+
+    def to_dict(self):
+        """summary of the histogram as a JSON serializable dict"""
+        return {
+            "count": self.count,
+            "sum": self.total,
+            "min": self.min,
+            "max": self.max,
+            "mean": self.total/self.count if self.count else None,
+            "p50": self.quantile(0.5),
+            "p99": self.quantile(0.99),
+            "buckets": { ("0" if k is None else f"<={2.0**k:g}"): c
+                         for k, c in sorted(self.buckets.items(), key=lambda kc: -math.inf if kc[0] is None else kc[0]) },
+        }
+
+
+class Registry:
+    """In-process sink aggregating all the metrics
+
+    Attributes
+    ----------
+    stages: dict
+        name of stage to list of its recorded runs
+    histograms: dict
+        name of value to Histogram
+    counters: dict
+        name of counter to its value
+    events: list
+        other events, e.g. oversized buckets
+    """
+
+    def __init__(self):
+        self.stages = dict()
+        self.histograms = dict()
+        self.counters = dict()
+        self.events = []
+
+    def emit(self, event):
+        kind, name = event["type"], event["name"]
+        if kind == "stage":
+            self.stages.setdefault(name, []).append(event)
+        elif kind == "observe":
+            self.histograms.setdefault(name, Histogram()).add_many(event["values"])
+        elif kind == "counter":
+            self.counters[name] = self.counters.get(name, 0) + event["value"]
+        else:
+            self.events.append(event)
+
+    def snapshot(self):
+        """all the metrics as a JSON serializable dict"""
+        return {
+            "stages": self.stages,
+            "histograms": { name: h.to_dict() for name, h in self.histograms.items() },
+            "counters": dict(self.counters),
+            "events": list(self.events),
+        }
+
+
+class JSONLogSink:
+    """Sink writing every event as a line of JSON
+
+    arrays of observed values are written as a histogram summary.
+
+    Parameters
+    ----------
+    path_or_stream: str or file
+        path of the log file to append to, or an open text stream
+    """
+
+    def __init__(self, path_or_stream=sys.stderr):
+        if isinstance(path_or_stream, str):
+            self.stream = open(path_or_stream, 'a', encoding="utf8")
+        else:
+            self.stream = path_or_stream
+
+    def emit(self, event):
+        if event["type"] == "observe":
+            histogram = Histogram()
+            histogram.add_many(event["values"])
+            event = dict(event, values=histogram.to_dict())
+        self.stream.write(json.dumps(event) + "\n")
+        self.stream.flush()
+
+    def close(self):
+        if self.stream not in (sys.stdout, sys.stderr):
+            self.stream.close()
+
+
+class MultiSink:
+    """Sink forwarding every event to several sinks"""
+
+    def __init__(self, *sinks):
+        self.sinks = sinks
+
+    def emit(self, event):
+        for sink in self.sinks:
+            sink.emit(dict(event))
+
+
+class _NullStage:
+    """helper-class: stage used when metrics are disabled"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def set(self, **counts):
+        pass
+
+    def note(self, **fields):
+        pass
+
+
+_NULL_STAGE = _NullStage()
+
+
+class _Stage:
+    """helper-class: times a stage and emits it with throughput and memory
+    """
+
+    def __init__(self, name, labels, histogram=False):
+        self.name = name
+        self.labels = labels
+        self.counts = dict()
+        self.fields = dict()
+        self.histogram = histogram
+
+    def set(self, **counts):
+        """sets the no of items (e.g. docs, shingles) processed by the stage,
+        emitted along with their per second rate
+        """
+        self.counts.update(counts)
+
+    def note(self, **fields):
+        """sets other fields of the stage event, which have no rate"""
+        self.fields.update(fields)
+
+    def __enter__(self):
+        self.memory = None
+        if not self.histogram:
+            self.memory = self.peak = current_memory()
+            if self.memory is not None:
+                _sampler.start(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        seconds = time.perf_counter() - self.start
+        if self.memory is not None:
+            _sampler.stop(self)
+        if _sink is None:
+            return False
+        if self.histogram:
+            _emit({"type": "observe", "name": self.name, "values": [seconds], **self.labels})
+            return False
+        event = {"type": "stage", "name": self.name, "seconds": seconds, "failed": exc_type is not None,
+                 "peak_memory": None if self.memory is None else self.peak,
+                 "memory_delta": None if self.memory is None else self.peak - self.memory, **self.labels}
+        for key, count in self.counts.items():
+            event[key] = count
+            event[f"{key}_per_second"] = count/seconds if seconds > 0 else None
+        event.update(self.fields)
+        _emit(event)
+        return False
+
+
+def stage(name, **labels):
+    """This function times a pipeline stage
+
+    use as ``with metrics.stage("shingling") as s: ... s.set(docs=n)``.
+    Emits duration, the peak resident memory during the stage and its
+    growth over the memory at the start (memory_delta), and the per second
+    rate of every count set. Fields without a rate are set by s.note().
+
+    Parameters
+    ----------
+    name: str
+        name of the stage
+    labels:
+        extra fields added to the event
+    """
+
+    if _sink is None:
+        return _NULL_STAGE
+    return _Stage(name, labels)
+
+
+def latency(name, **labels):
+    """This function records the duration of a block into histogram name
+    """
+
+    if _sink is None:
+        return _NULL_STAGE
+    return _Stage(name, labels, histogram=True)
+
+
+def observe_many(name, values, **labels):
+    """This function records an array of values into histogram name
+    """
+
+    if _sink is None:
+        return
+    # sinks summarize the array, so it is passed on as is
+    _emit({"type": "observe", "name": name, "values": np.asarray(values), **labels})
+
+
+def observe(name, value, **labels):
+    """This function records a value into histogram name
+    """
+
+    if _sink is None:
+        return
+    _emit({"type": "observe", "name": name, "values": [value], **labels})
+
+
+def incr(name, value=1, **labels):
+    """This function adds value to counter name
+    """
+
+    if _sink is None:
+        return
+    _emit({"type": "counter", "name": name, "value": value, **labels})
+
+
+def event(name, **fields):
+    """This function records a single event, e.g. an oversized bucket
+    """
+
+    if _sink is None:
+        return
+    _emit({"type": "event", "name": name, **fields})
+
+
+def progress(iterable, total=None, **kwargs):
+    """This function wraps iterable in a tqdm progress bar if enabled
+
+    tqdm is only imported when a progress bar is shown.
+    """
+
+    if not SHOW_PROGRESS:
+        return iterable
+    from tqdm import tqdm
+    return tqdm(iterable, total=total, **kwargs)
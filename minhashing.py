@@ -4,94 +4,648 @@ Reduce the size of shingle incidence matrix by converting docs to signatures
 This module calculates the signature of each document using minhashing 
 technique by utilizing a number of hash functions
 
+All hash functions are of the form (a*x+b)%prime. Their parameters are drawn
+once from a seeded random generator, so the same seed always gives the same
+signatures.
+
+One permutation hashing (scheme "oph") is an alternative which hashes every
+shingle only once. The hash picks one of n bins and each bin keeps the
+smallest value it recieves. Bins left empty are filled by densification:
+the value of another bin, picked by a probe sequence which is the same for
+all documents, is copied into it. Its cost does not depend on n.
+
+b-bit minhash keeps only the lowest b bits of every signature value. The
+values are bit packed into uint64 words by PackedSignatures, which is 32/b
+times smaller than the uint32 signature matrix.
+
+SimHash (scheme "simhash") targets cosine similarity instead of jaccard.
+Every bit of a signature is the side of a random hyperplane a document falls
+on: each shingle adds +1 or -1 to the projection, picked by a hash of the
+shingle, and the bit is set if the sum is positive. Two documents agree on a
+bit with probability 1 - angle/pi, where angle is the angle between their
+0/1 shingle vectors. The bits are stored packed by SimHashSignatures, and
+bands of them are hashed by lsh like any other signature.
+
+Both schemes keep the smallest hash value seen, so a document can also be
+signed chunk by chunk: the minimum over its chunks is the same as over the
+whole document. stream_signature_matrix does so for documents which are
+streamed by shingling.iter_documents, without an incidence matrix.
+
 This module contatins following functions:
+    * generate_hash_functions - to draw the parameters of the hash functions
+    * minhash - to generate the signature of a single document
+    * oph_signature - one permutation hash signature of a single document
     * generate_signature_matrix - to generate signature matrix from incidence matrix
+    * stream_signature_matrix - signature matrix of documents streamed in chunks
+    * simhash_signature - simhash signature of a single document
+    * mix64 - splitmix64 finalizer of a uint64 array
+    * PackedSignatures - b-bit minhash signatures packed into uint64 words
+    * SimHashSignatures - simhash signatures packed into uint64 words
 """
 
-from random import randint
-from pandas import DataFrame, read_pickle
+from collections import namedtuple
 import numpy as np
-import os
-from tqdm import tqdm
+
+import metrics
+
+
+# mersenne prime 2^31-1, keeps a*x+b inside uint64 for 32-bit shingle ids
+PRIME = (1 << 31) - 1
+# signature value used for documents which do not have any shingle
+EMPTY = np.iinfo(np.uint32).max
+# upper bound on the no of hash values computed at once (hashes x shingles)
+BLOCK_SIZE = 1 << 22
+
+HashParameters = namedtuple("HashParameters", ["a", "b", "prime"])
+
+# constants of the splitmix64 finalizer, see mix64
+GOLDEN = np.uint64(0x9e3779b97f4a7c15)
+_MIX_1 = np.uint64(0xbf58476d1ce4e5b9)
+_MIX_2 = np.uint64(0x94d049bb133111eb)
+_LOW_32 = np.uint64(0xffffffff)
 
 
-def generate_hash_functions(rows, no_of_hash_functions=200):
+def generate_hash_functions(no_of_hash_functions=200, seed=0):
     """This function generates parameters for given no of hash functions
     
     Parameters
     ----------
-    rows: int
-        no of shingles in corpus, a.k.a no of rows in shingle matrix
     no_of_hash_functions: int, optional
         no of hash functions to generate for minhashing
-        Default: 100
+        Default: 200
+    seed: int, optional
+        seed for the random generator. Default: 0
     
     Returns
     -------
-    list
-        list of functions which can be used as hashes[i](x)
+    HashParameters
+        namedtuple of uint64 arrays a, b and the prime, such that
+        hash i of x is (a[i]*x + b[i]) % prime
     """
 
-    hashes = []
-    c = rows
+    rng = np.random.default_rng(seed)
+    a = rng.integers(1, PRIME, size=no_of_hash_functions, dtype=np.uint64)
+    b = rng.integers(0, PRIME, size=no_of_hash_functions, dtype=np.uint64)
+    return HashParameters(a, b, PRIME)
+
+
+def _hash_values(shingles, hash_params):
+    """helper-function: hash values of all shingles under all hash functions
+
+    returns an array of shape (no_of_hash_functions, len(shingles))
+    """
+
+    a, b, prime = hash_params
+    x = np.asarray(shingles).astype(np.uint64) % np.uint64(prime)
+    return (a[:, None] * x[None, :] + b[:, None]) % np.uint64(prime)
+
+
+def minhash(shingles, hash_params):
+    """This function generates the signature of a single document
+
+    Parameters
+    ----------
+    shingles: numpy.ndarray
+        shingle ids present in the document
+    hash_params: HashParameters
+        hash functions generated by generate_hash_functions
     
-    # all functions are same here. check this
-    for i in range(no_of_hash_functions):
-        def hash(x):
-            """
-            This function calculates hash for given x
+    Returns
+    -------
+    numpy.ndarray
+        uint32 signature of length no_of_hash_functions
+    """
+
+    return _fold_minhash(np.full(len(hash_params.a), EMPTY, dtype=np.uint64), shingles, hash_params)
+
+
+def _fold_minhash(signature, shingles, hash_params):
+    """helper-function: fold shingles into a uint64 signature in place, a
+    range of shingles at a time so that atmost BLOCK_SIZE hash values are
+    computed at once. Returns the signature as uint32
+    """
+
+    step = max(1, BLOCK_SIZE // len(hash_params.a))
+    for i in range(0, len(shingles), step):
+        np.minimum(signature, _hash_values(shingles[i:i+step], hash_params).min(axis=1), out=signature)
+    return signature.astype(np.uint32)
+
+
+def mix64(x):
+    """This function applies the splitmix64 finalizer to a uint64 array
+
+    used to hash shingles for one permutation hashing and simhash, and by
+    lsh to mix band rows into bucket keys.
+    """
+    x = x ^ (x >> np.uint64(30))
+    x = x * _MIX_1
+    x ^= x >> np.uint64(27)
+    x *= _MIX_2
+    x ^= x >> np.uint64(31)
+    return x
+
+
+def _oph_salt(seed):
+    """helper-function: salts of the shingle hash and the probe sequence"""
+    rng = np.random.default_rng(seed)
+    return rng.integers(0, 1 << 63, size=2, dtype=np.uint64)
+
+
+def _densify(block, non_empty, salt):
+    """helper-function: fill empty bins of non-empty documents in place
+
+    empty bin i of every document probes bins mix(i, attempt) % n for
+    attempt = 1, 2, ... and copies the first bin which was not empty.
+    """
+
+    no_of_bins = block.shape[0]
+    original = block.copy()
+    bins, docs = np.nonzero(block == EMPTY)
+    keep = non_empty[docs]
+    bins, docs = bins[keep], docs[keep]
+    attempt = 0
+    while len(bins):
+        attempt += 1
+        probe = mix64((bins.astype(np.uint64) * GOLDEN + np.uint64(attempt)) ^ salt)
+        values = original[(probe % np.uint64(no_of_bins)).astype(np.intp), docs]
+        hit = values != EMPTY
+        block[bins[hit], docs[hit]] = values[hit]
+        bins, docs = bins[~hit], docs[~hit]
+
+
+def _oph_bins(shingles, no_of_bins, salt):
+    """helper-function: bin and value of every shingle under one permutation
+    hashing
+    """
+
+    h = mix64(np.asarray(shingles).astype(np.uint64) ^ salt[0])
+    # high half of the hash picks the bin, low half is the value
+    bins = (((h >> np.uint64(32)) * np.uint64(no_of_bins)) >> np.uint64(32)).astype(np.intp)
+    values = np.minimum(h & _LOW_32, EMPTY - 1).astype(np.uint32)
+    return bins, values
+
+
+def _oph_block(indptr, indices, no_of_bins, salt, start, stop, out):
+    """helper-function: one permutation hash documents start..stop into
+    out[:, start:stop]
+    """
+
+    offsets = indptr[start:stop+1] - indptr[start]
+    sizes = np.diff(offsets)
+    bins, values = _oph_bins(indices[indptr[start]:indptr[stop]], no_of_bins, salt)
+    owner = np.repeat(np.arange(stop - start), sizes)
+
+    block = np.full((no_of_bins, stop - start), EMPTY, dtype=np.uint32)
+    np.minimum.at(block, (bins, owner), values)
+    _densify(block, sizes > 0, salt[1])
+    out[:, start:stop] = block
+
+
+def oph_signature(shingles, no_of_bins=200, seed=0):
+    """This function generates the one permutation hash signature of a document
+
+    Parameters
+    ----------
+    shingles: numpy.ndarray
+        shingle ids present in the document
+    no_of_bins: int, optional
+        length of the signature. Default: 200
+    seed: int, optional
+        same seed used for generate_signature_matrix. Default: 0
+
+    Returns
+    -------
+    numpy.ndarray
+        uint32 signature of length no_of_bins
+    """
+
+    out = np.empty((no_of_bins, 1), dtype=np.uint32)
+    indptr = np.array([0, len(shingles)], dtype=np.int64)
+    _oph_block(indptr, np.asarray(shingles), no_of_bins, _oph_salt(seed), 0, 1, out)
+    return out[:, 0]
+
+
+def _simhash_salt(no_of_words, seed):
+    """helper-function: salt of the shingle hash of every signature word"""
+    rng = np.random.default_rng([seed, 1])
+    return rng.integers(0, 1 << 63, size=no_of_words, dtype=np.uint64)
+
+
+def _simhash_block(indptr, indices, no_of_bits, salt, start, stop, out):
+    """helper-function: simhash documents start..stop into the signature
+    words out[:, start:stop]
+    """
+
+    offsets = indptr[start:stop+1] - indptr[start]
+    sizes = np.diff(offsets)
+    x = np.asarray(indices[indptr[start]:indptr[stop]]).astype(np.uint64)
+    # bit i of the hash of a shingle picks its +1/-1 weight on hyperplane i
+    h = mix64(x[:, None] ^ salt[None, :]).astype('<u8', copy=False)
+    bits = np.unpackbits(h.view(np.uint8), axis=1, bitorder='little')[:, :no_of_bits]
+    non_empty = sizes > 0
+    ones = np.zeros((stop - start, no_of_bits), dtype=np.int64)
+    if len(x) > 0:
+        ones[non_empty] = np.add.reduceat(bits, offsets[:-1][non_empty], axis=0, dtype=np.int64)
+    # projection is positive if more shingles weigh +1 than -1
+    signs = 2 * ones > sizes[:, None]
+    packed = np.zeros((stop - start, 8 * out.shape[0]), dtype=np.uint8)
+    packed[:, :-(-no_of_bits // 8)] = np.packbits(signs, axis=1, bitorder='little')
+    out[:, start:stop] = packed.view('<u8').T
+
+
+def simhash_signature(shingles, no_of_bits=256, seed=0):
+    """This function generates the simhash signature of a single document
+
+    Parameters
+    ----------
+    shingles: numpy.ndarray
+        unique shingle ids present in the document
+    no_of_bits: int, optional
+        length of the signature in bits. Default: 256
+    seed: int, optional
+        same seed used for generate_signature_matrix. Default: 0
+
+    Returns
+    -------
+    SimHashSignatures
+        signature of the document
+    """
 
-            hash function format: (a*x+b)%c where
-                c: prime integer just greater than rows
-                a,b: random integer less than c
-            """
-            return (randint(1,5*c)*x + randint(1,5*c))%c
-        hashes.append(hash)
+    no_of_words = -(-no_of_bits // 64)
+    out = np.empty((no_of_words, 1), dtype=np.uint64)
+    indptr = np.array([0, len(shingles)], dtype=np.int64)
+    _simhash_block(indptr, np.asarray(shingles), no_of_bits, _simhash_salt(no_of_words, seed), 0, 1, out)
+    return SimHashSignatures(out, 1, no_of_bits)
 
-    return hashes
 
+def _doc_chunks(indptr, no_of_hash_functions, block_size=None, doc_size=0):
+    """helper-function: split documents into ranges of bounded hashing work
 
-def generate_signature_matrix(incidence_matrix, no_of_hash_functions=200):
+    yields (start, stop) document ranges whose no of non-zeros times
+    no_of_hash_functions, plus doc_size for every document, stays around
+    block_size. A range holds atleast one doc, so a larger document is a
+    range of its own.
+    """
+
+    block_size = BLOCK_SIZE if block_size is None else block_size
+    cols = len(indptr) - 1
+    # work of all the documents before every document
+    work = np.asarray(indptr, dtype=np.int64) * max(1, no_of_hash_functions)
+    if doc_size:
+        work = work + np.arange(cols + 1, dtype=np.int64) * doc_size
+    start = 0
+    while start < cols:
+        stop = int(np.searchsorted(work, work[start] + block_size, side='right')) - 1
+        stop = min(max(stop, start + 1), cols)
+        yield start, stop
+        start = stop
+
+
+def _signature_block(indptr, indices, hash_params, start, stop, out):
+    """helper-function: minhash documents start..stop into out[:, start:stop]
+    """
+
+    offsets = indptr[start:stop+1] - indptr[start]
+    if stop - start == 1:
+        # a single document can be larger than a block, fold it in pieces
+        out[:, start] = minhash(indices[indptr[start]:indptr[stop]], hash_params)
+        return
+    values = _hash_values(indices[indptr[start]:indptr[stop]], hash_params)
+    non_empty = offsets[1:] > offsets[:-1]
+    block = out[:, start:stop]
+    block[:, ~non_empty] = EMPTY
+    if values.shape[1] > 0:
+        # segments of empty docs have zero length, so starts of the
+        # non-empty docs are enough to delimit every segment
+        block[:, non_empty] = np.minimum.reduceat(values, offsets[:-1][non_empty], axis=1)
+
+
+def _signature_worker(args):
+    """helper-function: worker to minhash a slice of documents
+
+    the signatures are written straight into the shared memory block
+    holding the signature matrix, so nothing is sent back to the parent.
+    """
+
+    from multiprocessing.shared_memory import SharedMemory
+
+    shm_name, shape, indptr, indices, hash_params, start = args
+    shm = SharedMemory(name=shm_name)
+    try:
+        signature_matrix = np.ndarray(shape, dtype=np.uint32, buffer=shm.buf)
+        out = signature_matrix[:, start:start+len(indptr)-1]
+        for begin, end in _doc_chunks(indptr, shape[0]):
+            _signature_block(indptr, indices, hash_params, begin, end, out)
+        del signature_matrix, out
+    finally:
+        shm.close()
+
+
+def _parallel_signatures(incidence_matrix, hash_params, parallel, chunk_size):
+    """helper-function: minhash chunks of documents in a process pool
+
+    every worker recieves the same hash_params, hence the result is equal
+    to the serial computation.
+    """
+
+    from multiprocessing import Pool
+    from multiprocessing.shared_memory import SharedMemory
+
+    shape = (len(hash_params.a), incidence_matrix.shape[1])
+    nbytes = max(1, shape[0] * shape[1] * np.dtype(np.uint32).itemsize)
+    indptr, indices = incidence_matrix.indptr, incidence_matrix.indices
+
+    shm = SharedMemory(create=True, size=nbytes)
+    try:
+        tasks = [ (shm.name, shape, indptr[i:i+chunk_size+1] - indptr[i],
+                   indices[indptr[i]:indptr[min(i+chunk_size, shape[1])]], hash_params, i)
+                  for i in range(0, shape[1], chunk_size) ]
+        with Pool(parallel) as pool:
+            for _ in metrics.progress(pool.imap_unordered(_signature_worker, tasks), total=len(tasks)):
+                pass
+        signature_matrix = np.ndarray(shape, dtype=np.uint32, buffer=shm.buf).copy()
+    finally:
+        shm.close()
+        shm.unlink()
+    return signature_matrix
+
+
+def generate_signature_matrix(incidence_matrix, no_of_hash_functions=200, seed=0,
+                              parallel=None, chunk_size=1024, scheme="minhash"):
     """This function generates the signature matrix for whole corpus
 
-    if a already generated pickle file named sig_mat.pickle exists,
-    this function will load it instead
+    to reuse a generated signature matrix across runs, see storage.save_index
 
     Parameters
     ----------
-    incidence_matrix: pandas.DataFrame
-        incidence index generated after shingling of similar process
+    incidence_matrix: shingling.IncidenceMatrix
+        sparse incidence index generated after shingling
     no_of_hash_functions: int, optional
         no of hash functions to use to generate document signatures.
-        Default: 100
+        Default: 200
+    seed: int, optional
+        seed used to draw the hash functions. Default: 0
+    parallel: int, optional
+        no of worker processes to minhash with. Set to None or 1 to run in
+        the current process. Default: None
+    chunk_size: int, optional
+        no of documents handed to a worker process at once. Default: 1024
+    scheme: str, optional
+        "minhash" to hash every shingle with every hash function, "oph"
+        for one permutation hashing with densification, which hashes every
+        shingle once, or "simhash" for no_of_hash_functions bits of
+        simhash. "oph" and "simhash" always run in the current process.
+        Default: "minhash"
     
     Returns
     -------
-    pandas.DataFrame
-        dataframe containing signatures of each document
+    numpy.ndarray or SimHashSignatures
+        uint32 matrix of shape (no_of_hash_functions, no_of_docs) containing
+        signatures of each document as columns. Packed bits for "simhash"
     """
 
-    # if pickle file exists, load and return it
-    if os.path.exists("sig_mat.pickle"):
-        signature_matrix = read_pickle("sig_mat.pickle")
-        print("Using already created sig_mat.pickle file")
-        return signature_matrix
-
-    rows, cols = incidence_matrix.shape
-    hashes = generate_hash_functions(rows, no_of_hash_functions)
-    signature_matrix = DataFrame(index=[i for i in range(no_of_hash_functions)], columns=incidence_matrix.columns)
+    if scheme not in ("minhash", "oph", "simhash"):
+        raise Exception(f"Unknown signature scheme: {scheme}")
+    hash_params = generate_hash_functions(no_of_hash_functions, seed)
     
-    # core minhashing algorithm
-    for i in tqdm(range(rows)):
-        for j in incidence_matrix.columns:
-            if incidence_matrix.iat[i][j]==1:
-                for k in range(no_of_hash_functions):
-                    if np.isnan(signature_matrix.iat[k][j]):
-                        signature_matrix.iat[k][j] = hashes[k](i)
-                    else:
-                        signature_matrix.iat[k][j] = min(signature_matrix.iat[k][j], hashes[k](i))
+    with metrics.stage("minhashing", parallel=parallel, scheme=scheme) as stage:
+        if scheme == "simhash":
+            cols = incidence_matrix.shape[1]
+            no_of_words = -(-no_of_hash_functions // 64)
+            words = np.empty((no_of_words, cols), dtype=np.uint64)
+            indptr, indices = incidence_matrix.indptr, incidence_matrix.indices
+            salt = _simhash_salt(no_of_words, seed)
+            for start, stop in metrics.progress(list(_doc_chunks(indptr, no_of_hash_functions))):
+                _simhash_block(indptr, indices, no_of_hash_functions, salt, start, stop, words)
+            signature_matrix = SimHashSignatures(words, 1, no_of_hash_functions)
+        elif scheme == "oph":
+            cols = incidence_matrix.shape[1]
+            signature_matrix = np.empty((no_of_hash_functions, cols), dtype=np.uint32)
+            indptr, indices = incidence_matrix.indptr, incidence_matrix.indices
+            salt = _oph_salt(seed)
+            # the bins of every document are a dense block, whatever its size
+            for start, stop in metrics.progress(list(_doc_chunks(indptr, 1, doc_size=no_of_hash_functions))):
+                _oph_block(indptr, indices, no_of_hash_functions, salt, start, stop, signature_matrix)
+        elif parallel is not None and parallel > 1:
+            signature_matrix = _parallel_signatures(incidence_matrix, hash_params, parallel, chunk_size)
+        else:
+            cols = incidence_matrix.shape[1]
+            signature_matrix = np.empty((no_of_hash_functions, cols), dtype=np.uint32)
+            # core minhashing algorithm: hash blocks of documents at once
+            indptr, indices = incidence_matrix.indptr, incidence_matrix.indices
+            for start, stop in metrics.progress(list(_doc_chunks(indptr, no_of_hash_functions))):
+                _signature_block(indptr, indices, hash_params, start, stop, signature_matrix)
+        stage.set(docs=incidence_matrix.shape[1], shingles=incidence_matrix.nnz)
     
-    print("saving generated signature_matrix to pickle file...")
-    signature_matrix.to_pickle("sig_mat.pickle")
-    print("saved to sig_mat.pickle")
     return signature_matrix
+
+
+def _stream_minhash(chunks, hash_params):
+    """helper-function: minhash signature of a document given in chunks"""
+    signature = np.full(len(hash_params.a), EMPTY, dtype=np.uint64)
+    for shingles in chunks:
+        _fold_minhash(signature, shingles, hash_params)
+    return signature.astype(np.uint32)
+
+
+def _stream_oph(chunks, no_of_bins, salt):
+    """helper-function: one permutation hash signature of a document given
+    in chunks
+    """
+
+    block = np.full((no_of_bins, 1), EMPTY, dtype=np.uint32)
+    non_empty = False
+    for shingles in chunks:
+        bins, values = _oph_bins(shingles, no_of_bins, salt)
+        np.minimum.at(block[:, 0], bins, values)
+        non_empty = non_empty or len(shingles) > 0
+    _densify(block, np.array([non_empty]), salt[1])
+    return block[:, 0]
+
+
+def stream_signature_matrix(documents, no_of_hash_functions=200, seed=0, scheme="minhash"):
+    """This function generates the signature matrix of streamed documents
+
+    every document is given as chunks of shingle ids, which are hashed and
+    dropped one at a time. The signatures are equal to those of
+    generate_signature_matrix over the incidence matrix of the documents.
+
+    Parameters
+    ----------
+    documents: iterable
+        shingle ids of every document, as an iterable of numpy.ndarray
+        chunks (see shingling.iter_documents). Ids may repeat
+    no_of_hash_functions: int, optional
+        no of hash functions to use to generate document signatures.
+        Default: 200
+    seed: int, optional
+        seed used to draw the hash functions. Default: 0
+    scheme: str, optional
+        "minhash" or "oph", see generate_signature_matrix. Default: "minhash"
+
+    Returns
+    -------
+    numpy.ndarray
+        uint32 matrix of shape (no_of_hash_functions, no_of_docs) containing
+        signatures of each document as columns, in column major order
+    """
+
+    if scheme == "simhash":
+        raise Exception("simhash needs the unique shingles of a document, it can not be streamed")
+    if scheme not in ("minhash", "oph"):
+        raise Exception(f"Unknown signature scheme: {scheme}")
+    hash_params = generate_hash_functions(no_of_hash_functions, seed)
+    salt = _oph_salt(seed)
+
+    # signatures as rows, grown in place when the documents outnumber them,
+    # so the signature matrix is its transpose without a copy
+    rows = np.empty((len(documents) if hasattr(documents, "__len__") else 1024, no_of_hash_functions),
+                    dtype=np.uint32)
+    no_of_docs = 0
+    with metrics.stage("minhashing", scheme=scheme, stream=True) as stage:
+        for chunks in metrics.progress(documents):
+            if no_of_docs == len(rows):
+                rows.resize((max(2*len(rows), 1), no_of_hash_functions), refcheck=False)
+            if scheme == "oph":
+                rows[no_of_docs] = _stream_oph(chunks, no_of_hash_functions, salt)
+            else:
+                rows[no_of_docs] = _stream_minhash(chunks, hash_params)
+            no_of_docs += 1
+        rows.resize((no_of_docs, no_of_hash_functions), refcheck=False)
+        stage.set(docs=no_of_docs)
+
+    return rows.T
+
+
+class PackedSignatures:
+    """b-bit minhash signatures bit packed into uint64 words
+
+    only the lowest b bits of every signature value are kept. Value i of a
+    signature is stored at bit (i % (64/b))*b of word i // (64/b), so a
+    signature of n values takes ceil(n*b/64) words. Unused fields of the
+    last word are zero.
+
+    Parameters
+    ----------
+    words: numpy.ndarray
+        uint64 array of shape (no_of_words, no_of_docs), documents as columns
+    bits: int
+        no of bits kept of every value: 1, 2, 4, 8 or 16
+    n: int
+        no of values in a signature
+    """
+
+    def __init__(self, words, bits, n):
+        if bits not in (1, 2, 4, 8, 16):
+            raise Exception(f"b-bit signatures can keep 1, 2, 4, 8 or 16 bits, not {bits}")
+        self.words = words
+        self.bits = bits
+        self.n = n
+
+    @classmethod
+    def from_signatures(cls, signature_matrix, bits):
+        """packs the lowest bits of every value of a signature matrix
+
+        Parameters
+        ----------
+        signature_matrix: numpy.ndarray
+            signatures as columns, as returned by generate_signature_matrix
+        bits: int
+            no of bits to keep of every value
+        """
+        signature_matrix = np.asarray(signature_matrix)
+        n, cols = signature_matrix.shape
+        per_word = 64 // bits
+        no_of_words = -(-n // per_word)
+        values = np.zeros((no_of_words * per_word, cols), dtype=np.uint64)
+        values[:n] = signature_matrix & np.uint32((1 << bits) - 1)
+        values = values.reshape(no_of_words, per_word, cols)
+        words = np.zeros((no_of_words, cols), dtype=np.uint64)
+        for j in range(per_word):
+            words |= values[:, j, :] << np.uint64(j * bits)
+        return cls(words, bits, n)
+
+    @property
+    def shape(self):
+        """(no of values in a signature, no of documents)"""
+        return (self.n, self.words.shape[1])
+
+    def select(self, docs):
+        """returns the packed signatures of given doc_ids"""
+        return type(self)(np.asarray(self.words[:, docs]), self.bits, self.n)
+
+    def rows(self, start, stop):
+        """unpacks values start..stop of every signature
+
+        Returns
+        -------
+        numpy.ndarray
+            uint64 array of shape (stop-start, no_of_docs)
+        """
+        per_word = 64 // self.bits
+        i = np.arange(start, stop)
+        shift = ((i % per_word) * self.bits).astype(np.uint64)
+        values = np.asarray(self.words[i // per_word]) >> shift[:, None]
+        return values & np.uint64((1 << self.bits) - 1)
+
+    def unpack(self):
+        """returns all the b-bit values as a (n, no_of_docs) array"""
+        return self.rows(0, self.n)
+
+    def agreement(self, x, docs):
+        """no of signature values of docs equal to those of x
+
+        Parameters
+        ----------
+        x: numpy.ndarray
+            packed signature words to compare with. Either of one signature,
+            or of one signature per doc with shape (no_of_words, len(docs))
+        docs: numpy.ndarray
+            doc_ids to compare
+        """
+        x = np.asarray(x)
+        diff = np.asarray(self.words[:, docs]) ^ (x[:, None] if x.ndim == 1 else x)
+        # fold every field onto its lowest bit, which is then 0 iff equal
+        shift = 1
+        while shift < self.bits:
+            diff |= diff >> np.uint64(shift)
+            shift *= 2
+        low_bits = np.uint64(sum(1 << j for j in range(0, 64, self.bits)))
+        # padding fields are zero in both, so they never differ
+        return self.n - _popcount(diff & low_bits).sum(axis=0)
+
+    def __repr__(self):
+        return f"PackedSignatures(n={self.n}, docs={self.shape[1]}, bits={self.bits})"
+
+
+class SimHashSignatures(PackedSignatures):
+    """simhash signatures, one bit per random hyperplane
+
+    stored like 1-bit PackedSignatures, but the fraction of agreeing bits
+    estimates cosine similarity, see statistics.simhash_similarity.
+
+    Parameters
+    ----------
+    words: numpy.ndarray
+        uint64 array of shape (no_of_words, no_of_docs), documents as columns
+    bits: int
+        always 1
+    n: int
+        no of bits in a signature
+    """
+
+    def __init__(self, words, bits, n):
+        if bits != 1:
+            raise Exception(f"simhash signatures keep 1 bit per hyperplane, not {bits}")
+        super().__init__(words, bits, n)
+
+    def __repr__(self):
+        return f"SimHashSignatures(n={self.n}, docs={self.shape[1]})"
+
+
+def _popcount(x):
+    """helper-function: no of set bits of every element of a uint64 array"""
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(x).astype(np.int64)
+    bits = np.unpackbits(np.ascontiguousarray(x).view(np.uint8).reshape(x.shape + (8,)), axis=-1)
+    return bits.sum(axis=-1, dtype=np.int64)
@@ -0,0 +1,401 @@
+"""
+Query server keeping a saved LSH index loaded across requests
+
+The server speaks a line oriented protocol over TCP. Every request is a
+line of JSON, answered by a line of JSON carrying the same "id":
+
+    {"id": 1, "doc_id": 12}               query an indexed document
+    {"id": 2, "text": "..."}              query a document given as text
+
+Requests can also set "sim_type" (jaccard, euclid, cosine), "estimate",
+"threshold" and "limit". Setting "k" returns the k most similar documents
+found by the LSH forest instead of the documents sharing a bucket. Answers
+look like
+
+    {"id": 1, "results": [[doc_id, filename, score], ...]}
+    {"id": 2, "error": "..."}
+
+and are sent as soon as they are ready, so several requests can be in
+flight on one connection and answers may arrive out of order.
+
+Requests of all connections go through a bounded queue. When it is full,
+connections are not read from until there is room again. Queued requests
+are grouped into batches, which are answered by a pool of worker processes
+that each open the index once (memory mapped, so the pages are shared).
+
+This module contains the following:
+    * run_batch - answer a batch of requests using an index
+    * QueryServer - asyncio server answering requests from a worker pool
+    * Client - blocking client for the server
+    * main - command line entry point
+"""
+
+import argparse
+import asyncio
+import functools
+import json
+import os
+import re
+import socket
+from concurrent.futures import BrokenExecutor, ProcessPoolExecutor, ThreadPoolExecutor
+
+import metrics
+import storage
+
+
+# longest request line accepted, large enough for the text of a document
+MAX_LINE = 1 << 24
+# "id" of a request line which is not valid JSON, to echo it in the error
+_ID = re.compile(rb'"id"\s*:\s*("(?:[^"\\]|\\.)*"|-?\d+)')
+
+_index = None
+
+
+def _load_worker(index_path):
+    """helper-function: open the index once in every worker process"""
+    global _index
+    _index = storage.load_index(index_path)
+
+
+def _request_id(line):
+    """helper-function: id of an invalid request line, None if not found"""
+    match = _ID.search(line)
+    if match is None:
+        return None
+    try:
+        return json.loads(match.group(1))
+    except ValueError:
+        return None
+
+
+def _doc_id(index, x):
+    """helper-function: doc_id of a request, if it is a live document of the index"""
+    doc_id = int(x)
+    if not 0 <= doc_id < len(index.files) or index.files[doc_id][0] is None:
+        raise Exception(f"Unknown doc_id: {x}")
+    return doc_id
+
+
+def _answer(index, request, output):
+    """helper-function: response to a request from its ranked documents"""
+    threshold = float(request.get("threshold", 0.0))
+    results = [ [doc_id, index.files[doc_id][0], score] for doc_id, score in output if score >= threshold ]
+    if request.get("limit") is not None:
+        results = results[:int(request["limit"])]
+    return {"id": request.get("id"), "results": results}
+
+
+def run_batch(requests, index=None):
+    """This function answers a batch of requests
+
+    requests for indexed documents with the same options are looked up
+    together using StoredIndex.query_ids. A failing request only fails
+    itself.
+
+    Parameters
+    ----------
+    requests: list
+        list of request dicts, see the module documentation
+    index: storage.StoredIndex, optional
+        index to query. Default: the index opened by the worker process
+
+    Returns
+    -------
+    list
+        response dict of every request, in the given order
+    """
+
+    index = index if index is not None else _index
+    responses = [None] * len(requests)
+    groups = dict()
+    for i, request in enumerate(requests):
+        try:
+            sim_type = request.get("sim_type", "jaccard")
+            estimate = bool(request.get("estimate", False))
+            if "k" in request:
+                x = request["text"] if "text" in request else request.get("doc_id")
+                if x is None:
+                    raise Exception("Request needs a doc_id or a text")
+                if not isinstance(x, str):
+                    x = _doc_id(index, x)
+                k = int(request["k"])
+                responses[i] = _answer(index, request, index.top_k(x, k, sim_type, request.get("estimate", True)))
+            elif "doc_id" in request:
+                _doc_id(index, request["doc_id"])
+                groups.setdefault((sim_type, estimate), []).append(i)
+            elif "text" in request:
+                responses[i] = _answer(index, request, index.query_text(request["text"], sim_type, estimate))
+            else:
+                raise Exception("Request needs a doc_id or a text")
+        except Exception as error:
+            responses[i] = {"id": request.get("id"), "error": str(error)}
+
+    for (sim_type, estimate), positions in groups.items():
+        try:
+            outputs = index.query_ids([ int(requests[i]["doc_id"]) for i in positions ], sim_type, estimate)
+            for i in positions:
+                responses[i] = _answer(index, requests[i], outputs[int(requests[i]["doc_id"])])
+        except Exception as error:
+            for i in positions:
+                responses[i] = {"id": requests[i].get("id"), "error": str(error)}
+    return responses
+
+
+class QueryServer:
+    """asyncio server answering queries against a saved index
+
+    Parameters
+    ----------
+    index_path: str
+        directory of an index written by storage.save_index
+    workers: int, optional
+        no of worker processes. Set to 0 to answer in a thread of the
+        server process. Default: None, no of cpus
+    max_queue: int, optional
+        no of requests which can wait to be answered. Default: 1024
+    batch_size: int, optional
+        most requests answered by a worker at once. Default: 64
+    batch_wait: float, optional
+        seconds to wait for more requests before sending a partial batch.
+        Default: 0.002
+    """
+
+    def __init__(self, index_path, workers=None, max_queue=1024, batch_size=64, batch_wait=0.002):
+        self.index_path = index_path
+        self.workers = workers
+        self.max_queue = max_queue
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.index = None
+        self.server = None
+        # batches being answered, finished ones remove themselves
+        self.running = set()
+
+    async def start(self, host="127.0.0.1", port=8765):
+        """opens the index and starts listening
+
+        Returns
+        -------
+        tuple
+            (host, port) the server listens on, port 0 picks a free port
+        """
+        self.index = storage.load_index(self.index_path)
+        if self.index is None:
+            raise Exception(f"No index found at {self.index_path}")
+        self.executor = self._new_executor()
+        self.queue = asyncio.Queue(self.max_queue)
+        self.in_flight = asyncio.Semaphore(self.workers or (1 if self.workers == 0 else os.cpu_count() or 1))
+        self.batcher = asyncio.create_task(self._batches())
+        self.server = await asyncio.start_server(self._handle, host, port, limit=MAX_LINE)
+        return self.server.sockets[0].getsockname()[:2]
+
+    def _new_executor(self):
+        """helper-function: start the worker pool"""
+        if self.workers == 0:
+            self._run_batch = functools.partial(run_batch, index=self.index)
+            return ThreadPoolExecutor(1)
+        self._run_batch = run_batch
+        return ProcessPoolExecutor(self.workers, initializer=_load_worker, initargs=(self.index_path,))
+
+    async def close(self):
+        """stops listening and shuts the worker pool down"""
+        self.server.close()
+        await self.server.wait_closed()
+        self.batcher.cancel()
+        # waiting for the workers would block the event loop
+        await asyncio.get_running_loop().run_in_executor(
+            None, functools.partial(self.executor.shutdown, cancel_futures=True))
+
+    async def serve_forever(self, host="127.0.0.1", port=8765):
+        """starts the server and answers requests until cancelled"""
+        host, port = await self.start(host, port)
+        print(f"Serving {self.index_path} ({len(self.index.files)} documents) on {host}:{port}")
+        try:
+            await self.server.serve_forever()
+        finally:
+            await self.close()
+
+    async def _handle(self, reader, writer):
+        """helper-function: read the requests of a connection"""
+        lock = asyncio.Lock()
+        # replies still being answered, finished ones remove themselves
+        replies = set()
+        try:
+            while True:
+                try:
+                    line = await reader.readline()
+                except (ValueError, asyncio.LimitOverrunError):
+                    await self._write(writer, lock, {"id": None, "error": f"Request longer than {MAX_LINE} bytes"})
+                    break
+                if not line:
+                    break
+                if not line.strip():
+                    continue
+                try:
+                    request = json.loads(line)
+                    if not isinstance(request, dict):
+                        raise ValueError("request is not an object")
+                except ValueError as error:
+                    await self._write(writer, lock, {"id": _request_id(line), "error": f"Invalid request: {error}"})
+                    continue
+                future = asyncio.get_running_loop().create_future()
+                # waits while the queue is full, which stops reading this connection
+                await self.queue.put((request, future))
+                reply = asyncio.create_task(self._reply(future, writer, lock))
+                replies.add(reply)
+                reply.add_done_callback(replies.discard)
+            await asyncio.gather(*replies)
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def _reply(self, future, writer, lock):
+        """helper-function: send a response once it is ready"""
+        await self._write(writer, lock, await future)
+
+    async def _write(self, writer, lock, response):
+        """helper-function: send one response line"""
+        async with lock:
+            writer.write(json.dumps(response).encode("utf8") + b"\n")
+            await writer.drain()
+
+    async def _batches(self):
+        """helper-function: group queued requests into batches for the workers"""
+        while True:
+            batch = [await self.queue.get()]
+            waited = False
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except asyncio.QueueEmpty:
+                    if waited:
+                        break
+                    waited = True
+                    await asyncio.sleep(self.batch_wait)
+            # atmost one batch per worker, the rest wait in the queue
+            await self.in_flight.acquire()
+            task = asyncio.create_task(self._run(batch))
+            self.running.add(task)
+            task.add_done_callback(self.running.discard)
+
+    async def _run(self, batch):
+        """helper-function: answer a batch in the worker pool"""
+        requests = [ request for request, future in batch ]
+        metrics.observe("server_batch_size", len(requests))
+        executor = self.executor
+        try:
+            with metrics.latency("server_batch_seconds"):
+                responses = await asyncio.get_running_loop().run_in_executor(executor, self._run_batch, requests)
+        except Exception as error:
+            responses = [ {"id": request.get("id"), "error": f"Worker failed: {error!r}"} for request in requests ]
+            if isinstance(error, BrokenExecutor) and executor is self.executor:
+                # a worker process died: replace the pool and keep serving
+                executor.shutdown(wait=False)
+                self.executor = self._new_executor()
+        finally:
+            self.in_flight.release()
+        for (request, future), response in zip(batch, responses):
+            if not future.done():
+                future.set_result(response)
+
+
+class Client:
+    """Blocking client of QueryServer
+
+    Parameters
+    ----------
+    host: str, optional
+        host of the server. Default: 127.0.0.1
+    port: int, optional
+        port of the server. Default: 8765
+    timeout: float, optional
+        socket timeout in seconds. Default: None
+    """
+
+    def __init__(self, host="127.0.0.1", port=8765, timeout=None):
+        self.sock = socket.create_connection((host, port), timeout=timeout)
+        self.stream = self.sock.makefile('rwb')
+        self.next_id = 0
+
+    def request(self, requests):
+        """sends requests and waits for all of their responses
+
+        Parameters
+        ----------
+        requests: list
+            list of request dicts, an id is added to those without one
+
+        Returns
+        -------
+        list
+            response dict of every request, in the given order
+        """
+        ids = []
+        for request in requests:
+            if "id" not in request:
+                request = dict(request, id=f"c{self.next_id}")
+                self.next_id += 1
+            ids.append(request["id"])
+            self.stream.write(json.dumps(request).encode("utf8") + b"\n")
+        self.stream.flush()
+
+        expected = set(ids)
+        responses = dict()
+        while len(responses) < len(ids):
+            line = self.stream.readline()
+            if not line:
+                raise Exception("Connection closed by server")
+            response = json.loads(line)
+            if response.get("id") not in expected:
+                # the server could not tell which request this answers
+                raise Exception(response.get("error", f"Unexpected response: {response}"))
+            responses[response["id"]] = response
+        return [ responses[i] for i in ids ]
+
+    def _results(self, request):
+        response = self.request([request])[0]
+        if "error" in response:
+            raise Exception(response["error"])
+        return response["results"]
+
+    def query_id(self, doc_id, **options):
+        """returns [doc_id, filename, score] lists similar to an indexed document"""
+        return self._results(dict(options, doc_id=doc_id))
+
+    def query_text(self, text, **options):
+        """returns [doc_id, filename, score] lists similar to given text"""
+        return self._results(dict(options, text=text))
+
+    def close(self):
+        self.stream.close()
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve queries against a saved LSH index")
+    parser.add_argument("index", nargs="?", default="corpus.index", help="index directory")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--workers", type=int, default=None,
+                        help="no of worker processes, 0 to answer in the server process")
+    parser.add_argument("--max-queue", type=int, default=1024)
+    parser.add_argument("--batch-size", type=int, default=64)
+    args = parser.parse_args()
+
+    server = QueryServer(args.index, workers=args.workers, max_queue=args.max_queue,
+                         batch_size=args.batch_size)
+    try:
+        asyncio.run(server.serve_forever(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
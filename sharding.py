@@ -0,0 +1,296 @@
+"""
+Index partitioned by doc_id into shards served by separate processes
+
+Every shard owns a contiguous range of doc_ids: its slice of the signature
+matrix and band tables built over that slice only. Shards run in their own
+process and open the saved index memory mapped, so each one only reads the
+columns it owns. A coordinator signs queries once, scatters the signatures
+to all shards and merges their ranked candidates, which every shard has
+already cut down to the k best.
+
+A shard which dies, raises or does not answer within the timeout is left
+out of the merged results, and is listed in ShardedIndex.failed. Shards
+which died or did not answer in time are killed and started again on the
+next query; one which fails to start is left out of that query too.
+
+This module contains the following:
+    * ShardedIndex - coordinator of the shard processes
+"""
+
+import heapq
+import time
+import numpy as np
+from multiprocessing import Pipe, Process
+from multiprocessing.connection import wait
+
+import lsh
+import minhashing
+import statistics
+import storage
+
+
+def _shard_worker(conn, index_path, start, stop):
+    """helper-function: build the tables of a shard and answer its queries
+
+    every query is a (request_id, signatures, k, threshold, exclude) tuple
+    and is answered with (request_id, ranked lists) or (request_id, error
+    message). The ranked lists only hold the k best documents above
+    threshold, leaving out exclude[j] for query j.
+    """
+
+    try:
+        # the shard only needs the signatures, not the documents or shingles
+        manifest, signature_matrix = storage.load_signatures(index_path)
+        # deleted documents are in none of the buckets
+        doc_ids = np.arange(start, min(stop, signature_matrix.shape[1]), dtype=np.int64)
+        doc_ids = doc_ids[~np.isin(doc_ids, np.array(manifest["deleted"], dtype=np.int64))]
+        if isinstance(signature_matrix, minhashing.PackedSignatures):
+            local = signature_matrix.select(doc_ids)
+        else:
+            local = np.asarray(signature_matrix[:, doc_ids])
+        r = manifest["params"]["r"]
+        buckets_list = [ lsh.BandTable.from_keys(band_keys, doc_ids) for band_keys in lsh.band_hash(local, r) ]
+    except Exception as error:
+        conn.send((None, f"{error!r}"))
+        return
+    conn.send((None, "ready"))
+
+    while True:
+        try:
+            message = conn.recv()
+        except EOFError:
+            break
+        if message is None:
+            break
+        request_id, signatures, k, threshold, exclude = message
+        try:
+            packed = isinstance(signatures, minhashing.PackedSignatures)
+            columns = signatures.words if packed else signatures
+            results = []
+            for j, similar_docs in enumerate(lsh.query_batch(signatures, buckets_list, r)):
+                skip = exclude[j] if exclude is not None else None
+                ranked = [ (doc_id, score) for doc_id, score
+                           in statistics.estimate_similarity(np.asarray(columns[:, j]), similar_docs, signature_matrix)
+                           if score >= threshold and doc_id != skip ]
+                # only the k best can be in the merged results
+                results.append(ranked if k is None else ranked[:k])
+            conn.send((request_id, results))
+        except Exception as error:
+            conn.send((request_id, f"{error!r}"))
+
+
+class _Shard:
+    """helper-class: process of a shard and the pipe to it"""
+
+    def __init__(self, shard_id, index_path, start, stop):
+        self.shard_id = shard_id
+        self.index_path = index_path
+        self.start = start
+        self.stop = stop
+        self.process = None
+        self.conn = None
+        self.stale = False  # died or did not answer, so has to be restarted
+
+    def spawn(self):
+        """starts the shard process, without waiting for it"""
+        self.conn, child = Pipe()
+        self.process = Process(target=_shard_worker, args=(child, self.index_path, self.start, self.stop),
+                               daemon=True)
+        self.process.start()
+        child.close()
+
+    def wait_ready(self, timeout):
+        """waits for the shard to build its tables, returns True if it did"""
+        if not self.conn.poll(timeout):
+            return False
+        try:
+            request_id, message = self.conn.recv()
+        except EOFError:
+            return False
+        return message == "ready"
+
+    def alive(self):
+        return self.process is not None and self.process.is_alive()
+
+    def kill(self):
+        if self.process is not None:
+            # a hung shard may not handle SIGTERM
+            self.process.kill()
+            self.process.join()
+        if self.conn is not None:
+            self.conn.close()
+
+
+class ShardedIndex:
+    """Coordinator scattering queries to shard processes
+
+    Parameters
+    ----------
+    index_path: str
+        directory of an index written by storage.save_index
+    no_of_shards: int, optional
+        no of shards, each in its own process. Default: 2
+    timeout: float, optional
+        seconds to wait for the shards to answer a query. Default: 30
+
+    Attributes
+    ----------
+    index: storage.StoredIndex
+        the index, memory mapped, used to sign queries
+    failed: set
+        ids of the shards left out of the results of the last query
+    """
+
+    def __init__(self, index_path, no_of_shards=2, timeout=30.0):
+        self.index = storage.load_index(index_path)
+        if self.index is None:
+            raise Exception(f"No index found at {index_path}")
+        self.timeout = timeout
+        self.failed = set()
+        self.request_id = 0
+
+        bounds = np.linspace(0, len(self.index.files), no_of_shards+1).astype(np.int64)
+        self.shards = [ _Shard(i, index_path, int(bounds[i]), int(bounds[i+1])) for i in range(no_of_shards) ]
+        for shard in self.shards:
+            shard.spawn()
+        for shard in self.shards:
+            if not shard.wait_ready(timeout):
+                self.close()
+                raise Exception(f"Shard {shard.shard_id} failed to start")
+
+    def _restart_stale(self):
+        """helper-function: restart shard processes which died or did not
+        answer the last query, and add the ones which fail to start to failed
+        """
+
+        restarted = [ shard for shard in self.shards if shard.stale or not shard.alive() ]
+        for shard in restarted:
+            print(f"Restarting shard {shard.shard_id}")
+            shard.kill()
+            shard.spawn()
+        for shard in restarted:
+            shard.stale = not shard.wait_ready(self.timeout)
+            if shard.stale:
+                print(f"Shard {shard.shard_id} failed to restart")
+                self.failed.add(shard.shard_id)
+
+    def _scatter(self, signatures, k, threshold, exclude):
+        """helper-function: send a query to all shards and gather answers
+
+        returns the ranked lists of every shard which answered in time.
+        """
+
+        self._restart_stale()
+        self.request_id += 1
+        pending = dict()
+        for shard in self.shards:
+            if shard.stale:
+                continue
+            try:
+                shard.conn.send((self.request_id, signatures, k, threshold, exclude))
+                pending[shard.conn] = shard
+            except (OSError, ValueError):
+                shard.stale = True
+                self.failed.add(shard.shard_id)
+
+        answers = []
+        deadline = time.monotonic() + self.timeout
+        while pending:
+            ready = wait(list(pending), timeout=max(0.0, deadline - time.monotonic()))
+            if not ready:
+                break
+            for conn in ready:
+                shard = pending[conn]
+                try:
+                    request_id, message = conn.recv()
+                except (EOFError, OSError):
+                    shard.stale = True
+                    self.failed.add(shard.shard_id)
+                    del pending[conn]
+                    continue
+                if request_id != self.request_id:
+                    continue    # late answer to an earlier query
+                del pending[conn]
+                if isinstance(message, str):
+                    print(f"Shard {shard.shard_id} failed: {message}")
+                    self.failed.add(shard.shard_id)
+                else:
+                    answers.append(message)
+        for shard in pending.values():
+            print(f"Shard {shard.shard_id} did not answer within {self.timeout}s")
+            shard.stale = True
+            self.failed.add(shard.shard_id)
+        return answers
+
+    def query_batch(self, signatures, k=None, threshold=0.0, exclude=None):
+        """This function finds similar documents for many signatures
+
+        Parameters
+        ----------
+        signatures: numpy.ndarray or minhashing.PackedSignatures
+            query signatures as columns, in the representation of the index
+        k: int, optional
+            no of documents to return per query. Default: all candidates
+        threshold: float, optional
+            minimum estimated similarity of returned documents
+        exclude: list, optional
+            doc_id to leave out of the results of every query
+
+        Returns
+        -------
+        list
+            sorted list of (docid, score) tuples of every query
+        """
+
+        self.failed = set()
+        if exclude is not None:
+            exclude = [ int(doc_id) for doc_id in exclude ]
+        answers = self._scatter(signatures, k, threshold, exclude)
+        results = []
+        for j in range(signatures.shape[1]):
+            # every shard answers an already sorted and filtered list
+            merged = list(heapq.merge(*(answer[j] for answer in answers), key=lambda pair: -pair[1]))
+            results.append(merged if k is None else merged[:k])
+        return results
+
+    def query_ids(self, doc_ids, k=None, threshold=0.0):
+        """finds similar documents of indexed documents, see query_batch
+
+        Returns
+        -------
+        dict
+            maps every doc_id to its sorted list of (docid, score) tuples
+        """
+
+        doc_ids = [ int(doc_id) for doc_id in doc_ids ]
+        signature_matrix = self.index.signature_matrix
+        if isinstance(signature_matrix, minhashing.PackedSignatures):
+            signatures = signature_matrix.select(doc_ids)
+        else:
+            signatures = np.asarray(signature_matrix[:, doc_ids])
+        return dict(zip(doc_ids, self.query_batch(signatures, k, threshold, exclude=doc_ids)))
+
+    def query_text(self, text, k=None, threshold=0.0):
+        """finds indexed documents similar to given text, see query_batch
+        """
+
+        shingles, signature = self.index.sign(text.encode("utf8"))
+        return self.query_batch(signature, k, threshold)[0]
+
+    def close(self):
+        """stops all the shard processes"""
+        for shard in self.shards:
+            try:
+                shard.conn.send(None)
+            except (OSError, ValueError, AttributeError):
+                pass
+        for shard in self.shards:
+            if shard.process is not None:
+                shard.process.join(1)
+            shard.kill()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
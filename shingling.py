@@ -3,15 +3,40 @@ Incidence matrix builder for corpus using shingling
 
 This module contains the following functions:
     * list_files - list the files in the given directory
+    * iter_files - list_files as a generator, walking the directory lazily
     * get_shingle_matrix - returns incidence-matrix of shingle and documents
+    * hash_shingles - fingerprints of all shingles of a document
+    * iter_documents - stream the shingle fingerprints of every document
+
+The incidence matrix is kept sparse: for every document only the ids of the
+shingles it contains are stored (compressed sparse column layout), together
+with a vocabulary mapping each shingle to its row id.
+
+With hashed shingling, the id of a shingle is a 32 or 64-bit fingerprint of
+its bytes computed by a vectorized polynomial hash. No shingle strings are
+created and no vocabulary is kept, so documents can be shingled
+independently of each other.
+
+Hashed shingling can also be streamed: files are found while walking the
+corpus and read in chunks of CHUNK_SIZE bytes, which are normalized and
+hashed one at a time. Consecutive chunks overlap by k-1 bytes, so shingles
+spanning a chunk boundary are kept, and neither the contents nor the
+shingles of a whole document are ever held in memory.
 """
 
-from pandas import DataFrame,read_pickle
 import numpy as np
 import codecs
 import os
-import pickle
-from tqdm import tqdm
+
+import metrics
+
+
+# base of the polynomial hash over shingle bytes (64-bit FNV prime)
+_SHINGLE_BASE = np.uint64(0x100000001b3)
+# odd multiplier of the finalizer spreading the polynomial hash
+_SHINGLE_MIX = np.uint64(0xff51afd7ed558ccd)
+# bytes of a document read at once by streaming ingestion
+CHUNK_SIZE = 1 << 20
 
 
 def list_files(folderpath, extension=".txt"):
@@ -37,60 +62,469 @@ def list_files(folderpath, extension=".txt"):
     """
 
     print(f"Reading corpus: {folderpath}")
+    return list(iter_files(folderpath, extension))
+
+
+def iter_files(folderpath, extension=".txt"):
+    """Generates the corpus files of given folderpath one at a time
+
+    same files and doc_ids as list_files, in the same order, but only one
+    directory listing is held in memory at a time. Directories and files
+    are visited in sorted order, so the doc_ids do not depend on the order
+    the filesystem lists them in.
+
+    Parameters
+    ----------
+    folderpath: str
+        The path to target folder where corpus files exist
+    extension: str, optional
+        File extension of files to be read. Default: .txt
+        set to None to read all files
+
+    Yields
+    ------
+    tuple
+        (filename, doc_id) of every file
+
+    Raises
+    ------
+    Exception
+        if given folder path does not exist
+    """
+
     # check if folder path exists
     if(not os.path.exists(folderpath)):
         raise Exception(f"Given folder path: {folderpath} does not exist")
-        return
-    
-    doc_files = []
+
     i = 0           # index/id to identify each file
 
     if extension == None:
         extension = ""
-    
+
     for (root, dirs, files) in os.walk(folderpath):
-        for f in files:
+        dirs.sort()
+        for f in sorted(files):
             if f.endswith(extension):
-                doc_files.append( (os.path.join(root, f), i) )
+                yield (os.path.join(root, f), i)
                 i += 1
-    
-    return doc_files
-
-def build_matrix(files, k=4, newline=False):
-    """helper-function: build incidence matrix for k-grams (shingles)
-    """
-
-    df = DataFrame(columns=[x[1] for x in files])
-
-    for f in tqdm(files):
-        with codecs.open(f[0], 'r', encoding="utf8", errors='ignore') as doc:
-            # print("reading: "+f[0])
-            data = doc.read()
-            # df[ f[1] ] = 0
-            data = data.lower()             # lowercase all letters
-            data = ' '.join(data.split())   # substiture multiples spaces with single space
-            data = data.replace('\r\n', ' ') # replace windows line endings with space
-            data = data.replace('\r', '')   # remove \r in windows
-            data = data.replace('\t', '')   # remove tab-spaces
-            if newline is False:
-                data = data.replace('\n',' ')
-
-            # st_time = time.time()
-            for i in range(0, len(data)-k+1):
-                shingle = data[i:i+k]
-                if (shingle in df.index) == False:
-                    df.loc[shingle] = [0 for i in range(df.shape[1])]
-                df.at[ shingle, f[1] ] = 1
-            # print(time.time()-st_time)
-    
-    return df
 
 
-def get_shingle_matrix(folderpath, shingle_size=8, extension=".txt"):
+class IncidenceMatrix:
+    """Sparse shingle/document incidence matrix in compressed column form
+
+    The shingle ids of document j are stored sorted in
+    ``indices[indptr[j]:indptr[j+1]]``, so memory grows with the number of
+    non-zero entries instead of shingles x documents. A matrix whose
+    documents were rewritten after it was built, such as an updated index,
+    keeps them in the columns given by columns instead.
+
+    Parameters
+    ----------
+    indptr: numpy.ndarray
+        column pointer array of length no_of_columns+1
+    indices: numpy.ndarray
+        concatenated, per-column sorted shingle ids
+    vocabulary: dict
+        maps every shingle (str) to its row id. None if the ids are
+        fingerprints from hash_shingles
+    columns: numpy.ndarray, optional
+        column of every document. Default: None, document j is column j
+    """
+
+    def __init__(self, indptr, indices, vocabulary, columns=None):
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.indices = np.asarray(indices)
+        self.vocabulary = vocabulary
+        self.columns = columns
+
+    @property
+    def shape(self):
+        """(no of shingles, no of documents)
+
+        for fingerprints, no of shingles is the size of the fingerprint space
+        """
+        if self.vocabulary is None:
+            return (np.iinfo(self.indices.dtype).max + 1, len(self))
+        return (len(self.vocabulary), len(self))
+
+    @property
+    def nnz(self):
+        """no of non-zero entries in the matrix"""
+        return len(self.indices)
+
+    def __len__(self):
+        return len(self.indptr) - 1 if self.columns is None else len(self.columns)
+
+    def __getitem__(self, doc_id):
+        """returns the sorted array of shingle ids present in document doc_id"""
+        column = int(doc_id) if self.columns is None else int(self.columns[doc_id])
+        return self.indices[self.indptr[column]:self.indptr[column+1]]
+
+    def bounds(self, docs):
+        """returns the start and stop of the shingle ids of docs in indices"""
+        docs = np.asarray(docs, dtype=np.int64)
+        columns = docs if self.columns is None else np.asarray(self.columns)[docs]
+        return self.indptr[columns], self.indptr[columns+1]
+
+    def sizes(self):
+        """returns the no of shingles of every document"""
+        if self.columns is None:
+            return np.diff(self.indptr)
+        starts, stops = self.bounds(np.arange(len(self)))
+        return stops - starts
+
+    def compacted(self):
+        """returns the matrix with document j in column j, copying its
+        indices if the documents are in other columns
+        """
+        if self.columns is None:
+            return self
+        starts, stops = self.bounds(np.arange(len(self)))
+        sizes = stops - starts
+        indptr = np.zeros(len(self)+1, dtype=np.int64)
+        np.cumsum(sizes, out=indptr[1:])
+        positions = np.arange(indptr[-1]) - np.repeat(indptr[:-1] - starts, sizes)
+        return IncidenceMatrix(indptr, np.asarray(self.indices)[positions], self.vocabulary)
+
+    def to_csc(self):
+        """returns the matrix as a scipy.sparse.csc_matrix of int32 ones
+        """
+        from scipy.sparse import csc_matrix
+        if self.columns is not None:
+            return self.compacted().to_csc()
+        indices = np.asarray(self.indices)
+        if self.vocabulary is None:
+            # fingerprints are renumbered to consecutive rows
+            unique, indices = np.unique(indices, return_inverse=True)
+            rows = len(unique)
+        else:
+            rows = len(self.vocabulary)
+            if self.nnz:
+                rows = max(rows, int(np.max(indices)) + 1)
+        data = np.ones(self.nnz, dtype=np.int32)
+        return csc_matrix((data, indices, np.asarray(self.indptr)), shape=(rows, len(self)))
+
+    def __repr__(self):
+        rows, cols = self.shape
+        return f"IncidenceMatrix(shingles={rows}, docs={cols}, nnz={self.nnz})"
+
+
+def normalize(data, newline=False):
+    """helper-function: normalize raw document text before shingling
+    """
+
+    data = data.lower()             # lowercase all letters
+    data = ' '.join(data.split())   # substiture multiples spaces with single space
+    data = data.replace('\r\n', ' ') # replace windows line endings with space
+    data = data.replace('\r', '')   # remove \r in windows
+    data = data.replace('\t', '')   # remove tab-spaces
+    if newline is False:
+        data = data.replace('\n',' ')
+    return data
+
+
+def shingle_ids(data, k, vocabulary):
+    """helper-function: returns sorted unique shingle ids of normalized text
+
+    shingles not yet present in vocabulary are added to it.
+    """
+
+    ids = { vocabulary.setdefault(data[i:i+k], len(vocabulary))
+            for i in range(0, len(data)-k+1) }
+    return np.fromiter(sorted(ids), dtype=np.uint32, count=len(ids))
+
+
+def lookup_shingle_ids(data, k, vocabulary):
+    """helper-function: returns sorted unique shingle ids w.r.t fixed vocabulary
+
+    unlike shingle_ids, vocabulary is not modified. Shingles missing from it
+    are given ids from len(vocabulary) onwards, so they never match a shingle
+    of the indexed documents but still count towards the size of the set.
+    """
+
+    unseen = dict()
+    ids = set()
+    for i in range(0, len(data)-k+1):
+        shingle = data[i:i+k]
+        j = vocabulary.get(shingle)
+        if j is None:
+            j = unseen.setdefault(shingle, len(vocabulary) + len(unseen))
+        ids.add(j)
+    return np.fromiter(sorted(ids), dtype=np.uint32, count=len(ids))
+
+
+def normalize_bytes(data):
+    """helper-function: normalize raw document bytes before hashed shingling
+
+    same as normalize, but only ascii letters are lowercased and only ascii
+    whitespace is collapsed.
+    """
+
+    return b' '.join(data.lower().split())
+
+
+def hash_shingles(data, k, bits=32):
+    """This function returns the sorted unique fingerprints of all shingles
+
+    the polynomial hash of every window of k bytes is computed for all
+    windows at once, in k passes over the document.
+
+    Parameters
+    ----------
+    data: bytes or str
+        normalized document, see normalize_bytes. str is encoded as utf8
+    k: int
+        size of shingles in bytes
+    bits: int, optional
+        32 or 64 bit fingerprints. Default: 32
+
+    Returns
+    -------
+    numpy.ndarray
+        sorted unique uint32 or uint64 fingerprints
+    """
+
+    if bits not in (32, 64):
+        raise Exception(f"Fingerprints can be 32 or 64 bits, not {bits}")
+    if isinstance(data, str):
+        data = data.encode("utf8")
+    dtype = np.uint32 if bits == 32 else np.uint64
+    buf = np.frombuffer(data, dtype=np.uint8)
+    n = len(buf) - k + 1
+    if n <= 0:
+        return np.zeros(0, dtype=dtype)
+
+    h = np.zeros(n, dtype=np.uint64)
+    for j in range(k):
+        h *= _SHINGLE_BASE
+        h += buf[j:j+n]
+    # finalize so that all bits depend on every byte of the shingle
+    h ^= h >> np.uint64(33)
+    h *= _SHINGLE_MIX
+    h ^= h >> np.uint64(29)
+    if bits == 32:
+        h = (h >> np.uint64(32)).astype(np.uint32)
+    # sort and drop repeats, which is many times faster than np.unique
+    h.sort()
+    return h[np.concatenate(([True], h[1:] != h[:-1]))]
+
+
+def read_normalized_chunks(path, chunk_size=CHUNK_SIZE):
+    """helper-function: read a document in chunks, normalized as read_bytes
+
+    joining the yielded pieces gives read_bytes(path). Whitespace at the end
+    of a chunk is carried over, so a word split by a chunk boundary is not.
+    """
+
+    started = False     # a piece was yielded already
+    space = False       # whitespace seen since the end of the last piece
+    with open(path, 'rb') as doc:
+        for raw in iter(lambda: doc.read(chunk_size), b""):
+            words = raw.lower().split()
+            if not words:
+                space = True
+                continue
+            piece = b' '.join(words)
+            if started and (space or raw[:1].isspace()):
+                piece = b' ' + piece
+            started = True
+            space = raw[-1:].isspace()
+            yield piece
+
+
+def iter_shingle_hashes(path, k, bits=32, chunk_size=CHUNK_SIZE):
+    """This function streams the shingle fingerprints of a document
+
+    every chunk is hashed along with the last k-1 bytes of the previous
+    one, so together the chunks give every fingerprint of
+    hash_shingles(read_bytes(path), k, bits). A fingerprint can be yielded
+    in more than one chunk.
+
+    Parameters
+    ----------
+    path: str
+        path of the document
+    k: int
+        size of shingles in bytes
+    bits: int, optional
+        32 or 64 bit fingerprints. Default: 32
+    chunk_size: int, optional
+        no of bytes read at once. Default: CHUNK_SIZE
+
+    Yields
+    ------
+    numpy.ndarray
+        sorted unique fingerprints of the shingles of a chunk
+    """
+
+    tail = b""
+    for piece in read_normalized_chunks(path, chunk_size):
+        data = tail + piece
+        if len(data) >= k:
+            yield hash_shingles(data, k, bits)
+        tail = data[max(0, len(data)-k+1):]
+
+
+def iter_documents(folderpath, shingle_size=8, extension=".txt", hash_bits=32, chunk_size=CHUNK_SIZE):
+    """Streams the shingle fingerprints of every document of a corpus
+
+    the corpus is walked lazily and every document is read in chunks, so
+    memory use does not depend on the size of documents or of the corpus.
+    The fingerprints of a document must be consumed before moving on to
+    the next document.
+
+    Parameters
+    ----------
+    folderpath: str
+        The path to target folder where corpus files exist
+    shingle_size: int, optional
+        Size of shingles in bytes. Default: 8
+    extension: str, optional
+        File extension of files to be read. Default: .txt
+        set to None to read all files
+    hash_bits: int, optional
+        32 or 64 bit fingerprints. Default: 32
+    chunk_size: int, optional
+        no of bytes of a document read at once. Default: CHUNK_SIZE
+
+    Yields
+    ------
+    tuple
+        ((filename, doc_id), generator of fingerprint arrays, see
+        iter_shingle_hashes) for every document
+    """
+
+    print(f"Streaming corpus: {folderpath}")
+    for f in iter_files(folderpath, extension):
+        yield f, iter_shingle_hashes(f[0], shingle_size, hash_bits, chunk_size)
+
+
+def read_bytes(path):
+    """helper-function: read and normalize a document as bytes from disk
+    """
+
+    with open(path, 'rb') as doc:
+        return normalize_bytes(doc.read())
+
+
+def read_document(path, newline=False):
+    """helper-function: read and normalize a document from disk
+    """
+
+    with codecs.open(path, 'r', encoding="utf8", errors='ignore') as doc:
+        return normalize(doc.read(), newline)
+
+
+def _to_matrix(columns, vocabulary):
+    """helper-function: stack per-document shingle id arrays into a matrix
+    """
+
+    indptr = np.zeros(len(columns)+1, dtype=np.int64)
+    np.cumsum([len(col) for col in columns], out=indptr[1:])
+    if columns:
+        indices = np.concatenate(columns)
+    else:
+        indices = np.zeros(0, dtype=np.uint32)
+    return IncidenceMatrix(indptr, indices, vocabulary)
+
+
+def build_matrix(files, k=4, newline=False, vocabulary=None):
+    """helper-function: build sparse incidence matrix for k-grams (shingles)
+
+    new shingles are added to the given vocabulary, if any, so the matrix
+    shares its shingle ids with an existing one.
+    """
+
+    vocabulary = dict() if vocabulary is None else vocabulary
+    columns = []
+
+    for f in metrics.progress(files):
+        columns.append(shingle_ids(read_document(f[0], newline), k, vocabulary))
+
+    return _to_matrix(columns, vocabulary)
+
+
+def build_hashed_matrix(files, k=4, bits=32):
+    """helper-function: build sparse incidence matrix of shingle fingerprints
+    """
+
+    columns = [ hash_shingles(read_bytes(f[0]), k, bits) for f in metrics.progress(files) ]
+    matrix = _to_matrix(columns, None)
+    matrix.indices = matrix.indices.astype(np.uint32 if bits == 32 else np.uint64, copy=False)
+    return matrix
+
+
+def _hash_chunk(args):
+    """helper-function: worker to hash the shingles of a slice of files
+    """
+
+    paths, k, bits = args
+    return [ hash_shingles(read_bytes(path), k, bits) for path in paths ]
+
+
+def build_hashed_matrix_parallel(files, k=4, bits=32, parallel=None, chunk_size=64):
+    """helper-function: build_hashed_matrix using a process pool
+
+    fingerprints do not depend on other documents, so slices of files are
+    simply concatenated in file order.
+    """
+
+    from multiprocessing import Pool
+
+    tasks = [ ([f[0] for f in files[i:i+chunk_size]], k, bits)
+              for i in range(0, len(files), chunk_size) ]
+    columns = []
+    with Pool(parallel) as pool:
+        for local_columns in metrics.progress(pool.imap(_hash_chunk, tasks), total=len(tasks)):
+            columns.extend(local_columns)
+    matrix = _to_matrix(columns, None)
+    matrix.indices = matrix.indices.astype(np.uint32 if bits == 32 else np.uint64, copy=False)
+    return matrix
+
+
+def _shingle_chunk(args):
+    """helper-function: worker to shingle a slice of files
+
+    returns shingle ids of each file w.r.t a local vocabulary along with
+    the shingles of that vocabulary in the order of their ids.
+    """
+
+    paths, k, newline = args
+    vocabulary = dict()
+    columns = [ shingle_ids(read_document(path, newline), k, vocabulary) for path in paths ]
+    return columns, list(vocabulary)
+
+
+def build_matrix_parallel(files, k=4, newline=False, parallel=None, chunk_size=64):
+    """helper-function: build sparse incidence matrix using a process pool
+
+    files are split into slices of chunk_size which are shingled by
+    parallel worker processes. Local vocabularies are merged in file order,
+    so the resulting shingle ids are the same as those of build_matrix.
+    """
+
+    from multiprocessing import Pool
+
+    tasks = [ ([f[0] for f in files[i:i+chunk_size]], k, newline)
+              for i in range(0, len(files), chunk_size) ]
+    vocabulary = dict()
+    columns = []
+
+    with Pool(parallel) as pool:
+        for local_columns, local_shingles in metrics.progress(pool.imap(_shingle_chunk, tasks), total=len(tasks)):
+            # map local ids of this slice to global ids
+            remap = np.fromiter((vocabulary.setdefault(sh, len(vocabulary)) for sh in local_shingles),
+                                dtype=np.uint32, count=len(local_shingles))
+            columns.extend(np.sort(remap[col]) for col in local_columns)
+
+    return _to_matrix(columns, vocabulary)
+
+
+def get_shingle_matrix(folderpath, shingle_size=8, extension=".txt", parallel=None, chunk_size=64,
+                       hash_bits=None):
     """Performs shingling and builds incidence index for shingles
 
-    if a already generated pickle file named {foldername}_inc_mat.pickle exists,
-    this function will load it instead
+    to reuse a generated index across runs, see storage.save_index
 
     Parameters
     ----------
@@ -101,38 +535,36 @@ def get_shingle_matrix(folderpath, shingle_size=8, extension=".txt"):
     extension: str, optional
         File extension of files to be read. Default: .txt
         set to None to read all files
-    parallel: no of parallel processes to spawn
-        Only use if hardware supports parallel read. Else, this does not give
-        any speed improvement
+    parallel: int, optional
+        no of parallel processes to spawn. Set to None or 1 to read files
+        serially. Only use if hardware supports parallel read. Else, this
+        does not give any speed improvement. Default: None
+    chunk_size: int, optional
+        no of files handed to a worker process at once. Default: 64
+    hash_bits: int, optional
+        if 32 or 64, shingle ids are fingerprints of this size computed by
+        hash_shingles and no vocabulary is built. Default: None
     
     Returns
     -------
-    pandas.Dataframe
-        dataframe containing rows as shingles and cols as doc_ids
-    """
-
-    # if pickle file exists, then load and return it instead 
-    incidence_matrix = None
-    if os.path.exists(f"{folderpath}_inc_mat.pickle"):
-        incidence_matrix = read_pickle(f"{folderpath}_inc_mat.pickle")
-        if os.path.exists("file_list.pickle"):
-            print(f"Using already created {folderpath}_inc_mat.pickle file")
-            print("using pickled file list")
-            with open("file_list.pickle", 'rb') as file_list_pkl:
-                files = pickle.load(file_list_pkl)
-            return incidence_matrix, files
-        print("file list not found")
+    IncidenceMatrix
+        sparse matrix containing rows as shingles and cols as doc_ids
+    """
 
     # fetch the list of files to be read
     files = list_files(folderpath, extension)
-    # check if parallelism is requested
-    incidence_matrix = build_matrix(files, k=shingle_size)
-
-    print("saving generated incidence index to file...")
-    incidence_matrix.to_pickle(f"{folderpath}_inc_mat.pickle")
-    with open("file_list.pickle", 'wb') as file_list_pkl:
-        pickle.dump(files, file_list_pkl)
-    print(f"saved to {folderpath}_inc_mat.pickle")
+    with metrics.stage("shingling", parallel=parallel) as stage:
+        # check if parallelism is requested
+        if hash_bits is not None and parallel is not None and parallel > 1:
+            incidence_matrix = build_hashed_matrix_parallel(files, shingle_size, hash_bits, parallel, chunk_size)
+        elif hash_bits is not None:
+            incidence_matrix = build_hashed_matrix(files, shingle_size, hash_bits)
+        elif parallel is not None and parallel > 1:
+            incidence_matrix = build_matrix_parallel(files, k=shingle_size, parallel=parallel, chunk_size=chunk_size)
+        else:
+            incidence_matrix = build_matrix(files, k=shingle_size)
+        stage.set(docs=len(files), shingles=incidence_matrix.nnz)
+
     return incidence_matrix, files
 
 
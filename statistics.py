@@ -1,84 +1,152 @@
 """
 includes functions (metrics) required to evaluate Locality Sensitive Hashing.
+
+Exact similarities of all pairs of a corpus can be computed once using
+ground_truth, to evaluate queries without comparing against whole corpus.
 """
 import numpy as np
 
-def jaccard(x, a, signature_matrix):
+import metrics
+from minhashing import PackedSignatures, SimHashSignatures
+
+def _overlap(x, a, incidence_matrix):
+    """helper-function: returns (|x & a|, |x|, |a|) for shingle sets of x and a
+
+    x and a can be docids or sorted arrays of shingle ids.
+    """
+    if not isinstance(x, np.ndarray):
+        x = incidence_matrix[x]
+    if not isinstance(a, np.ndarray):
+        a = incidence_matrix[a]
+    common = np.intersect1d(x, a, assume_unique=True).size
+    return common, x.size, a.size
+
+
+def jaccard(x, a, incidence_matrix):
     """This function finds jaccard similarity between two documents
 
     Parameters
     ----------
     x: int
-        1-d signature array of document with docid=x
+        docid of first document
     a: int
-        1-d signature array of document with docid=a
-    signature_matrix: pandas DataFrame
-        contains signature vectors of all documents as columns
+        docid of second document
+    incidence_matrix: shingling.IncidenceMatrix
+        contains sorted shingle ids of all documents as columns
     
     Returns
     -------
-    int
+    float
         jaccard similarity between documents x and a
     """
-    x = signature_matrix[x]
-    a = signature_matrix[a]
-    return sum(x & a)/sum(x | a)
+    common, x_size, a_size = _overlap(x, a, incidence_matrix)
+    union = x_size + a_size - common
+    if union == 0:
+        return 0.0
+    return common/union
 
 
-def euclid(x, a, signature_matrix):
+def euclid(x, a, incidence_matrix):
     """This function finds euclidean similarity between two documents
 
     Parameters
     ----------
     x: int
-        1-d signature array of document with docid=x
+        docid of first document
     a: int
-        1-d signature array of document with docid=a
-    signature_matrix: pandas DataFrame
-        contains signature vectors of all documents as columns
+        docid of second document
+    incidence_matrix: shingling.IncidenceMatrix
+        contains sorted shingle ids of all documents as columns
     
     Returns
     -------
-    int
+    float
         euclidean distance between documents x and a
     """
-    x = signature_matrix[x]
-    a = signature_matrix[a]
-    return np.sum(a**2 - x**2)**0.5
+    # for 0/1 vectors, squared distance is the size of symmetric difference
+    common, x_size, a_size = _overlap(x, a, incidence_matrix)
+    return (x_size + a_size - 2*common)**0.5
 
-def cosine(x, a, signature_matrix):
+def cosine(x, a, incidence_matrix):
     """This function finds cosine similarity between two documents
 
     Parameters
     ----------
     x: int
-        1-d signature array of document with docid=x
+        docid of first document
     a: int
-        1-d signature array of document with docid=a
-    signature_matrix: pandas DataFrame
-        contains signature vectors of all documents as columns
+        docid of second document
+    incidence_matrix: shingling.IncidenceMatrix
+        contains sorted shingle ids of all documents as columns
     
     Returns
     -------
-    int
+    float
         cosine similarity between documents x and a
     """
-    x = signature_matrix[x]
-    a = signature_matrix[a]
-    return np.dot(a,x)/(np.sum(a**2) * np.sum(x**2))**0.5
+    common, x_size, a_size = _overlap(x, a, incidence_matrix)
+    if x_size == 0 or a_size == 0:
+        return 0.0
+    return common/(x_size * a_size)**0.5
 
 
-def compute_similarity(x, similar_docs, signature_matrix, sim_type="jaccard"):
-    """This function finds cosine similarity between two documents
+def _gather(docs, incidence_matrix):
+    """helper-function: concatenated shingle ids of docs and their sizes
+    """
+    starts, stops = incidence_matrix.bounds(docs)
+    sizes = stops - starts
+    # position of every shingle of every doc in incidence_matrix.indices
+    ends = np.cumsum(sizes)
+    positions = np.arange(ends[-1] if len(ends) else 0) - np.repeat(ends - sizes - starts, sizes)
+    return np.asarray(incidence_matrix.indices)[positions], sizes
+
+
+def _overlaps(x, docs, incidence_matrix):
+    """helper-function: vectorized (|x & a|, |x|, |a|) for every a in docs
+
+    x can be a docid or a sorted array of shingle ids. The shingles of all
+    docs are tested against x at once, so the cost depends on the size of
+    the candidate documents and not on the vocabulary.
+    """
+    if not isinstance(x, np.ndarray):
+        x = incidence_matrix[x]
+    shingles, sizes = _gather(docs, incidence_matrix)
+    hits = np.isin(shingles, x)
+    owner = np.repeat(np.arange(len(docs)), sizes)
+    common = np.bincount(owner, weights=hits, minlength=len(docs))
+    return common, x.size, sizes
+
+
+def _scores(common, x_size, a_size, sim_type):
+    """helper-function: vectorized similarity from overlap counts
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if sim_type == "jaccard":
+            scores = common / (x_size + a_size - common)
+        elif sim_type == "euclid":
+            # for 0/1 vectors, squared distance is the size of symmetric difference
+            scores = np.sqrt(x_size + a_size - 2*common)
+        elif sim_type == "cosine":
+            scores = common / np.sqrt(x_size * a_size)
+        else:
+            raise Exception(f"Unknown sim_type: {sim_type}")
+    return np.nan_to_num(scores, nan=0.0, posinf=0.0)
+
+
+def compute_similarity(x, similar_docs, incidence_matrix, sim_type="jaccard"):
+    """This function finds similarity of a document to its candidates
+
+    all candidates are scored together by intersecting their sorted
+    shingle ids with those of x.
 
     Parameters
     ----------
     x: int
-        1-d signature array of document with docid=x
+        docid of the query document
     similar_docs: list
         a list of docids which are similar to x.
-    signature_matrix: pandas DataFrame
-        contains signature vectors of all documents as columns
+    incidence_matrix: shingling.IncidenceMatrix
+        contains sorted shingle ids of all documents as columns
     sim_type: string
         can take values jaccard, euclid, cosine. 
 
@@ -87,16 +155,182 @@ def compute_similarity(x, similar_docs, signature_matrix, sim_type="jaccard"):
     list
         sorted list of (docid, score) tuples.
     """
-    if sim_type == "jaccard": sim_fun = jaccard
-    elif sim_type == "euclid": sim_fun = euclid
-    elif sim_type == "cosine": sim_fun = cosine
-    # write for all other funcs
-    ranked_list = []
-    for i in similar_docs:
-        if i == x: continue
-        score = sim_fun(x, i, signature_matrix)
-        ranked_list.append((i, score))
-    
+    docs = np.array([ i for i in similar_docs if i != x ], dtype=np.int64)
+    with metrics.latency("rerank_seconds", sim_type=sim_type):
+        common, x_size, a_size = _overlaps(x, docs, incidence_matrix)
+        ranked_list = list(zip(docs.tolist(), _scores(common, x_size, a_size, sim_type).tolist()))
+    return _rank(ranked_list, sim_type)
+
+
+def compute_similarity_to(shingles, similar_docs, incidence_matrix, sim_type="jaccard"):
+    """This function ranks documents by similarity to a set of shingles
+
+    used for query documents which are not part of the incidence matrix.
+
+    Parameters
+    ----------
+    shingles: numpy.ndarray
+        sorted unique shingle ids of the query document
+    similar_docs: list
+        a list of docids which are similar to the query.
+    incidence_matrix: shingling.IncidenceMatrix
+        contains sorted shingle ids of all documents as columns
+    sim_type: string
+        can take values jaccard, euclid, cosine. 
+
+    Returns
+    -------
+    list
+        sorted list of (docid, score) tuples.
+    """
+    docs = np.array(list(similar_docs), dtype=np.int64)
+    with metrics.latency("rerank_seconds", sim_type=sim_type):
+        common, x_size, a_size = _overlaps(np.asarray(shingles), docs, incidence_matrix)
+        ranked_list = list(zip(docs.tolist(), _scores(common, x_size, a_size, sim_type).tolist()))
+    return _rank(ranked_list, sim_type)
+
+
+def estimate_similarity(x, similar_docs, signature_matrix):
+    """This function estimates jaccard similarity of x to its candidates
+
+    the estimate is the fraction of minhash signature rows on which the
+    documents agree, computed for all candidates in one comparison. Cost
+    depends only on the signature length. For b-bit signatures, the
+    fraction is corrected for random collisions, see bbit_similarity. For
+    simhash signatures, cosine similarity is estimated instead, see
+    simhash_similarity.
+
+    Parameters
+    ----------
+    x: int or numpy.ndarray
+        docid of the query document, or its signature (packed words of it
+        for b-bit signatures)
+    similar_docs: list
+        a list of docids which are similar to x.
+    signature_matrix: numpy.ndarray or minhashing.PackedSignatures
+        signatures of all documents as columns
+
+    Returns
+    -------
+    list
+        sorted list of (docid, score) tuples.
+    """
+    packed = isinstance(signature_matrix, PackedSignatures)
+    if isinstance(x, np.ndarray):
+        signature = x
+        docs = np.array(list(similar_docs), dtype=np.int64)
+    else:
+        columns = signature_matrix.words if packed else signature_matrix
+        signature = np.asarray(columns[:, int(x)])
+        docs = np.array([ i for i in similar_docs if i != x ], dtype=np.int64)
+    with metrics.latency("rerank_seconds", sim_type="estimate"):
+        if packed:
+            agreement = _packed_similarity(signature_matrix.agreement(signature, docs) / signature_matrix.n,
+                                           signature_matrix)
+        else:
+            agreement = np.mean(np.asarray(signature_matrix[:, docs]) == signature[:, None], axis=0)
+    return _rank(list(zip(docs.tolist(), agreement.tolist())), "jaccard")
+
+
+def pair_similarity(pairs, signature_matrix, block_size=1 << 16):
+    """This function estimates jaccard similarity of pairs of documents
+
+    cosine similarity for simhash signatures, see estimate_similarity.
+
+    Parameters
+    ----------
+    pairs: list or numpy.ndarray
+        list of (docid, docid) tuples, or an array of shape (no_of_pairs, 2)
+    signature_matrix: numpy.ndarray or minhashing.PackedSignatures
+        signatures of all documents as columns
+    block_size: int, optional
+        no of pairs compared at once. Default: 65536
+
+    Returns
+    -------
+    numpy.ndarray
+        estimated similarity of every pair, in the given order
+    """
+    pairs = np.asarray(pairs if isinstance(pairs, np.ndarray) else list(pairs), dtype=np.int64).reshape(-1, 2)
+    scores = np.empty(len(pairs))
+    if isinstance(signature_matrix, PackedSignatures):
+        words = np.asarray(signature_matrix.words)
+        for i in range(0, len(pairs), block_size):
+            block = pairs[i:i+block_size]
+            agreement = signature_matrix.agreement(words[:, block[:, 0]], block[:, 1])
+            scores[i:i+block_size] = agreement / signature_matrix.n
+        return _packed_similarity(scores, signature_matrix)
+    signature_matrix = np.asarray(signature_matrix)
+    for i in range(0, len(pairs), block_size):
+        block = pairs[i:i+block_size]
+        scores[i:i+block_size] = np.mean(signature_matrix[:, block[:, 0]] == signature_matrix[:, block[:, 1]], axis=0)
+    return scores
+
+
+def bbit_similarity(agreement, bits):
+    """This function estimates jaccard similarity from b-bit signatures
+
+    two different minhash values still agree on their lowest b bits with
+    probability 1/2^b, so the fraction of agreeing values P relates to the
+    jaccard similarity J as P = 1/2^b + (1 - 1/2^b) J. This is the estimator
+    of Li and Konig for shingle sets much smaller than the shingle space.
+
+    Parameters
+    ----------
+    agreement: numpy.ndarray
+        fraction of b-bit signature values on which documents agree
+    bits: int
+        no of bits kept of every value
+
+    Returns
+    -------
+    numpy.ndarray
+        estimated jaccard similarity, clipped to [0, 1]
+    """
+    chance = 1.0 / (1 << bits)
+    return np.clip((np.asarray(agreement, dtype=np.float64) - chance) / (1 - chance), 0.0, 1.0)
+
+
+def simhash_similarity(agreement):
+    """This function estimates cosine similarity from simhash signatures
+
+    a random hyperplane separates two vectors with probability angle/pi,
+    so the fraction of agreeing bits P gives the angle as pi (1 - P).
+
+    Parameters
+    ----------
+    agreement: numpy.ndarray
+        fraction of simhash bits on which documents agree
+
+    Returns
+    -------
+    numpy.ndarray
+        estimated cosine similarity, cos(pi (1 - P)) clipped to [0, 1]
+    """
+    return np.clip(np.cos(np.pi * (1 - np.asarray(agreement, dtype=np.float64))), 0.0, 1.0)
+
+
+def _packed_similarity(agreement, signature_matrix):
+    """helper-function: similarity estimate from the agreement of packed
+    signatures
+    """
+    if isinstance(signature_matrix, SimHashSignatures):
+        return simhash_similarity(agreement)
+    return bbit_similarity(agreement, signature_matrix.bits)
+
+
+def _sim_function(sim_type):
+    """helper-function: returns the similarity function of given sim_type
+    """
+    if sim_type == "jaccard": return jaccard
+    elif sim_type == "euclid": return euclid
+    elif sim_type == "cosine": return cosine
+    raise Exception(f"Unknown sim_type: {sim_type}")
+
+
+def _rank(ranked_list, sim_type):
+    """helper-function: sorts (docid, score) tuples, most similar first
+    """
     if sim_type == "euclid":
         return sorted(ranked_list, key=lambda x: x[1], reverse=False)
     else:
@@ -122,7 +356,7 @@ def precision(threshold, output):
     return len(req)/len(output)
 
 
-def recall(threshold, x, size, output, signature_matrix, sim_type):
+def recall(threshold, x, size, output, incidence_matrix, sim_type, ground_truth=None):
     """This function finds cosine similarity between two documents
 
     Parameters
@@ -130,29 +364,210 @@ def recall(threshold, x, size, output, signature_matrix, sim_type):
     threshold: float
         value of similarity above which retrieved docs are considered relevant
     x: int
-        1-d signature array of document with docid=x
+        docid of the query document
     size: int
         number of all documents in the corpus
     output: list
         a list of retrieved items.
-    signature_matrix: pandas DataFrame
-        contains signature vectors of all documents as columns
+    incidence_matrix: shingling.IncidenceMatrix
+        contains sorted shingle ids of all documents as columns
     sim_type: string
         can take values jaccard, euclid, cosine. 
+    ground_truth: GroundTruth, optional
+        precomputed jaccard similarities of the corpus. If given, it is used
+        instead of comparing x with whole corpus, when it covers threshold
 
     Returns
     -------
     float
         recall value for the given set of retrieved items.
     """
-    docs = compute_similarity(x, [ i for i in range(size) ], signature_matrix, sim_type)
     req = [ i for f, i in output if i>=threshold ]
-    den = [ i for f, i in docs if i>=threshold and f!=x ]
+    if ground_truth is not None and sim_type == "jaccard" and ground_truth.covers(threshold):
+        den = ground_truth.relevant(x, threshold)
+    else:
+        docs = compute_similarity(x, [ i for i in range(size) ], incidence_matrix, sim_type)
+        den = [ i for f, i in docs if i>=threshold and f!=x ]
     if len(den) == 0:
         return "not defined"
     return len(req)/len(den)
 
 
+class GroundTruth:
+    """Exact jaccard similarities of all pairs of a corpus above a threshold
+
+    Built once by ground_truth, it answers precision, recall and f1 of any
+    query or of the whole corpus for thresholds >= min_threshold without
+    scanning the corpus again.
+
+    Parameters
+    ----------
+    no_of_docs: int
+        no of documents in the corpus
+    x, a: numpy.ndarray
+        docids of every pair, with x < a
+    scores: numpy.ndarray
+        jaccard similarity of every pair
+    min_threshold: float
+        pairs below this similarity are not stored
+    """
+
+    def __init__(self, no_of_docs, x, a, scores, min_threshold):
+        self.no_of_docs = int(no_of_docs)
+        self.x = np.asarray(x, dtype=np.int64)
+        self.a = np.asarray(a, dtype=np.int64)
+        self.scores = np.asarray(scores, dtype=np.float64)
+        self.min_threshold = float(min_threshold)
+        # symmetric adjacency to look up the pairs of a single doc
+        src = np.concatenate([self.x, self.a])
+        order = np.argsort(src, kind='stable')
+        self._neighbors = np.concatenate([self.a, self.x])[order]
+        self._neighbor_scores = np.concatenate([self.scores, self.scores])[order]
+        self._indptr = np.zeros(self.no_of_docs+1, dtype=np.int64)
+        np.cumsum(np.bincount(src, minlength=self.no_of_docs), out=self._indptr[1:])
+
+    def covers(self, threshold):
+        """whether all pairs with similarity >= threshold are stored"""
+        return threshold >= self.min_threshold
+
+    def _check(self, threshold):
+        if not self.covers(threshold):
+            raise Exception(f"threshold {threshold} is below min_threshold {self.min_threshold} of ground truth")
+
+    def similar(self, doc_id, threshold):
+        """sorted list of (docid, score) of documents similar to doc_id
+        """
+        self._check(threshold)
+        start, stop = self._indptr[doc_id], self._indptr[doc_id+1]
+        scores = self._neighbor_scores[start:stop]
+        keep = scores >= threshold
+        return _rank(list(zip(self._neighbors[start:stop][keep].tolist(), scores[keep].tolist())), "jaccard")
+
+    def relevant(self, doc_id, threshold):
+        """list of docids with similarity >= threshold to doc_id
+        """
+        return [ i for i, score in self.similar(doc_id, threshold) ]
+
+    def evaluate(self, doc_id, retrieved, threshold):
+        """precision, recall and f1 of documents retrieved for doc_id
+
+        Parameters
+        ----------
+        doc_id: int
+            docid of the query document
+        retrieved: list
+            docids retrieved for the query
+        threshold: float
+            similarity above which documents are considered relevant
+
+        Returns
+        -------
+        dict
+            precision, recall and f1. A measure is None if not defined
+        """
+        relevant = set(self.relevant(doc_id, threshold))
+        retrieved = set(retrieved) - {doc_id}
+        return _measures(len(retrieved & relevant), len(retrieved), len(relevant))
+
+    def report(self, candidate_pairs, threshold):
+        """corpus level precision, recall and f1 of candidate pairs
+
+        Parameters
+        ----------
+        candidate_pairs: iterable or numpy.ndarray
+            (docid, docid) pairs retrieved, e.g. by lsh.bucket_pairs
+        threshold: float
+            similarity above which pairs are considered relevant
+
+        Returns
+        -------
+        dict
+            precision, recall, f1 along with no of retrieved, relevant
+            and true positive pairs
+        """
+        self._check(threshold)
+        if not isinstance(candidate_pairs, np.ndarray):
+            candidate_pairs = list(candidate_pairs)
+        pairs = np.asarray(candidate_pairs, dtype=np.int64).reshape(-1, 2)
+        pairs = np.unique(np.sort(pairs, axis=1), axis=0)
+        keep = self.scores >= threshold
+        relevant = self.x[keep] * self.no_of_docs + self.a[keep]
+        retrieved = pairs[:, 0] * self.no_of_docs + pairs[:, 1]
+        hits = int(np.isin(retrieved, relevant).sum())
+        measures = _measures(hits, len(retrieved), len(relevant))
+        measures.update(threshold=threshold, retrieved=len(retrieved), relevant=len(relevant), true_positives=hits)
+        return measures
+
+    def save(self, path):
+        """saves the ground truth to a .npz file"""
+        with open(path, 'wb') as truth_file:
+            np.savez(truth_file, no_of_docs=self.no_of_docs, x=self.x, a=self.a,
+                     scores=self.scores, min_threshold=self.min_threshold)
+
+    @classmethod
+    def load(cls, path):
+        """loads a ground truth saved using save"""
+        with np.load(path) as data:
+            return cls(data["no_of_docs"], data["x"], data["a"], data["scores"], data["min_threshold"])
+
+
+def _measures(hits, retrieved, relevant):
+    """helper-function: precision, recall and f1 from counts
+    """
+    precision = hits/retrieved if retrieved else None
+    recall = hits/relevant if relevant else None
+    f1 = None
+    if precision and recall:
+        f1 = 2*precision*recall/(precision+recall)
+    return {"precision": precision, "recall": recall, "f1": f1}
+
+
+def ground_truth(incidence_matrix, min_threshold=0.1, block_size=1024, exclude=None):
+    """This function computes exact jaccard similarity of all document pairs
+
+    Intersections are computed by sparse matrix products of the transposed
+    incidence matrix with itself, a block of documents at a time.
+
+    Parameters
+    ----------
+    incidence_matrix: shingling.IncidenceMatrix
+        contains sorted shingle ids of all documents as columns
+    min_threshold: float, optional
+        only pairs with similarity >= min_threshold are kept. Default: 0.1
+    block_size: int, optional
+        no of documents multiplied at once. Default: 1024
+    exclude: set, optional
+        doc_ids left out of all pairs, e.g. deleted documents. Default: None
+
+    Returns
+    -------
+    GroundTruth
+        similarities of all pairs above min_threshold
+    """
+    matrix = incidence_matrix.to_csc()
+    rows = matrix.T.tocsr()
+    sizes = incidence_matrix.sizes()
+    no_of_docs = matrix.shape[1]
+    exclude = np.array(sorted(exclude) if exclude else [], dtype=np.int64)
+
+    xs, as_, scores = [], [], []
+    for start in range(0, no_of_docs, block_size):
+        common = (rows[start:start+block_size] @ matrix).tocoo()
+        x = common.row.astype(np.int64) + start
+        a = common.col.astype(np.int64)
+        upper = a > x
+        x, a, common = x[upper], a[upper], common.data[upper].astype(np.float64)
+        score = common / (sizes[x] + sizes[a] - common)
+        keep = (score >= min_threshold) & ~np.isin(x, exclude) & ~np.isin(a, exclude)
+        xs.append(x[keep])
+        as_.append(a[keep])
+        scores.append(score[keep])
+
+    empty = [np.zeros(0, dtype=np.int64)]
+    return GroundTruth(no_of_docs, np.concatenate(xs + empty), np.concatenate(as_ + empty),
+                       np.concatenate(scores + [np.zeros(0)]), min_threshold)
+
+
 def get_file_name(file_id, files):
     """This function finds cosine similarity between two documents
 
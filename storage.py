@@ -0,0 +1,1030 @@
+"""
+Versioned on-disk format for the generated LSH index
+
+An index is stored as a directory containing:
+    * manifest.json - format version, parameters used to build the index,
+        corpus fingerprints, deleted doc_ids and the layout (dtype, shape)
+        of every array
+    * documents.jsonl - document table, a [doc_id, record] line with path,
+        size, modification time and sha256 of every doc_id. A later line
+        replaces an earlier one, the record is null for deleted documents
+    * vocabulary.jsonl - shingles of the incidence matrix, a line per shingle
+        in order of their ids. Not written if shingle ids are fingerprints
+    * *.bin - raw arrays: incidence matrix, signature matrix a document
+        after the other, and the band bucket tables as sorted key/doc_id
+        arrays. Indexes built by streaming ingestion have no incidence matrix
+
+Raw arrays are opened using numpy.memmap, so loading an index does not read
+it into memory. The vocabulary is only read once a query document has to
+be shingled with it. The manifest is checked against the requested parameters and
+the corpus, so a stale index is detected and rebuilt instead of being used.
+
+An index can also be brought up to date incrementally: the corpus folder is
+diffed against the document table, and only added or modified files are
+shingled and signed. Added files get new doc_ids, modified ones keep theirs,
+and doc_ids of deleted files are not reused. Signatures of added files are
+appended to the signature matrix and those of modified files overwrite their
+column. Shingles of both are appended to the incidence matrix, as new
+columns which the manifest maps their doc_ids to. New vocabulary and
+document records are appended too. Band table entries of changed files are
+kept in separate delta tables, their entries in the band tables are skipped,
+and deleted doc_ids are listed in the manifest.
+
+Writing the manifest commits an update, data past the sizes it records is
+overwritten by the next one. If an update does not complete, the document
+records of its modified files are not committed either, so the next update
+signs them again. Once the delta tables and skipped entries grow past
+COMPACT_FRACTION of the band tables, the index is compacted: rewritten with
+the delta tables merged.
+
+This module contains the following functions:
+    * corpus_fingerprint - fingerprints of the files of a corpus
+    * file_record - document table entry of a file
+    * diff_corpus - changes of the corpus since the index was saved
+    * update_index - bring an index up to date with its corpus
+    * compact_index - merge the changes of updates into the band tables
+    * save_index - write a generated index to a directory
+    * load_index - open an index directory if it is up to date
+    * load_signatures - open only the signature matrix of an index directory
+"""
+
+import hashlib
+import itertools
+import json
+import os
+import shutil
+import time
+from collections import namedtuple
+from collections.abc import Mapping
+import numpy as np
+
+import lsh
+import metrics
+import minhashing
+import shingling
+import statistics
+from shingling import IncidenceMatrix
+
+
+FORMAT_VERSION = 5
+MANIFEST = "manifest.json"
+DOCUMENTS = "documents.jsonl"
+VOCABULARY = "vocabulary.jsonl"
+# ground truth cached in the index directory by main.get_ground_truth,
+# removed by updates
+GROUND_TRUTH = "ground_truth.npz"
+# size of the delta tables and skipped entries, as a fraction of the band
+# tables, above which update_index compacts the index
+COMPACT_FRACTION = 0.25
+
+# added: doc_ids given to new files
+# modified: doc_ids of files whose contents changed
+# deleted: doc_ids of files which no longer exist
+# records: document table after the changes
+CorpusDiff = namedtuple("CorpusDiff", ["added", "modified", "deleted", "records"])
+
+
+class _Vocabulary(Mapping):
+    """helper-class: vocabulary of a stored index, read from vocabulary.jsonl
+    on first use. Its size is kept in the manifest, so len() does not read it
+    """
+
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+        self._ids = None
+
+    def _load(self):
+        if self._ids is None:
+            with open(self.path, 'r', encoding="utf8") as vocabulary:
+                lines = itertools.islice(vocabulary, self.size)
+                self._ids = { json.loads(line): i for i, line in enumerate(lines) }
+        return self._ids
+
+    def __getitem__(self, shingle):
+        return self._load()[shingle]
+
+    def get(self, shingle, default=None):
+        return self._load().get(shingle, default)
+
+    def __contains__(self, shingle):
+        return shingle in self._load()
+
+    def __iter__(self):
+        return iter(self._load())
+
+    def __len__(self):
+        return self.size
+
+
+class StoredIndex:
+    """Index loaded from disk
+
+    Documents which are not part of the index can be queried using
+    query_text and query_file. They are shingled and minhashed with the
+    exact parameters of the index, and the index is not modified.
+
+    Attributes
+    ----------
+    path: str
+        directory the index was loaded from
+    manifest: dict
+        contents of manifest.json
+    files: list
+        list of (filename, doc_id) tuples, as returned by shingling.list_files.
+        filename is None for doc_ids of deleted documents
+    records: list
+        document table entry of every doc_id, see file_record
+    incidence_matrix: shingling.IncidenceMatrix
+        memory mapped incidence matrix, None if the index was streamed. Only
+        estimated jaccard similarity is available then
+    signature_matrix: numpy.memmap or minhashing.PackedSignatures
+        memory mapped signature matrix, minhashing.SimHashSignatures for
+        scheme "simhash"
+    buckets_list: list
+        list of lsh.BandTable, one per band
+    """
+
+    def __init__(self, path, manifest, files, incidence_matrix, signature_matrix, buckets_list, records=None):
+        self.path = path
+        self.manifest = manifest
+        self.files = files
+        self.records = records
+        self.incidence_matrix = incidence_matrix
+        self.signature_matrix = signature_matrix
+        self.buckets_list = buckets_list
+        self._hash_params = None
+        self._forest = None
+        self._deleted = None
+
+    @property
+    def params(self):
+        """parameters the index was built with"""
+        return self.manifest["params"]
+
+    @property
+    def deleted(self):
+        """doc_ids of deleted documents, which are in none of the buckets"""
+        if self._deleted is None:
+            self._deleted = set(self.manifest["deleted"])
+        return self._deleted
+
+    @property
+    def hash_params(self):
+        """hash functions the signatures of the index were generated with"""
+        if self._hash_params is None:
+            self._hash_params = minhashing.generate_hash_functions(
+                self.params["no_of_hash_functions"], self.params["seed"])
+        return self._hash_params
+
+    @property
+    def forest(self):
+        """lsh.LSHForest over the signatures of live documents, built on first use"""
+        if self._forest is None:
+            doc_ids = None
+            if self.deleted:
+                doc_ids = [ doc_id for filename, doc_id in self.files if filename is not None ]
+            self._forest = lsh.LSHForest.from_signature_matrix(self.signature_matrix, seed=self.params["seed"],
+                                                               doc_ids=doc_ids)
+        return self._forest
+
+    def _shingles(self, data):
+        """shingle ids of raw document bytes as used by the index"""
+        k = self.params["shingle_size"]
+        if self.params.get("hash_bits") is not None:
+            return shingling.hash_shingles(shingling.normalize_bytes(data), k, self.params["hash_bits"])
+        text = shingling.normalize(data.decode("utf8", errors="ignore"))
+        return shingling.lookup_shingle_ids(text, k, self.incidence_matrix.vocabulary)
+
+    def sign(self, data):
+        """shingle ids and signature of raw document bytes
+
+        for b-bit signatures, the signature is a PackedSignatures of one doc.
+        """
+        shingles = self._shingles(data)
+        if self.params.get("scheme", "minhash") == "simhash":
+            return shingles, minhashing.simhash_signature(shingles, self.params["no_of_hash_functions"],
+                                                          self.params["seed"])
+        if self.params.get("scheme", "minhash") == "oph":
+            signature = minhashing.oph_signature(shingles, self.params["no_of_hash_functions"],
+                                                 self.params["seed"])
+        else:
+            signature = minhashing.minhash(shingles, self.hash_params)
+        if self.params.get("signature_bits") is not None:
+            return shingles, minhashing.PackedSignatures.from_signatures(signature[:, None],
+                                                                        self.params["signature_bits"])
+        return shingles, signature[:, None]
+
+    @property
+    def estimated_sim_type(self):
+        """sim_type estimated from the signatures: cosine for simhash, else
+        jaccard
+        """
+        return "cosine" if self.params.get("scheme") == "simhash" else "jaccard"
+
+    def _rank(self, x, similar_docs, sim_type, estimate):
+        """similarity of candidates to doc_id x, or to (shingles, signature)"""
+        if self.incidence_matrix is None:
+            if sim_type != self.estimated_sim_type:
+                raise Exception(f"Index {self.path} has no incidence matrix for {sim_type} similarity")
+            estimate = True
+        if isinstance(x, tuple):
+            shingles, signature = x
+            if estimate and sim_type == self.estimated_sim_type:
+                packed = isinstance(signature, minhashing.PackedSignatures)
+                column = signature.words[:, 0] if packed else signature[:, 0]
+                return statistics.estimate_similarity(column, similar_docs, self.signature_matrix)
+            return statistics.compute_similarity_to(shingles, similar_docs, self.incidence_matrix, sim_type)
+        if estimate and sim_type == self.estimated_sim_type:
+            return statistics.estimate_similarity(x, similar_docs, self.signature_matrix)
+        return statistics.compute_similarity(x, similar_docs, self.incidence_matrix, sim_type)
+
+    def _query(self, data, sim_type, estimate):
+        shingles, signature = self.sign(data)
+        similar_docs = lsh.query_batch(signature, self.buckets_list, self.params["r"])[0]
+        return self._rank((shingles, signature), similar_docs, sim_type, estimate)
+
+    def top_k(self, x, k=10, sim_type="jaccard", estimate=True, candidates=2):
+        """finds the k most similar documents using the LSH forest
+
+        unlike the other queries, this always returns k documents (if the
+        index has that many) however dissimilar they are.
+
+        Parameters
+        ----------
+        x: int or str
+            doc_id of an indexed document, or raw text of a query document
+        k: int, optional
+            no of documents to return. Default: 10
+        sim_type: string, optional
+            can take values jaccard, euclid, cosine
+        estimate: bool, optional
+            if True, similarity of estimated_sim_type is estimated from the signatures.
+            Default: True
+        candidates: int, optional
+            candidates*k documents are ranked to pick the top k. Default: 2
+
+        Returns
+        -------
+        list
+            sorted list of atmost k (docid, score) tuples
+        """
+        if isinstance(x, str):
+            x = self.sign(x.encode("utf8"))
+            signature = x[1]
+            exclude = set()
+        else:
+            x = int(x)
+            if isinstance(self.signature_matrix, minhashing.PackedSignatures):
+                signature = self.signature_matrix.select([x])
+            else:
+                signature = np.asarray(self.signature_matrix[:, [x]])
+            exclude = {x}
+        if isinstance(signature, minhashing.PackedSignatures):
+            signature = signature.unpack()
+        similar_docs = self.forest.query(signature[:, 0], candidates*k + len(exclude)) - exclude
+        return self._rank(x, similar_docs, sim_type, estimate)[:k]
+
+    def query_ids(self, doc_ids, sim_type="jaccard", estimate=False):
+        """finds similar documents for indexed documents, all at once
+
+        Parameters
+        ----------
+        doc_ids: list
+            doc_ids of indexed documents
+        sim_type: string, optional
+            can take values jaccard, euclid, cosine
+        estimate: bool, optional
+            if True, similarity of estimated_sim_type is estimated from the signatures
+            instead of computed from the shingles. Default: False
+
+        Returns
+        -------
+        dict
+            maps every doc_id to its sorted list of (docid, score) tuples
+        """
+        candidates = lsh.find_similar_docs_batch(doc_ids, self.buckets_list, self.signature_matrix,
+                                                 self.params["r"])
+        return { doc_id: self._rank(doc_id, similar_docs, sim_type, estimate)
+                 for doc_id, similar_docs in candidates.items() }
+
+    def query_text(self, text, sim_type="jaccard", estimate=False):
+        """finds indexed documents similar to given text
+
+        Parameters
+        ----------
+        text: str
+            raw contents of the query document
+        sim_type: string, optional
+            can take values jaccard, euclid, cosine
+        estimate: bool, optional
+            if True, similarity of estimated_sim_type is estimated from the signatures
+            instead of computed from the shingles. Default: False
+
+        Returns
+        -------
+        list
+            sorted list of (docid, score) tuples
+        """
+        return self._query(text.encode("utf8"), sim_type, estimate)
+
+    def query_file(self, path, sim_type="jaccard", estimate=False):
+        """finds indexed documents similar to the file at given path
+
+        see query_text
+        """
+        with open(path, 'rb') as doc:
+            return self._query(doc.read(), sim_type, estimate)
+
+
+def corpus_fingerprint(files, content=False):
+    """This function computes a fingerprint of the corpus files
+
+    files are taken in order of their path and their doc_ids are not used,
+    as those of an updated index differ from the ones given by list_files.
+
+    Parameters
+    ----------
+    files: list
+        list of (filename, doc_id) tuples, as returned by shingling.list_files
+    content: bool, optional
+        if True, hash the contents of each file. Else, only their path, size
+        and modification time are used, which does not read the files.
+        Default: False
+
+    Returns
+    -------
+    str
+        hex digest of the corpus
+    """
+
+    entries = []
+    for filename in sorted(filename for filename, doc_id in files):
+        if content:
+            entries.append((filename, _file_digest(filename)))
+        else:
+            stat = os.stat(filename)
+            entries.append((filename, stat.st_size, stat.st_mtime_ns))
+    return _corpus_digest(entries)
+
+
+def _corpus_digest(entries):
+    """helper-function: hex digest of a list of tuples of file attributes"""
+    digest = hashlib.sha256()
+    for entry in entries:
+        digest.update("".join(f"{value}\0" for value in entry).encode("utf8", errors="surrogateescape"))
+    return digest.hexdigest()
+
+
+def _file_digest(path):
+    """helper-function: sha256 of the contents of a file"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as doc:
+        for block in iter(lambda: doc.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def file_record(path):
+    """This function gives the document table entry of a file
+
+    Returns
+    -------
+    dict
+        path, size, mtime_ns (modification time) and sha256 of the file
+    """
+
+    stat = os.stat(path)
+    return {"path": path, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha256": _file_digest(path)}
+
+
+def _write_array(index_path, name, array, order="C"):
+    """helper-function: write array as a raw file and return its layout
+
+    arrays of order "F" are written a column after the other, so that
+    columns can be appended.
+    """
+
+    array = np.asarray(array)
+    np.ascontiguousarray(array.T if order == "F" else array).tofile(os.path.join(index_path, name))
+    return {"file": name, "dtype": array.dtype.str, "shape": list(array.shape), "order": order}
+
+
+def _append_array(index_path, layout, array):
+    """helper-function: append array to a file written by _write_array and
+    return the new layout
+
+    arrays of order "C" grow along their first axis, those of order "F"
+    along their last one. Data past the layout, left by an update which did
+    not complete, is overwritten.
+    """
+
+    dtype, order = np.dtype(layout["dtype"]), layout["order"]
+    array = np.asarray(array, dtype=dtype)
+    shape = list(layout["shape"])
+    shape[-1 if order == "F" else 0] += array.shape[-1 if order == "F" else 0]
+    _append_bytes(os.path.join(index_path, layout["file"]), int(np.prod(layout["shape"])) * dtype.itemsize,
+                  np.ascontiguousarray(array.T if order == "F" else array).tobytes())
+    return dict(layout, shape=shape)
+
+
+def _open_array(index_path, layout):
+    """helper-function: memory map an array written by _write_array
+    """
+
+    dtype = np.dtype(layout["dtype"])
+    shape = tuple(layout["shape"])
+    if int(np.prod(shape)) == 0:
+        # empty files can not be memory mapped
+        return np.zeros(shape, dtype=dtype, order=layout["order"])
+    return np.memmap(os.path.join(index_path, layout["file"]), dtype=dtype, mode='r', shape=shape,
+                     order=layout["order"])
+
+
+def _append_bytes(path, size, data):
+    """helper-function: write data to a file at offset size, dropping what
+    was past it, and return the new size
+    """
+
+    with open(path, 'r+b') as log:
+        if os.path.getsize(path) > size:
+            log.truncate(size)
+        log.seek(size)
+        log.write(data)
+    return size + len(data)
+
+
+def _json_lines(values):
+    """helper-function: values as JSON lines, encoded"""
+    return "".join(json.dumps(value) + "\n" for value in values).encode("utf8")
+
+
+def _read_documents(index_path, size):
+    """helper-function: document table from the first size bytes of the
+    documents file
+    """
+
+    records = []
+    with open(os.path.join(index_path, DOCUMENTS), 'rb') as documents:
+        for line in documents.read(size).splitlines():
+            doc_id, record = json.loads(line)
+            records.extend([None] * (doc_id + 1 - len(records)))
+            records[doc_id] = record
+    return records
+
+
+def _corpus(records):
+    """helper-function: corpus entry of the manifest for a document table
+
+    digests are those of corpus_fingerprint for the live documents, without
+    reading them again.
+    """
+
+    live = sorted((record for record in records if record is not None), key=lambda record: record["path"])
+    return {
+        "no_of_docs": len(live),
+        "stat_digest": _corpus_digest([ (record["path"], record["size"], record["mtime_ns"])
+                                        for record in live ]),
+        "content_digest": _corpus_digest([ (record["path"], record["sha256"]) for record in live ]),
+    }
+
+
+def _write_manifest(index_path, manifest):
+    """helper-function: replace the manifest of an index in one step"""
+    tmp_path = os.path.join(index_path, MANIFEST + ".tmp")
+    with open(tmp_path, 'w', encoding="utf8") as manifest_file:
+        json.dump(manifest, manifest_file, indent=2)
+    os.replace(tmp_path, os.path.join(index_path, MANIFEST))
+
+
+def save_index(index_path, params, files, incidence_matrix, signature_matrix, buckets_list, records=None):
+    """This function writes a generated index to a directory
+
+    The index is first written to a temporary directory which then replaces
+    index_path, so a partially written index is never picked up.
+
+    Parameters
+    ----------
+    index_path: str
+        directory to write the index to
+    params: dict
+        parameters used to build the index (shingle_size, extension,
+        no_of_hash_functions, seed, r, hash_bits, scheme, signature_bits)
+    files: list
+        list of (filename, doc_id) tuples, as returned by shingling.list_files
+    incidence_matrix: shingling.IncidenceMatrix
+        incidence matrix of the corpus, None if it was not built
+    signature_matrix: numpy.ndarray or minhashing.PackedSignatures
+        signature matrix of the corpus. Only the words of b-bit signatures
+        are written, set params["signature_bits"] to read them back
+    buckets_list: list
+        list of bucket tables, as returned by lsh.get_bucket_list. Delta
+        tables are merged
+    records: list, optional
+        document table entry of every doc_id, see file_record. Default:
+        None, computed from files
+    """
+
+    with metrics.stage("save_index") as stage:
+        _save_index(index_path, params, files, incidence_matrix, signature_matrix, buckets_list, records)
+        stage.set(docs=len(files))
+
+
+def _save_index(index_path, params, files, incidence_matrix, signature_matrix, buckets_list, records):
+    """helper-function: write the index, see save_index
+    """
+
+    if records is None:
+        records = [ file_record(filename) for filename, doc_id in sorted(files, key=lambda f: f[1]) ]
+
+    tmp_path = index_path + ".tmp"
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+
+    tables = [ table if isinstance(table, lsh.BandTable) else lsh.BandTable.from_dict(table)
+               for table in buckets_list ]
+    band_ptr = np.zeros(len(tables)+1, dtype=np.int64)
+    np.cumsum([len(table.keys) for table in tables], out=band_ptr[1:])
+    if isinstance(signature_matrix, minhashing.PackedSignatures):
+        signature_matrix = signature_matrix.words
+
+    arrays = dict()
+    if incidence_matrix is not None:
+        incidence_matrix = incidence_matrix.compacted()
+        arrays["indptr"] = _write_array(tmp_path, "indptr.bin", incidence_matrix.indptr)
+        arrays["indices"] = _write_array(tmp_path, "indices.bin", incidence_matrix.indices)
+    arrays.update({
+        "signatures": _write_array(tmp_path, "signatures.bin", signature_matrix, order="F"),
+        "band_ptr": _write_array(tmp_path, "band_ptr.bin", band_ptr),
+        "bucket_keys": _write_array(tmp_path, "bucket_keys.bin",
+            np.concatenate([np.asarray(table.keys, dtype=np.uint64) for table in tables] + [np.zeros(0, np.uint64)])),
+        "bucket_docs": _write_array(tmp_path, "bucket_docs.bin",
+            np.concatenate([np.asarray(table.docs, dtype=np.uint32) for table in tables] + [np.zeros(0, np.uint32)])),
+    })
+
+    with open(os.path.join(tmp_path, DOCUMENTS), 'wb') as documents:
+        documents.write(_json_lines(enumerate(records)))
+    vocabulary = None
+    if incidence_matrix is not None and incidence_matrix.vocabulary is not None:
+        with open(os.path.join(tmp_path, VOCABULARY), 'wb') as vocabulary_file:
+            vocabulary_file.write(_json_lines(sorted(incidence_matrix.vocabulary, key=incidence_matrix.vocabulary.get)))
+        vocabulary = {"size": len(incidence_matrix.vocabulary),
+                      "bytes": os.path.getsize(os.path.join(tmp_path, VOCABULARY))}
+
+    manifest = {
+        "version": FORMAT_VERSION,
+        "created": time.time(),
+        "generation": 0,
+        "params": params,
+        "corpus": _corpus(records),
+        "arrays": arrays,
+        "documents": os.path.getsize(os.path.join(tmp_path, DOCUMENTS)),
+        "vocabulary": vocabulary,
+        # doc_ids of deleted documents, and of documents whose band table entries are skipped
+        "deleted": [ doc_id for doc_id, record in enumerate(records) if record is None ],
+        "removed": [],
+        # [doc_id, column] of documents not in their own column of the incidence matrix
+        "columns": [],
+    }
+    _write_manifest(tmp_path, manifest)
+
+    # swap in the new index
+    old_path = index_path + ".old"
+    if os.path.exists(index_path):
+        os.rename(index_path, old_path)
+    os.rename(tmp_path, index_path)
+    if os.path.exists(old_path):
+        shutil.rmtree(old_path)
+
+
+def is_stale(manifest, params, files=None):
+    """This function checks whether an index manifest matches the corpus
+
+    Parameters
+    ----------
+    manifest: dict
+        contents of manifest.json
+    params: dict
+        parameters requested for the index
+    files: list, optional
+        current list of (filename, doc_id) tuples of the corpus. Default:
+        None, only the format version and parameters are checked. Files are
+        matched to the index by path, their doc_ids are ignored
+
+    Returns
+    -------
+    str
+        reason why the index is stale, or None if it is up to date
+    """
+
+    if manifest.get("version") != FORMAT_VERSION:
+        return f"index format version {manifest.get('version')} is not {FORMAT_VERSION}"
+    if manifest["params"] != params:
+        return f"index parameters {manifest['params']} do not match {params}"
+    if files is None:
+        return None
+    corpus = manifest["corpus"]
+    if corpus["no_of_docs"] != len(files):
+        return "no of documents in corpus changed"
+    # stat based check avoids reading the corpus when nothing was touched
+    if corpus["stat_digest"] != corpus_fingerprint(files):
+        if corpus["content_digest"] != corpus_fingerprint(files, content=True):
+            return "contents of corpus changed"
+    return None
+
+
+def load_index(index_path, params=None, files=None):
+    """This function opens an index directory written by save_index
+
+    Parameters
+    ----------
+    index_path: str
+        directory containing the index
+    params: dict, optional
+        parameters requested for the index. If given along with files, the
+        index is checked against them and not loaded if stale
+    files: list, optional
+        current list of (filename, doc_id) tuples of the corpus
+
+    Returns
+    -------
+    StoredIndex
+        the loaded index, or None if it does not exist or is stale
+    """
+
+    manifest_path = os.path.join(index_path, MANIFEST)
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path, 'r', encoding="utf8") as manifest_file:
+        manifest = json.load(manifest_file)
+
+    if params is not None and files is not None:
+        reason = is_stale(manifest, params, files)
+    else:
+        # an index of another format version can not be read
+        reason = is_stale(manifest, manifest["params"])
+    if reason is not None:
+        print(f"Index {index_path} is stale: {reason}")
+        return None
+
+    records = _read_documents(index_path, manifest["documents"])
+    files = [ (record["path"] if record is not None else None, doc_id) for doc_id, record in enumerate(records) ]
+    vocabulary = None
+    if manifest["vocabulary"] is not None:
+        vocabulary = _Vocabulary(os.path.join(index_path, VOCABULARY), manifest["vocabulary"]["size"])
+
+    with metrics.stage("load_index") as stage:
+        arrays = { name: _open_array(index_path, layout) for name, layout in manifest["arrays"].items() }
+        incidence_matrix = None
+        if "indptr" in arrays:
+            columns = None
+            if manifest["columns"]:
+                # documents whose shingles were appended by updates
+                columns = np.arange(len(records), dtype=np.int64)
+                doc_ids, moved = np.array(manifest["columns"], dtype=np.int64).T
+                columns[doc_ids] = moved
+            incidence_matrix = IncidenceMatrix(arrays["indptr"], arrays["indices"], vocabulary, columns)
+        signature_matrix = _signatures(manifest, arrays["signatures"])
+
+        buckets_list = _band_tables(arrays["band_ptr"], arrays["bucket_keys"], arrays["bucket_docs"])
+        if "delta_ptr" in arrays:
+            # entries added by updates, and the doc_ids whose entries in the tables are skipped
+            removed = set(manifest["removed"])
+            deltas = _band_tables(arrays["delta_ptr"], arrays["delta_keys"], arrays["delta_docs"])
+            buckets_list = [ lsh.DeltaBandTable(table, delta, removed) for table, delta in zip(buckets_list, deltas) ]
+        stage.set(docs=len(files))
+    if metrics.enabled():
+        lsh.record_bucket_sizes(buckets_list)
+
+    return StoredIndex(index_path, manifest, files, incidence_matrix, signature_matrix, buckets_list, records)
+
+
+def load_signatures(index_path):
+    """This function opens only the signature matrix of an index directory
+
+    the document table, vocabulary, incidence matrix and band tables are
+    not read, for processes which only need the signatures, such as the
+    shards of sharding.ShardedIndex.
+
+    Parameters
+    ----------
+    index_path: str
+        directory containing the index
+
+    Returns
+    -------
+    tuple
+        (manifest, signature_matrix) as in the StoredIndex returned by
+        load_index. The deleted doc_ids are in manifest["deleted"]. None if
+        there is no index of this format version
+    """
+
+    manifest_path = os.path.join(index_path, MANIFEST)
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path, 'r', encoding="utf8") as manifest_file:
+        manifest = json.load(manifest_file)
+    if manifest.get("version") != FORMAT_VERSION:
+        return None
+    return manifest, _signatures(manifest, _open_array(index_path, manifest["arrays"]["signatures"]))
+
+
+def _signatures(manifest, array):
+    """helper-function: signature matrix of the scheme of an index from its
+    memory mapped array
+    """
+
+    params = manifest["params"]
+    if params.get("scheme") == "simhash":
+        return minhashing.SimHashSignatures(array, 1, params["no_of_hash_functions"])
+    if params.get("signature_bits") is not None:
+        return minhashing.PackedSignatures(array, params["signature_bits"], params["no_of_hash_functions"])
+    return array
+
+
+def _band_tables(band_ptr, keys, docs):
+    """helper-function: lsh.BandTable of every band from the concatenated
+    key and doc_id arrays
+    """
+
+    buckets_list = []
+    for i in range(len(band_ptr)-1):
+        start, stop = int(band_ptr[i]), int(band_ptr[i+1])
+        buckets_list.append(lsh.BandTable(keys[start:stop], docs[start:stop]))
+    return buckets_list
+
+
+def diff_corpus(records, files):
+    """This function compares the document table of an index with the corpus
+
+    files are matched by path. A file whose size and modification time are
+    those of its record is taken as unchanged without reading it, else its
+    contents are hashed and compared. New files get new doc_ids, after
+    those of records.
+
+    Parameters
+    ----------
+    records: list
+        document table of the index, see file_record
+    files: list
+        current list of (filename, doc_id) tuples of the corpus. Their
+        doc_ids are ignored, those of the index are kept
+
+    Returns
+    -------
+    CorpusDiff
+        doc_ids of the added, modified and deleted documents, and the
+        document table after the changes
+    """
+
+    doc_ids = { record["path"]: doc_id for doc_id, record in enumerate(records) if record is not None }
+    records = list(records)
+    added, modified, seen = [], [], set()
+    for filename, _ in files:
+        seen.add(filename)
+        doc_id = doc_ids.get(filename)
+        if doc_id is None:
+            added.append(len(records))
+            records.append(file_record(filename))
+            continue
+        stat = os.stat(filename)
+        if (stat.st_size, stat.st_mtime_ns) == (records[doc_id]["size"], records[doc_id]["mtime_ns"]):
+            continue
+        record = file_record(filename)
+        if record["sha256"] != records[doc_id]["sha256"]:
+            modified.append(doc_id)
+        records[doc_id] = record
+
+    deleted = sorted(doc_id for path, doc_id in doc_ids.items() if path not in seen)
+    for doc_id in deleted:
+        records[doc_id] = None
+    return CorpusDiff(added, modified, deleted, records)
+
+
+def _sign_files(index, paths):
+    """helper-function: incidence matrix and signatures of files, built with
+    the parameters of the index
+
+    new shingles are added to a copy of the vocabulary of the index, which
+    is returned with the matrix. The incidence matrix is None for streamed
+    indexes.
+    """
+
+    params = index.params
+    k, n, seed = params["shingle_size"], params["no_of_hash_functions"], params["seed"]
+    scheme = params.get("scheme", "minhash")
+    files = [ (path, i) for i, path in enumerate(paths) ]
+    vocabulary = None
+    if params.get("stream"):
+        incidence_matrix = None
+        documents = ( shingling.iter_shingle_hashes(path, k, params["hash_bits"]) for path in paths )
+        signature_matrix = minhashing.stream_signature_matrix(documents, n, seed, scheme)
+    else:
+        if params.get("hash_bits") is not None:
+            incidence_matrix = shingling.build_hashed_matrix(files, k, params["hash_bits"])
+        else:
+            vocabulary = dict(index.incidence_matrix.vocabulary)
+            incidence_matrix = shingling.build_matrix(files, k, vocabulary=vocabulary)
+        signature_matrix = minhashing.generate_signature_matrix(incidence_matrix, n, seed, scheme=scheme)
+    if params.get("signature_bits") is not None:
+        signature_matrix = minhashing.PackedSignatures.from_signatures(signature_matrix, params["signature_bits"])
+    return incidence_matrix, signature_matrix, vocabulary
+
+
+def _drop_columns(incidence_matrix, doc_ids):
+    """helper-function: copy of an incidence matrix with the columns of
+    doc_ids emptied. Other documents are copied as contiguous runs
+    """
+
+    indptr, indices = np.asarray(incidence_matrix.indptr), incidence_matrix.indices
+    sizes = np.diff(indptr)
+    sizes[sorted(doc_ids)] = 0
+    pieces, start = [], 0
+    for doc_id in sorted(doc_ids) + [len(sizes)]:
+        if start < doc_id:
+            pieces.append(np.asarray(indices[indptr[start]:indptr[doc_id]]))
+        start = doc_id + 1
+
+    dropped_indptr = np.zeros(len(indptr), dtype=np.int64)
+    np.cumsum(sizes, out=dropped_indptr[1:])
+    dropped_indices = np.concatenate(pieces) if pieces else np.zeros(0, dtype=indices.dtype)
+    return IncidenceMatrix(dropped_indptr, dropped_indices.astype(indices.dtype, copy=False),
+                           incidence_matrix.vocabulary)
+
+
+def update_index(index, files):
+    """This function brings an index up to date with the files of its corpus
+
+    only added and modified files are shingled and signed. Added files are
+    appended to the index under new doc_ids, modified ones keep their
+    doc_ids. The band table entries of both are kept in delta tables, apart
+    from the band tables, which are only rewritten by compact_index once
+    the changes grow past COMPACT_FRACTION of them. The cached ground truth
+    and the delta tables of the previous update are removed.
+
+    Parameters
+    ----------
+    index: StoredIndex
+        index to update
+    files: list
+        current list of (filename, doc_id) tuples of the corpus, as returned
+        by shingling.list_files. Their doc_ids are ignored
+
+    Returns
+    -------
+    StoredIndex
+        the given index if no document changed, else the updated index
+    """
+
+    with metrics.stage("update_index") as stage:
+        diff = diff_corpus(index.records, files)
+        changed = diff.added + diff.modified
+        stage.set(docs=len(files))
+        stage.note(added=len(diff.added), modified=len(diff.modified), deleted=len(diff.deleted))
+        # document records to write, including those of files which were only touched
+        touched = [ doc_id for doc_id, record in enumerate(diff.records)
+                    if doc_id >= len(index.records) or record is not index.records[doc_id] ]
+        if not touched:
+            return index
+
+        # the cached ground truth no longer matches the corpus
+        if os.path.exists(os.path.join(index.path, GROUND_TRUTH)):
+            os.remove(os.path.join(index.path, GROUND_TRUTH))
+
+        manifest = json.loads(json.dumps(index.manifest))
+        manifest["documents"] = _append_bytes(os.path.join(index.path, DOCUMENTS), manifest["documents"],
+                                              _json_lines((doc_id, diff.records[doc_id]) for doc_id in touched))
+        manifest["corpus"] = _corpus(diff.records)
+        if changed or diff.deleted:
+            print(f"Updating index {index.path}: {len(diff.added)} added, {len(diff.modified)} modified, "
+                  f"{len(diff.deleted)} deleted")
+            _append_changes(index, manifest, diff)
+        _write_manifest(index.path, manifest)
+
+        # files of the previous update, which readers of the old manifest may still have open
+        superseded = ({ layout["file"] for layout in index.manifest["arrays"].values() }
+                      - { layout["file"] for layout in manifest["arrays"].values() })
+        for name in superseded:
+            try:
+                os.remove(os.path.join(index.path, name))
+            except OSError as error:
+                print(f"Could not remove {name} from index {index.path}: {error}")
+
+        index = load_index(index.path)
+        if not isinstance(index.buckets_list[0], lsh.DeltaBandTable):
+            return index
+        table = index.buckets_list[0]
+        if len(table.delta.keys) + len(table.removed) > COMPACT_FRACTION * len(table.base.keys):
+            index = compact_index(index)
+    return index
+
+
+def _overwrite_columns(index_path, layout, positions, array):
+    """helper-function: overwrite columns at positions of an array of order
+    "F" written by _write_array with the columns of array
+    """
+
+    dtype = np.dtype(layout["dtype"])
+    array = np.asarray(array, dtype=dtype)
+    width = int(np.prod(layout["shape"][:-1])) * dtype.itemsize
+    with open(os.path.join(index_path, layout["file"]), 'r+b') as values:
+        for j, position in enumerate(positions):
+            values.seek(position * width)
+            values.write(np.ascontiguousarray(array[..., j]).tobytes())
+
+
+def _append_changes(index, manifest, diff):
+    """helper-function: write the documents changed by diff to the files of
+    an index and the new delta tables, and record them in manifest
+    """
+
+    params, arrays = index.params, manifest["arrays"]
+    b = len(index.buckets_list)
+    changed = sorted(diff.added + diff.modified)
+    if changed:
+        paths = [ diff.records[doc_id]["path"] for doc_id in changed ]
+        incidence_matrix, signature_matrix, vocabulary = _sign_files(index, paths)
+        packed = isinstance(signature_matrix, minhashing.PackedSignatures)
+        columns = np.asarray(signature_matrix.words if packed else signature_matrix)
+        # doc_ids of modified documents come before those of the added ones
+        _overwrite_columns(index.path, arrays["signatures"], changed[:len(diff.modified)],
+                           columns[:, :len(diff.modified)])
+        arrays["signatures"] = _append_array(index.path, arrays["signatures"], columns[:, len(diff.modified):])
+        if incidence_matrix is not None:
+            offset = int(index.incidence_matrix.indptr[-1])
+            first = len(index.incidence_matrix.indptr) - 1
+            arrays["indptr"] = _append_array(index.path, arrays["indptr"],
+                                             offset + np.asarray(incidence_matrix.indptr[1:]))
+            arrays["indices"] = _append_array(index.path, arrays["indices"], incidence_matrix.indices)
+            moved = { doc_id: column for doc_id, column in manifest["columns"] }
+            moved.update({ doc_id: first + j for j, doc_id in enumerate(changed) })
+            manifest["columns"] = sorted([doc_id, column] for doc_id, column in moved.items() if doc_id != column)
+        if vocabulary is not None and len(vocabulary) > manifest["vocabulary"]["size"]:
+            new = sorted((i, shingle) for shingle, i in vocabulary.items() if i >= manifest["vocabulary"]["size"])
+            manifest["vocabulary"] = {
+                "size": len(vocabulary),
+                "bytes": _append_bytes(os.path.join(index.path, VOCABULARY), manifest["vocabulary"]["bytes"],
+                                       _json_lines(shingle for i, shingle in new)),
+            }
+        band_keys = lsh.band_hash(signature_matrix, params["r"])
+    else:
+        band_keys = np.zeros((b, 0), dtype=np.uint64)
+
+    # delta tables: entries of the previous updates of unchanged documents, and the new ones
+    dropped = np.array(diff.modified + diff.deleted, dtype=np.int64)
+    deltas = []
+    for band, table in enumerate(index.buckets_list):
+        keys, docs = np.zeros(0, dtype=np.uint64), np.zeros(0, dtype=np.int64)
+        if isinstance(table, lsh.DeltaBandTable):
+            keep = ~np.isin(np.asarray(table.delta.docs), dropped)
+            keys, docs = np.asarray(table.delta.keys)[keep], np.asarray(table.delta.docs, dtype=np.int64)[keep]
+        deltas.append(lsh.BandTable.from_keys(np.concatenate([keys, band_keys[band]]),
+                                              np.concatenate([docs, np.array(changed, dtype=np.int64)])))
+    delta_ptr = np.zeros(b+1, dtype=np.int64)
+    np.cumsum([ len(delta.keys) for delta in deltas ], out=delta_ptr[1:])
+
+    # new files for the delta tables, the ones of the previous generation may be in use
+    manifest["generation"] += 1
+    generation = manifest["generation"]
+    arrays.update({
+        "delta_ptr": _write_array(index.path, f"delta_ptr.{generation}.bin", delta_ptr),
+        "delta_keys": _write_array(index.path, f"delta_keys.{generation}.bin",
+            np.concatenate([ delta.keys for delta in deltas ] + [np.zeros(0, np.uint64)])),
+        "delta_docs": _write_array(index.path, f"delta_docs.{generation}.bin",
+            np.concatenate([ delta.docs for delta in deltas ] + [np.zeros(0, np.uint32)])),
+    })
+    manifest["deleted"] = sorted(set(manifest["deleted"]) | set(diff.deleted))
+    # entries of the band tables of modified and deleted documents are skipped
+    manifest["removed"] = sorted(set(manifest["removed"]) | set(diff.modified) | set(diff.deleted))
+
+
+def compact_index(index):
+    """This function merges the changes of updates into an index
+
+    the delta tables are merged into the band tables, skipped entries are
+    dropped from them, the shingles of every document are moved back to
+    its own column and those of deleted documents are dropped, and the
+    index is rewritten with save_index. doc_ids do not change.
+
+    Parameters
+    ----------
+    index: StoredIndex
+        index to compact
+
+    Returns
+    -------
+    StoredIndex
+        the compacted index
+    """
+
+    print(f"Compacting index {index.path}")
+    incidence_matrix = index.incidence_matrix
+    if incidence_matrix is not None:
+        # shingles of modified documents are back in their own column
+        incidence_matrix = incidence_matrix.compacted()
+        if index.deleted:
+            incidence_matrix = _drop_columns(incidence_matrix, index.deleted)
+    save_index(index.path, index.params, index.files, incidence_matrix, index.signature_matrix,
+               index.buckets_list, index.records)
+    return load_index(index.path)
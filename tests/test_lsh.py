@@ -0,0 +1,116 @@
+import numpy as np
+import pytest
+
+import lsh
+import minhashing
+import statistics
+from shingling import IncidenceMatrix
+
+
+def random_signatures(n=60, no_of_docs=40, seed=0):
+    """signatures with some near-duplicate columns"""
+    rng = np.random.default_rng(seed)
+    signature_matrix = rng.integers(0, 1 << 31, size=(n, no_of_docs), dtype=np.uint32)
+    signature_matrix[:, 1::2] = signature_matrix[:, 0::2]
+    signature_matrix[rng.random((n, no_of_docs)) < 0.1] = 7
+    return signature_matrix
+
+
+def test_packed_band_keys_equal_unpacked():
+    signature_matrix = random_signatures()
+    for bits in (1, 4, 16):
+        packed = minhashing.PackedSignatures.from_signatures(signature_matrix, bits)
+        assert np.array_equal(lsh.band_hash(packed, 5), lsh.band_hash(packed.unpack(), 5))
+
+
+def test_packed_pair_similarity_is_corrected_agreement():
+    signature_matrix = random_signatures()
+    pairs = np.array([[0, 1], [0, 2], [3, 9], [10, 11]])
+    for bits in (2, 8):
+        packed = minhashing.PackedSignatures.from_signatures(signature_matrix, bits)
+        unpacked = packed.unpack()
+        agreement = np.mean(unpacked[:, pairs[:, 0]] == unpacked[:, pairs[:, 1]], axis=0)
+        assert np.allclose(statistics.pair_similarity(pairs, packed), statistics.bbit_similarity(agreement, bits))
+
+
+
+def test_forest_prefix_keys_match_unpacked_forest():
+    signature_matrix = random_signatures(n=64, no_of_docs=200)
+    for bits in (1, 4, 16):
+        packed = minhashing.PackedSignatures.from_signatures(signature_matrix, bits)
+        forest = lsh.LSHForest.from_signature_matrix(packed, no_of_trees=4)
+        unpacked = lsh.LSHForest.from_signature_matrix(packed.unpack(), no_of_trees=4, depth=forest.rows.shape[1])
+        assert forest.rows.shape[1] * bits <= 64
+        for j in range(0, 200, 17):
+            signature = packed.unpack()[:, j]
+            assert forest.query(signature, 5) == unpacked.query(signature, 5)
+
+
+def test_bucket_pairs_equal_candidate_pairs():
+    signature_matrix = random_signatures()
+    buckets_list = lsh.get_bucket_list(signature_matrix, 3)
+    pairs, skipped = lsh.bucket_pairs(buckets_list)
+    assert skipped == 0
+    assert len(pairs) > 0
+    assert set(map(tuple, pairs.tolist())) == lsh.candidate_pairs(buckets_list)
+
+
+def test_bucket_pairs_skip_giant_buckets():
+    signature_matrix = random_signatures()
+    signature_matrix[:, :8] = signature_matrix[:, [0]]
+    buckets_list = lsh.get_bucket_list(signature_matrix, 3)
+    pairs, skipped = lsh.bucket_pairs(buckets_list, max_bucket=4)
+    assert skipped == len(buckets_list)
+    assert not np.any(pairs[:, 1] < 8)
+
+
+def test_simhash_bands_find_near_duplicate():
+    rng = np.random.default_rng(3)
+    columns = [ np.unique(rng.integers(0, 100000, size=300)) for j in range(20) ]
+    # document 20 is document 3 with a few shingles replaced
+    columns.append(np.union1d(columns[3][5:], rng.integers(0, 100000, size=5)))
+    indptr = np.zeros(len(columns) + 1, dtype=np.int64)
+    np.cumsum([ len(column) for column in columns ], out=indptr[1:])
+    matrix = IncidenceMatrix(indptr, np.concatenate(columns).astype(np.uint32), None)
+
+    signature_matrix = minhashing.generate_signature_matrix(matrix, 256, seed=1, scheme="simhash")
+    buckets_list = lsh.get_bucket_list(signature_matrix, 16)
+    assert len(buckets_list) == 16
+    similar_docs = lsh.query_batch(signature_matrix.select([3]), buckets_list, 16)[0]
+    assert similar_docs == {3, 20}
+    assert lsh.candidate_pairs(buckets_list) == {(3, 20)}
+
+
+def s_curve_threshold(plan, bits=None, scheme="minhash"):
+    """similarity at which the banding of a plan pairs documents half of the time"""
+    s = np.linspace(0, 1, 10001)
+    return s[np.searchsorted(lsh.collision_probability(s, plan.b, plan.r, bits, scheme), 0.5)]
+
+
+def test_plan_banding_threshold_near_target():
+    for threshold in (0.3, 0.5, 0.7, 0.9):
+        for bits, scheme in ((None, "minhash"), (4, "minhash"), (None, "simhash")):
+            if scheme == "simhash" and threshold < 0.5:
+                continue    # low cosine thresholds need more bits than max_hash_functions
+            plan = lsh.plan_banding(threshold, bits=bits, scheme=scheme)
+            assert plan.n == plan.b * plan.r
+            if bits is None and scheme == "minhash":
+                assert plan.false_negative_rate <= 0.1 and plan.false_positive_rate <= 0.1
+            assert abs(s_curve_threshold(plan, bits, scheme) - threshold) < 0.1
+
+
+def test_plan_banding_honors_fixed_n_and_r():
+    plan = lsh.plan_banding(0.5, n=128)
+    assert plan.n == 128 and plan.b * plan.r <= 128
+    assert abs(s_curve_threshold(plan) - 0.5) < 0.1
+
+    plan = lsh.plan_banding(0.5, r=7)
+    assert plan.r == 7 and plan.n == plan.b * 7
+
+    plan = lsh.plan_banding(0.5, n=100, r=7)
+    assert (plan.n, plan.b, plan.r) == (100, 14, 7)
+    signature_matrix = random_signatures(n=100)
+    assert lsh.band_hash(signature_matrix, plan).shape == (14, signature_matrix.shape[1])
+
+    with pytest.raises(Exception):
+        lsh.plan_banding(0.5, n=4, r=7)
@@ -0,0 +1,208 @@
+import numpy as np
+import pytest
+
+import minhashing
+import shingling
+import statistics
+from shingling import IncidenceMatrix
+
+
+def random_matrix(no_of_docs=50, max_size=300, seed=0):
+    """incidence matrix of random documents, some of them empty"""
+    rng = np.random.default_rng(seed)
+    columns = [ np.unique(rng.integers(0, 5000, size=rng.integers(0, max_size))) for j in range(no_of_docs) ]
+    columns[3] = np.zeros(0, dtype=np.int64)
+    indptr = np.zeros(no_of_docs + 1, dtype=np.int64)
+    np.cumsum([len(column) for column in columns], out=indptr[1:])
+    return IncidenceMatrix(indptr, np.concatenate(columns).astype(np.uint32), None)
+
+
+def reference_signatures(incidence_matrix, hash_params):
+    """minhash of every document, hashing all its shingles at once"""
+    columns = []
+    for j in range(len(incidence_matrix)):
+        shingles = incidence_matrix[j]
+        if len(shingles) == 0:
+            columns.append(np.full(len(hash_params.a), minhashing.EMPTY, dtype=np.uint32))
+        else:
+            columns.append(minhashing._hash_values(shingles, hash_params).min(axis=1).astype(np.uint32))
+    return np.stack(columns, axis=1)
+
+
+def test_signatures_match_reference():
+    matrix = random_matrix()
+    hash_params = minhashing.generate_hash_functions(64, seed=3)
+    signature_matrix = minhashing.generate_signature_matrix(matrix, 64, seed=3)
+    assert signature_matrix.dtype == np.uint32
+    assert np.array_equal(signature_matrix, reference_signatures(matrix, hash_params))
+
+
+def test_parallel_equals_serial():
+    matrix = random_matrix()
+    serial = minhashing.generate_signature_matrix(matrix, 64, seed=1)
+    parallel = minhashing.generate_signature_matrix(matrix, 64, seed=1, parallel=2, chunk_size=7)
+    assert np.array_equal(serial, parallel)
+
+
+def test_large_document_is_hashed_in_blocks(monkeypatch):
+    matrix = random_matrix(no_of_docs=5, max_size=2000)
+    hash_params = minhashing.generate_hash_functions(32)
+    expected = reference_signatures(matrix, hash_params)
+    # every document is larger than a block now
+    monkeypatch.setattr(minhashing, "BLOCK_SIZE", 32 * 10)
+    assert np.array_equal(minhashing.generate_signature_matrix(matrix, 32), expected)
+    assert np.array_equal(minhashing.minhash(matrix[0], hash_params), expected[:, 0])
+
+
+def test_same_seed_same_signatures():
+    matrix = random_matrix()
+    first = minhashing.generate_signature_matrix(matrix, 32, seed=7)
+    assert np.array_equal(first, minhashing.generate_signature_matrix(matrix, 32, seed=7))
+    assert not np.array_equal(first, minhashing.generate_signature_matrix(matrix, 32, seed=8))
+
+
+def test_packed_signatures_round_trip():
+    signature_matrix = minhashing.generate_signature_matrix(random_matrix(), 100)
+    for bits in (1, 2, 4, 8, 16):
+        packed = minhashing.PackedSignatures.from_signatures(signature_matrix, bits)
+        assert packed.shape == signature_matrix.shape
+        assert packed.words.shape[0] == -(-100 * bits // 64)
+        assert np.array_equal(packed.unpack(), signature_matrix & ((1 << bits) - 1))
+        assert np.array_equal(packed.rows(10, 30), signature_matrix[10:30] & ((1 << bits) - 1))
+
+
+def test_packed_agreement_counts_equal_values():
+    signature_matrix = minhashing.generate_signature_matrix(random_matrix(), 100)
+    docs = np.arange(signature_matrix.shape[1])
+    for bits in (1, 2, 4, 8, 16):
+        packed = minhashing.PackedSignatures.from_signatures(signature_matrix, bits)
+        low = signature_matrix & ((1 << bits) - 1)
+        expected = (low == low[:, [5]]).sum(axis=0)
+        assert np.array_equal(packed.agreement(packed.words[:, 5], docs), expected)
+
+
+@pytest.mark.parametrize("scheme", ["minhash", "oph"])
+def test_streamed_equals_whole(tmp_path, scheme):
+    rng = np.random.default_rng(5)
+    words = [ "alpha", "Beta", "gamma\n", "  delta", "\tepsilon", "zeta.", "eta\n\n" ]
+    texts = [ " ".join(rng.choice(words, size=size)) for size in (0, 1, 40, 300, 2000) ]
+    paths = []
+    for j, text in enumerate(texts):
+        paths.append(str(tmp_path / f"doc{j}.txt"))
+        with open(paths[-1], 'w', encoding="utf8") as doc:
+            doc.write(text)
+
+    matrix = shingling.build_hashed_matrix([ (path, j) for j, path in enumerate(paths) ], 5)
+    whole = minhashing.generate_signature_matrix(matrix, 64, seed=2, scheme=scheme)
+    for chunk_size in (7, 64, 1 << 20):
+        documents = ( shingling.iter_shingle_hashes(path, 5, chunk_size=chunk_size) for path in paths )
+        streamed = minhashing.stream_signature_matrix(documents, 64, seed=2, scheme=scheme)
+        assert np.array_equal(streamed, whole)
+
+
+@pytest.mark.parametrize("scheme", ["minhash", "oph"])
+def test_large_document_is_streamed_in_chunks(tmp_path, scheme):
+    rng = np.random.default_rng(6)
+    path = str(tmp_path / "large.txt")
+    with open(path, 'w', encoding="utf8") as doc:
+        doc.write(" ".join(f"word{i}" for i in rng.integers(0, 5000, size=40000)))
+
+    chunk_size = 4096
+    sizes = []
+
+    def chunks(path):
+        for chunk in shingling.iter_shingle_hashes(path, 5, chunk_size=chunk_size):
+            sizes.append(len(chunk))
+            yield chunk
+
+    matrix = shingling.build_hashed_matrix([(path, 0), (path, 1)], 5)
+    whole = minhashing.generate_signature_matrix(matrix, 64, seed=3, scheme=scheme)
+    streamed = minhashing.stream_signature_matrix([chunks(path), chunks(path)], 64, seed=3, scheme=scheme)
+    assert np.array_equal(streamed, whole)
+    # the document is far larger than a chunk, and never held whole
+    assert len(sizes) > 50 and max(sizes) <= chunk_size
+
+
+def test_streamed_signatures_grow_past_unknown_length():
+    documents = [ [np.arange(j, j+10, dtype=np.uint32)] for j in range(1500) ]
+    streamed = minhashing.stream_signature_matrix(( iter(chunks) for chunks in documents ), 16)
+    sized = minhashing.stream_signature_matrix([ iter(chunks) for chunks in documents ], 16)
+    assert streamed.shape == (16, 1500)
+    assert np.array_equal(streamed, sized)
+
+
+def overlapping_matrix(similarities, size=400, seed=0):
+    """incidence matrix of document pairs with given jaccard similarities"""
+    rng = np.random.default_rng(seed)
+    shingles = rng.permutation(100000).astype(np.uint32)
+    columns, used = [], 0
+    for similarity in similarities:
+        # pairs sharing common of their union of size shingles
+        common = int(round(similarity * size))
+        first = (size - common) // 2
+        union = shingles[used:used+size]
+        used += size
+        columns += [ np.sort(union[:common+first]), np.sort(np.concatenate([union[:common], union[common+first:]])) ]
+    indptr = np.zeros(len(columns) + 1, dtype=np.int64)
+    np.cumsum([ len(column) for column in columns ], out=indptr[1:])
+    return IncidenceMatrix(indptr, np.concatenate(columns), None)
+
+
+def test_oph_estimate_tracks_jaccard():
+    similarities = [0.0, 0.1, 0.3, 0.5, 0.7, 0.9, 1.0]
+    matrix = overlapping_matrix(similarities)
+    signature_matrix = minhashing.generate_signature_matrix(matrix, 512, seed=4, scheme="oph")
+    for i, similarity in enumerate(similarities):
+        first, second = matrix[2*i], matrix[2*i+1]
+        exact = len(np.intersect1d(first, second)) / len(np.union1d(first, second))
+        estimate = np.mean(signature_matrix[:, 2*i] == signature_matrix[:, 2*i+1])
+        assert abs(estimate - exact) < 0.08
+        assert np.array_equal(signature_matrix[:, 2*i], minhashing.oph_signature(first, 512, seed=4))
+
+
+def test_oph_empty_document():
+    matrix = random_matrix()
+    signature_matrix = minhashing.generate_signature_matrix(matrix, 64, scheme="oph")
+    # document 3 is empty
+    assert np.all(signature_matrix[:, 3] == minhashing.EMPTY)
+    assert np.all(minhashing.oph_signature(np.zeros(0, dtype=np.uint32), 64) == minhashing.EMPTY)
+    others = np.delete(signature_matrix, 3, axis=1)
+    assert not np.any(others == minhashing.EMPTY)
+
+
+def test_oph_blocks_are_bounded_by_bins(monkeypatch):
+    matrix = random_matrix(max_size=20)
+    expected = minhashing.generate_signature_matrix(matrix, 64, scheme="oph")
+    sizes = []
+    block = minhashing._oph_block
+
+    def recorded(indptr, indices, no_of_bins, salt, start, stop, out):
+        sizes.append(stop - start)
+        block(indptr, indices, no_of_bins, salt, start, stop, out)
+
+    # room for the bins of 4 documents, their shingles fit many times over
+    monkeypatch.setattr(minhashing, "BLOCK_SIZE", 64 * 4 + 20 * 4)
+    monkeypatch.setattr(minhashing, "_oph_block", recorded)
+    assert np.array_equal(minhashing.generate_signature_matrix(matrix, 64, scheme="oph"), expected)
+    assert max(sizes) <= 4
+
+
+def test_simhash_same_seed_same_signatures():
+    matrix = random_matrix()
+    first = minhashing.generate_signature_matrix(matrix, 128, seed=7, scheme="simhash")
+    assert isinstance(first, minhashing.SimHashSignatures)
+    assert np.array_equal(first.words, minhashing.generate_signature_matrix(matrix, 128, seed=7, scheme="simhash").words)
+    assert not np.array_equal(first.words, minhashing.generate_signature_matrix(matrix, 128, seed=8, scheme="simhash").words)
+    for j in (0, 3, 10):
+        assert np.array_equal(minhashing.simhash_signature(matrix[j], 128, seed=7).words[:, 0], first.words[:, j])
+
+
+def test_simhash_estimate_tracks_cosine():
+    similarities = [0.0, 0.2, 0.5, 0.8, 1.0]
+    matrix = overlapping_matrix(similarities)
+    signature_matrix = minhashing.generate_signature_matrix(matrix, 1024, seed=2, scheme="simhash")
+    for i in range(len(similarities)):
+        first, second = matrix[2*i], matrix[2*i+1]
+        exact = len(np.intersect1d(first, second)) / np.sqrt(len(first) * len(second))
+        agreement = signature_matrix.agreement(signature_matrix.words[:, 2*i], [2*i+1]) / signature_matrix.n
+        assert abs(statistics.simhash_similarity(agreement)[0] - exact) < 0.1
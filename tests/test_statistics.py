@@ -0,0 +1,81 @@
+import numpy as np
+import pytest
+
+import statistics
+from shingling import IncidenceMatrix
+
+
+def overlapping_matrix(no_of_docs=40, seed=0):
+    """incidence matrix of documents over a small vocabulary, with some
+    near-duplicates and an empty document
+    """
+    rng = np.random.default_rng(seed)
+    columns = [ np.unique(rng.integers(0, 150, size=rng.integers(10, 80))) for j in range(no_of_docs) ]
+    for j in range(1, no_of_docs, 5):
+        columns[j] = np.union1d(columns[j-1][2:], rng.integers(0, 150, size=2))
+    columns[7] = np.zeros(0, dtype=np.int64)
+    indptr = np.zeros(no_of_docs + 1, dtype=np.int64)
+    np.cumsum([ len(column) for column in columns ], out=indptr[1:])
+    return IncidenceMatrix(indptr, np.concatenate(columns).astype(np.uint32), None)
+
+
+def brute_force_pairs(incidence_matrix, min_threshold, exclude=()):
+    """jaccard similarity of every pair above min_threshold, one pair at a time"""
+    pairs = dict()
+    docs = [ doc_id for doc_id in range(len(incidence_matrix)) if doc_id not in exclude ]
+    for x in docs:
+        for a, score in statistics.compute_similarity(x, [ a for a in docs if a > x ], incidence_matrix):
+            if score >= min_threshold:
+                pairs[(x, a)] = score
+    return pairs
+
+
+def truth_pairs(truth):
+    return { (x, a): score for x, a, score in zip(truth.x.tolist(), truth.a.tolist(), truth.scores.tolist()) }
+
+
+@pytest.mark.parametrize("block_size", [1, 7, 1024])
+def test_ground_truth_equals_brute_force(block_size):
+    matrix = overlapping_matrix()
+    truth = statistics.ground_truth(matrix, 0.2, block_size=block_size)
+    expected = brute_force_pairs(matrix, 0.2)
+    pairs = truth_pairs(truth)
+    assert pairs.keys() == expected.keys()
+    assert np.allclose([ pairs[pair] for pair in expected ], list(expected.values()))
+    assert truth.no_of_docs == 40 and all(x < a for x, a in pairs)
+
+    for doc_id in (0, 5, 7):
+        assert truth.similar(doc_id, 0.3) == [ (a, score) for a, score in statistics.compute_similarity(
+            doc_id, range(40), matrix) if score >= 0.3 ]
+
+
+def test_ground_truth_min_threshold_and_exclude():
+    matrix = overlapping_matrix()
+    truth = statistics.ground_truth(matrix, 0.5, exclude={0, 11})
+    assert truth_pairs(truth).keys() == brute_force_pairs(matrix, 0.5, exclude={0, 11}).keys()
+    assert not {0, 11} & set(truth.x.tolist() + truth.a.tolist())
+    assert truth.covers(0.6) and not truth.covers(0.4)
+    with pytest.raises(Exception):
+        truth.similar(1, 0.4)
+
+
+def test_ground_truth_of_moved_columns():
+    matrix = overlapping_matrix()
+    # the shingles of documents 3 and 5 written after the others
+    columns = np.arange(len(matrix), dtype=np.int64)
+    columns[[3, 5]] = [len(matrix), len(matrix) + 1]
+    moved = [ matrix[j] for j in range(len(matrix)) ] + [matrix[3], matrix[5]]
+    indptr = np.zeros(len(moved) + 1, dtype=np.int64)
+    np.cumsum([ len(column) for column in moved ], out=indptr[1:])
+    moved = IncidenceMatrix(indptr, np.concatenate(moved), None, columns)
+    assert truth_pairs(statistics.ground_truth(moved, 0.2)) == truth_pairs(statistics.ground_truth(matrix, 0.2))
+
+
+def test_ground_truth_save_load(tmp_path):
+    truth = statistics.ground_truth(overlapping_matrix(), 0.2)
+    truth.save(str(tmp_path / "truth.npz"))
+    loaded = statistics.GroundTruth.load(str(tmp_path / "truth.npz"))
+    assert (loaded.no_of_docs, loaded.min_threshold) == (truth.no_of_docs, truth.min_threshold)
+    assert truth_pairs(loaded) == truth_pairs(truth)
+    assert loaded.similar(0, 0.2) == truth.similar(0, 0.2)
+    assert loaded.report([(0, 1), (2, 3)], 0.5) == truth.report([(0, 1), (2, 3)], 0.5)
@@ -0,0 +1,327 @@
+import asyncio
+import concurrent.futures
+import contextlib
+import json
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+
+import numpy as np
+import pytest
+
+import cli
+import lsh
+import main
+import server
+import sharding
+import shingling
+import storage
+
+
+REPOSITORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def write_corpus(folder, no_of_docs=12, seed=0):
+    """text files of random words, every third one a near-duplicate of the one before"""
+    rng = np.random.default_rng(seed)
+    words = [ f"word{i}" for i in range(300) ]
+    os.makedirs(folder, exist_ok=True)
+    text = ""
+    for j in range(no_of_docs):
+        if j % 3 == 2:
+            text = text + " " + " ".join(rng.choice(words, size=5))
+        else:
+            text = " ".join(rng.choice(words, size=200))
+        with open(os.path.join(folder, f"doc{j:02d}.txt"), 'w', encoding="utf8") as doc:
+            doc.write(text)
+
+
+def build_index(folder, **index_args):
+    return main.get_index(str(folder), no_of_hash_functions=32, r=4, hash_bits=32, **index_args)
+
+
+def test_deleted_documents_are_not_queried(tmp_path, capsys):
+    corpus = tmp_path / "corpus"
+    write_corpus(corpus)
+    build_index(corpus)
+    os.remove(corpus / "doc04.txt")
+    index = build_index(corpus)
+    deleted = [ doc_id for filename, doc_id in index.files if filename is None ]
+    assert len(deleted) == 1
+    capsys.readouterr()
+
+    cli.main(["query", index.path, str(corpus / "doc05.txt"), str(corpus / "doc07.txt")])
+    records = [ json.loads(line) for line in capsys.readouterr().out.splitlines() ]
+    assert [ "error" not in record for record in records ] == [True, True]
+    assert all(result[1] is not None for record in records for result in record["results"])
+
+    responses = server.run_batch([{"id": 1, "doc_id": deleted[0]}, {"id": 2, "doc_id": deleted[0], "k": 3}], index)
+    assert [ response["error"] for response in responses ] == [f"Unknown doc_id: {deleted[0]}"] * 2
+
+
+def test_updated_index_is_not_stale(tmp_path):
+    corpus = tmp_path / "corpus"
+    write_corpus(corpus)
+    build_index(corpus)
+    os.remove(corpus / "doc01.txt")
+    index = build_index(corpus)
+    files = shingling.list_files(str(corpus), ".txt")
+    assert [ doc_id for filename, doc_id in files ] != [ doc_id for filename, doc_id in index.files
+                                                        if filename is not None ]
+    assert storage.is_stale(index.manifest, index.params, files) is None
+    assert storage.load_index(index.path, index.params, files) is not None
+
+
+def live_documents(index):
+    """maps the path of every live document of an index to its doc_id"""
+    return { os.path.basename(filename): doc_id for filename, doc_id in index.files if filename is not None }
+
+
+def path_pairs(index):
+    """candidate pairs of an index as pairs of file names"""
+    names = { doc_id: name for name, doc_id in live_documents(index).items() }
+    pairs, skipped = lsh.bucket_pairs(index.buckets_list)
+    return { (names[x], names[a]) if names[x] < names[a] else (names[a], names[x]) for x, a in pairs.tolist() }
+
+
+def change_corpus(corpus, step):
+    if step == 0:
+        with open(corpus / "doc03.txt", 'a', encoding="utf8") as doc:
+            doc.write(" word1 word2 word3")
+        with open(corpus / "doc99.txt", 'w', encoding="utf8") as doc:
+            doc.write((corpus / "doc00.txt").read_text(encoding="utf8"))
+    else:
+        os.remove(corpus / "doc06.txt")
+        os.remove(corpus / "doc99.txt")
+
+
+@pytest.mark.parametrize("compact_fraction", [0.0, 10.0])
+@pytest.mark.parametrize("signature_bits", [None, 4])
+def test_update_matches_rebuild(tmp_path, monkeypatch, compact_fraction, signature_bits):
+    monkeypatch.setattr(storage, "COMPACT_FRACTION", compact_fraction)
+    corpus = tmp_path / "corpus"
+    write_corpus(corpus)
+    original = live_documents(build_index(corpus, signature_bits=signature_bits))
+    for step in range(2):
+        change_corpus(corpus, step)
+        index = build_index(corpus, signature_bits=signature_bits)
+        rebuilt = build_index(corpus, signature_bits=signature_bits, index_path=str(tmp_path / f"rebuilt{step}"))
+
+        assert isinstance(index.buckets_list[0], lsh.DeltaBandTable) == (compact_fraction > 0)
+        documents, rebuilt_documents = live_documents(index), live_documents(rebuilt)
+        assert documents.keys() == rebuilt_documents.keys()
+        # doc03.txt is modified in step 0
+        assert all(documents[name] == original[name] for name in documents if name in original)
+        signatures, rebuilt_signatures = index.signature_matrix, rebuilt.signature_matrix
+        if signature_bits is not None:
+            signatures, rebuilt_signatures = signatures.words, rebuilt_signatures.words
+        for name, doc_id in documents.items():
+            assert np.array_equal(signatures[:, doc_id], rebuilt_signatures[:, rebuilt_documents[name]])
+            assert np.array_equal(index.incidence_matrix[doc_id], rebuilt.incidence_matrix[rebuilt_documents[name]])
+        assert path_pairs(index) == path_pairs(rebuilt)
+        assert len(path_pairs(index)) > 0
+
+        deleted = index.deleted
+        assert storage.is_stale(index.manifest, index.params, shingling.list_files(str(corpus), ".txt")) is None
+        for doc_id, similar_docs in index.query_ids(list(documents.values())).items():
+            assert not { doc_id for doc_id, score in similar_docs } & deleted
+        assert not { doc_id for doc_id, score in index.top_k(documents["doc00.txt"], 20) } & deleted
+
+
+def test_update_removes_only_index_files(tmp_path, monkeypatch):
+    monkeypatch.setattr(storage, "COMPACT_FRACTION", 10.0)
+    corpus = tmp_path / "corpus"
+    write_corpus(corpus)
+    index = build_index(corpus)
+    main.get_ground_truth(index)
+    os.makedirs(os.path.join(index.path, "notes"))
+    with open(os.path.join(index.path, "notes.txt"), 'w', encoding="utf8") as notes:
+        notes.write("kept")
+    for step in range(2):
+        change_corpus(corpus, step)
+        index = build_index(corpus)
+
+    names = set(os.listdir(index.path))
+    assert { "notes", "notes.txt" } <= names
+    assert storage.GROUND_TRUTH not in names
+    assert not [ name for name in names if name.startswith("delta_") and name.endswith(".1.bin") ]
+
+
+def test_update_with_vocabulary(tmp_path):
+    corpus = tmp_path / "corpus"
+    write_corpus(corpus)
+    main.get_index(str(corpus), no_of_hash_functions=32, r=4)
+    change_corpus(corpus, 0)
+    index = main.get_index(str(corpus), no_of_hash_functions=32, r=4)
+    rebuilt = main.get_index(str(corpus), no_of_hash_functions=32, r=4, index_path=str(tmp_path / "rebuilt"))
+
+    index = storage.load_index(index.path)
+    shingles = { i: shingle for shingle, i in index.incidence_matrix.vocabulary.items() }
+    rebuilt_shingles = { i: shingle for shingle, i in rebuilt.incidence_matrix.vocabulary.items() }
+    rebuilt_documents = live_documents(rebuilt)
+    for name, doc_id in live_documents(index).items():
+        assert ({ shingles[i] for i in index.incidence_matrix[doc_id].tolist() }
+                == { rebuilt_shingles[i] for i in rebuilt.incidence_matrix[rebuilt_documents[name]].tolist() })
+    assert len(index.incidence_matrix.vocabulary) == len(rebuilt.incidence_matrix.vocabulary)
+
+
+def test_shards_leave_out_deleted_documents(tmp_path):
+    corpus = tmp_path / "corpus"
+    write_corpus(corpus)
+    build_index(corpus)
+    os.remove(corpus / "doc01.txt")
+    index = build_index(corpus)
+    manifest, signature_matrix = storage.load_signatures(index.path)
+    assert manifest["deleted"] == sorted(index.deleted)
+    assert np.array_equal(signature_matrix, index.signature_matrix)
+
+    documents = live_documents(index)
+    with sharding.ShardedIndex(index.path, no_of_shards=2) as sharded:
+        results = sharded.query_ids([documents["doc04.txt"]])[documents["doc04.txt"]]
+    assert results
+    assert not { doc_id for doc_id, score in results } & index.deleted
+
+
+def test_killed_shard_is_restarted(tmp_path):
+    corpus = tmp_path / "corpus"
+    write_corpus(corpus)
+    index = build_index(corpus)
+    documents = list(live_documents(index).values())
+    with sharding.ShardedIndex(index.path, no_of_shards=2) as sharded:
+        expected = sharded.query_ids(documents, k=3)
+        sharded.shards[1].process.kill()
+        sharded.shards[1].process.join()
+        assert sharded.query_ids(documents, k=3) == expected
+        assert not sharded.failed
+        assert sharded.shards[1].alive()
+
+
+def test_hung_shard_is_left_out_and_restarted(tmp_path):
+    corpus = tmp_path / "corpus"
+    write_corpus(corpus)
+    index = build_index(corpus)
+    documents = list(live_documents(index).values())
+    with sharding.ShardedIndex(index.path, no_of_shards=2, timeout=10.0) as sharded:
+        expected = sharded.query_ids(documents, k=3)
+        shard = sharded.shards[0]
+        hung = shard.process
+        os.kill(hung.pid, signal.SIGSTOP)
+        sharded.timeout = 0.5
+        results = sharded.query_ids(documents, k=3)
+        assert sharded.failed == {0}
+        assert not any(doc_id < shard.stop for similar_docs in results.values() for doc_id, score in similar_docs)
+
+        sharded.timeout = 10.0
+        assert sharded.query_ids(documents, k=3) == expected
+        assert not sharded.failed
+        assert shard.process is not hung and not hung.is_alive()
+
+
+@contextlib.contextmanager
+def running_server(index_path, **options):
+    """QueryServer answering in a thread of this process, yields it and its port"""
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    query_server = server.QueryServer(index_path, workers=0, **options)
+    host, port = asyncio.run_coroutine_threadsafe(query_server.start(port=0), loop).result(10)
+    try:
+        yield query_server, port
+    finally:
+        asyncio.run_coroutine_threadsafe(query_server.close(), loop).result(10)
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join(10)
+        loop.close()
+
+
+def test_server_answers_local_client(tmp_path):
+    corpus = tmp_path / "corpus"
+    write_corpus(corpus)
+    index = build_index(corpus)
+    documents = live_documents(index)
+    with running_server(index.path) as (query_server, port):
+        with server.Client(port=port, timeout=10) as client:
+            results = client.query_id(documents["doc04.txt"])
+            assert results[0][0] == documents["doc05.txt"]
+            assert os.path.basename(results[0][1]) == "doc05.txt"
+
+            text = (corpus / "doc04.txt").read_text(encoding="utf8")
+            results = client.query_text(text, k=2)
+            assert [ doc_id for doc_id, filename, score in results ][0] == documents["doc04.txt"]
+
+            with pytest.raises(Exception, match="Unknown doc_id"):
+                client.query_id(len(index.files))
+
+        def query_all():
+            with server.Client(port=port, timeout=10) as client:
+                return client.request([ {"doc_id": doc_id} for doc_id in documents.values() ])
+
+        expected = server.run_batch([ {"doc_id": doc_id} for doc_id in documents.values() ], index)
+        with concurrent.futures.ThreadPoolExecutor(4) as pool:
+            for responses in pool.map(lambda i: query_all(), range(8)):
+                assert [ response["results"] for response in responses ] == [ response["results"]
+                                                                             for response in expected ]
+
+
+def test_server_stops_reading_when_queue_is_full(tmp_path):
+    corpus = tmp_path / "corpus"
+    write_corpus(corpus)
+    index = build_index(corpus)
+    doc_id = live_documents(index)["doc04.txt"]
+    release = threading.Event()
+    with running_server(index.path, max_queue=2, batch_size=1) as (query_server, port):
+        answer = query_server._run_batch
+
+        def blocked(requests):
+            release.wait(10)
+            return answer(requests)
+
+        query_server._run_batch = blocked
+        with server.Client(port=port, timeout=10) as client, concurrent.futures.ThreadPoolExecutor(1) as pool:
+            future = pool.submit(client.request, [ {"doc_id": doc_id} for i in range(20) ])
+            deadline = time.monotonic() + 10
+            while not query_server.queue.full() and time.monotonic() < deadline:
+                time.sleep(0.01)
+            assert query_server.queue.qsize() == 2
+            assert not future.done()
+
+            release.set()
+            responses = future.result(10)
+    assert len(responses) == 20
+    assert all(response["results"] == responses[0]["results"] and response["results"] for response in responses)
+
+
+def run_cli(*args):
+    """runs cli.py in a new process, returns its stdout as JSON records"""
+    completed = subprocess.run([sys.executable, os.path.join(REPOSITORY, "cli.py"), *args], capture_output=True,
+                               text=True, timeout=120, check=True)
+    # every line of stdout must be a JSON object
+    return [ json.loads(line) for line in completed.stdout.splitlines() ]
+
+
+def test_cli_index_and_dedupe(tmp_path):
+    corpus = tmp_path / "corpus"
+    write_corpus(corpus)
+    index_path = str(tmp_path / "corpus.index")
+
+    records = run_cli("index", str(corpus), "--output", index_path, "--shingle-size", "8",
+                      "--hash-functions", "64", "--rows", "4")
+    assert len(records) == 1
+    assert records[0]["index"] == index_path and records[0]["documents"] == 12
+    assert records[0]["params"]["shingle_size"] == 8 and records[0]["params"]["no_of_hash_functions"] == 64
+
+    records = run_cli("dedupe", index_path, "--threshold", "0.8")
+    for i, record in enumerate(records):
+        assert set(record) == {"cluster", "representative", "members"}
+        assert record["cluster"] == i
+        assert record["representative"] in [ filename for doc_id, filename, score in record["members"] ]
+        for doc_id, filename, score in record["members"]:
+            assert isinstance(doc_id, int) and os.path.dirname(filename) == str(corpus)
+            assert 0.0 <= score <= 1.0
+    # every third document is a near-duplicate of the one before
+    clusters = { tuple(sorted(os.path.basename(filename) for doc_id, filename, score in record["members"]))
+                 for record in records }
+    assert clusters == { (f"doc{j-1:02d}.txt", f"doc{j:02d}.txt") for j in range(2, 12, 3) }